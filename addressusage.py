@@ -0,0 +1,155 @@
+import sqlite3
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Set
+
+'''
+Remembers whether addresses have been used on chain, so that discovery and existaddress don't ask
+the backend again. Used addresses stay used, so positive entries are kept in the database as well.
+Unused addresses may receive a transaction at any time, so negative entries expire after a short TTL.
+'''
+
+SQLITE_DB_FILE = os.path.dirname(
+    os.path.realpath(__file__)) + "/data/wallets.db"
+
+def create_tables(cursor: sqlite3.Cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS UsedAddresses (address TEXT PRIMARY KEY)")
+
+# Positive entries don't expire.
+NEVER = float("inf")
+
+# Addresses per SELECT, below the 999 host parameters older SQLite versions allow.
+SELECT_BATCH_SIZE = 500
+
+class AddressUsageCache:
+    def __init__(self, max_entries: int, negative_ttl: float, flush_batch_size: int = 256):
+        """
+        @max_entries: entries kept in memory. The least recently used entry is evicted first.
+        @negative_ttl: seconds an unused address is remembered.
+        @flush_batch_size: positive entries are written to the database in batches of this size,
+                           or when flush() is called.
+        """
+        self._max_entries = max_entries
+        self._negative_ttl = negative_ttl
+        self._flush_batch_size = flush_batch_size
+
+        # address -> expire at (UNIX time)
+        self._entries: OrderedDict = OrderedDict()
+        # Used addresses not written to the database yet.
+        self._unflushed: Set[str] = set()
+        self._lock = threading.Lock()
+        self._tables_created = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(SQLITE_DB_FILE)
+        if not self._tables_created:
+            create_tables(conn.cursor())
+            conn.commit()
+            self._tables_created = True
+        return conn
+
+    def _put_entry(self, address: str, expire_at: float):
+        # Caller must hold self._lock
+        self._entries[address] = expire_at
+        self._entries.move_to_end(address)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, address: str) -> bool:
+        """
+        @return: True if used, False if unused, None if unknown.
+        """
+        return self.get_many([address])[0]
+
+    def get_many(self, addresses: List[str]) -> List[bool]:
+        """
+        Same as get for each address, with one database query for all those not in memory.
+        """
+        results: List[bool] = [None] * len(addresses)
+        # address -> indexes in addresses
+        missing: Dict[str, List[int]] = {}
+        now = time.time()
+        with self._lock:
+            for i, address in enumerate(addresses):
+                expire_at = self._entries.get(address)
+                if expire_at is not None:
+                    if expire_at > now:
+                        self._entries.move_to_end(address)
+                        self.hits += 1
+                        results[i] = expire_at == NEVER
+                        continue
+                    del self._entries[address]
+                if address in self._unflushed:
+                    self._put_entry(address, NEVER)
+                    self.hits += 1
+                    results[i] = True
+                    continue
+                missing.setdefault(address, []).append(i)
+        if len(missing) == 0:
+            return results
+
+        used_addresses: Set[str] = set()
+        missing_addresses = list(missing)
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            for start in range(0, len(missing_addresses), SELECT_BATCH_SIZE):
+                chunk = missing_addresses[start:start + SELECT_BATCH_SIZE]
+                cursor.execute("SELECT address FROM UsedAddresses WHERE address IN ({})".format(
+                    ",".join("?" * len(chunk))), chunk)
+                used_addresses.update(row[0] for row in cursor)
+
+        with self._lock:
+            for address, indexes in missing.items():
+                if address in used_addresses:
+                    self._put_entry(address, NEVER)
+                    self.hits += len(indexes)
+                    for i in indexes:
+                        results[i] = True
+                else:
+                    self.misses += len(indexes)
+        return results
+
+    def put(self, address: str, used: bool):
+        flush = False
+        with self._lock:
+            if used:
+                if self._entries.get(address) != NEVER:
+                    self._unflushed.add(address)
+                    flush = len(self._unflushed) >= self._flush_batch_size
+                self._put_entry(address, NEVER)
+            else:
+                self._put_entry(address, time.time() + self._negative_ttl)
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Write used addresses to the database.
+        """
+        with self._lock:
+            if len(self._unflushed) == 0:
+                return
+            addresses: List[str] = list(self._unflushed)
+
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("INSERT OR IGNORE INTO UsedAddresses (address) VALUES (?)",
+                               [(address,) for address in addresses])
+            conn.commit()
+        # Only once written, so that a failed write is tried again by the next flush.
+        with self._lock:
+            self._unflushed.difference_update(addresses)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "unflushed": len(self._unflushed),
+            }
@@ -0,0 +1,167 @@
+import aiohttp
+import asyncio
+import binascii
+import logging
+import threading
+import time
+from bitcoin.wallet import CBitcoinAddress
+from bitcoin.core import CTransaction, lx
+from typing import List, Set, Dict
+from config import Config
+from ratelimit import classify, OUTCOME_ERROR, RETRYABLE_STATUS_CODES
+import esplora
+import wallet
+
+'''
+asyncio implementation of the esplora module API. Requests run on one event loop in a background
+thread, so that hundreds of them can be in flight without a thread each. Synchronous code such as the
+Flask routes calls in with run().
+'''
+
+gLoop: asyncio.AbstractEventLoop = None
+gLoopLock = threading.Lock()
+gSession: aiohttp.ClientSession = None
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    global gLoop
+    with gLoopLock:
+        if gLoop is None:
+            gLoop = asyncio.new_event_loop()
+            threading.Thread(target=gLoop.run_forever, name="aioesplora", daemon=True).start()
+    return gLoop
+
+def run(coroutine):
+    """
+    Run a coroutine on the event loop and wait for its result. Must not be called from the event loop thread.
+    """
+    return asyncio.run_coroutine_threadsafe(coroutine, get_loop()).result()
+
+async def run_blocking(function, *args):
+    """
+    Run a function that may block, on SQLite or on a lock other threads hold, in the default executor,
+    so that the requests in flight on the event loop are not held up.
+    """
+    return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+def get_session() -> aiohttp.ClientSession:
+    # Only called on the event loop thread.
+    global gSession
+    if gSession is None:
+        gSession = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=Config.AsyncEsploraMaxInFlight),
+            timeout=aiohttp.ClientTimeout(sock_connect=Config.EsploraConnectTimeout,
+                                          sock_read=Config.EsploraReadTimeout))
+    return gSession
+
+async def http_get_json(url, retry_on_5xx=True):
+    """
+    Same retries, limits and coalescing of identical requests as esplora.http_get.
+    """
+    return await esplora.gSingleFlight.do_async((url, retry_on_5xx), lambda: _http_get_json(url, retry_on_5xx))
+
+async def _http_get_json(url, retry_on_5xx):
+    attempt = 0
+    while True:
+        await esplora.gLimiter.acquire_async()
+        start_time = time.time()
+        try:
+            async with get_session().get(url) as response:
+                if response.status == 200:
+                    body = await response.json()
+                else:
+                    body = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            esplora.gLimiter.release(OUTCOME_ERROR, time.time() - start_time)
+            delay = esplora.retry_delay(attempt) if retry_on_5xx else None
+            if delay is None:
+                raise
+            logging.debug("Retrying {} in {:.2f}s: {!r}".format(url, delay, e))
+        except BaseException:
+            esplora.gLimiter.release(OUTCOME_ERROR, time.time() - start_time)
+            raise
+        else:
+            esplora.gLimiter.release(classify(response.status), time.time() - start_time)
+            delay = None
+            if retry_on_5xx and response.status in RETRYABLE_STATUS_CODES:
+                delay = esplora.retry_delay(attempt, response.headers.get("Retry-After"))
+            if delay is None:
+                assert response.status == 200, "HTTP Error {}: {}".format(response.status, body)
+                return body
+            logging.debug("Retrying {} in {:.2f}s: HTTP {}".format(url, delay, response.status))
+
+        await asyncio.sleep(delay)
+        attempt += 1
+
+async def existaddress(bitcoinaddr: CBitcoinAddress) -> bool:
+    # A miss reads the database.
+    used = await run_blocking(esplora.gAddressUsageCache.get, str(bitcoinaddr))
+    if used is not None:
+        return used
+
+    json = await http_get_json("%saddress/%s" % (esplora.getendpoint(), str(bitcoinaddr)))
+    used = json["chain_stats"]["tx_count"] != 0
+    # May flush a batch to the database.
+    await run_blocking(esplora.gAddressUsageCache.put, str(bitcoinaddr), used)
+    return used
+
+async def utxo(address: CBitcoinAddress) -> Set["wallet.UnspentOutput"]:
+    json = await http_get_json("{endpoint}address/{addr}/utxo".format(
+        endpoint=esplora.getendpoint(), addr=str(address)))
+    utxos = set()
+    for elm in json:
+        if elm["status"]["confirmed"]:
+            utxos.add(wallet.UnspentOutput(
+                elm["txid"], elm["vout"], elm["value"], address))
+    return utxos
+
+async def utxos(addresses: List[CBitcoinAddress]) -> Dict[str, Set["wallet.UnspentOutput"]]:
+    results = await asyncio.gather(*[utxo(address) for address in addresses])
+    return {str(address): result for address, result in zip(addresses, results)}
+
+async def tx_get(txid: str):
+    tx_json = await run_blocking(esplora.gTransactionCache.get, txid)
+    if tx_json is not None:
+        return tx_json
+
+    tx_json = await http_get_json("{}tx/{}".format(esplora.getendpoint(), txid))
+    await run_blocking(esplora.gTransactionCache.put, tx_json)
+    return tx_json
+
+async def address_stats(address: str) -> dict:
+    """
+    Same as esplora.address_stats.
+    """
+    stats_json = await http_get_json("{}address/{}".format(esplora.getendpoint(), address))
+    await run_blocking(esplora.gAddressUsageCache.put, address, stats_json["chain_stats"]["tx_count"] != 0)
+    return stats_json
+
+async def address_txs(address: str, synced_txid):
+    if synced_txid is None:
+        address_txs_url = "{}address/{}/txs".format(esplora.getendpoint(), address)
+    else:
+        address_txs_url = "{}address/{}/txs/chain/{}".format(
+            esplora.getendpoint(), address, synced_txid)
+    address_txs_json = await http_get_json(address_txs_url)
+
+    def cache_txs():
+        for tx_json in address_txs_json:
+            esplora.gTransactionCache.put(tx_json)
+    await run_blocking(cache_txs)
+    return address_txs_json
+
+async def fee_estimates():
+    """
+    Same as esplora.fee_estimates.
+    """
+    return await http_get_json("{endpoint}fee-estimates".format(endpoint=esplora.getendpoint()))
+
+async def send_tx(tx: CTransaction) -> str:
+    tx_url = "{endpoint}tx".format(endpoint=esplora.getendpoint())
+    async with get_session().post(tx_url, data=binascii.hexlify(tx.serialize()).decode("ascii")) as response:
+        text = await response.text()
+        if response.status != 200:
+            logging.warning("Send transaction failed: " + text)
+            return ""
+
+    assert lx(text) == tx.GetTxid()
+    return text
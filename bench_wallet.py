@@ -0,0 +1,127 @@
+import argparse
+import gc
+import json
+import os
+import random
+import time
+import tracemalloc
+import bitcoin
+from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut, COutPoint
+from bitcoin.core.script import CScript
+from bitcoin.wallet import P2WPKHBitcoinAddress
+# discovery before wallet, as utils imports them.
+import discovery
+from wallet import Wallet, AddressDelta, UnspentOutput
+
+'''
+Memory and throughput of the in-memory state of a big wallet, restored from a synthetic snapshot:
+python bench_wallet.py --addresses 50000 --utxos 100000
+No network access, nothing is written to the database.
+'''
+
+def random_address() -> P2WPKHBitcoinAddress:
+    return P2WPKHBitcoinAddress.from_scriptPubKey(CScript([0, os.urandom(20)]))
+
+def make_snapshot(address_count: int, utxo_count: int) -> dict:
+    per_chain = address_count // 2
+    addresses = []
+    for change in (0, 1):
+        for address_index in range(per_chain):
+            address = random_address()
+            addresses.append([0, change, address_index, str(address), address.to_scriptPubKey().hex(), 0,
+                              os.urandom(32).hex(), None, None, time.time()])
+    unspent_outputs = []
+    for _ in range(utxo_count):
+        address = random.choice(addresses)
+        value = random.randint(1000, 1000000)
+        address[5] += value
+        unspent_outputs.append([os.urandom(32).hex(), random.randint(0, 3), value, address[3], False])
+    return {
+        "last_sync": time.time(),
+        "balance": sum(utxo[2] for utxo in unspent_outputs),
+        "watermarks": [(per_chain - 1, per_chain - 1)],
+        "addresses": addresses,
+        "unspent_outputs": unspent_outputs,
+        "mempool_txids": [],
+        "mempool_txs": [],
+    }
+
+def make_txs(wallet: Wallet, count: int, own_fraction: float):
+    """
+    Transactions as seen by zmqnotify: mostly unrelated to the wallet, some paying to it.
+    """
+    addresses = list(wallet.addresses_map.values())
+    txs = []
+    for _ in range(count):
+        vin = [CMutableTxIn(COutPoint(os.urandom(32), 0)) for _ in range(2)]
+        vout = [CMutableTxOut(10000, random_address().to_scriptPubKey()) for _ in range(2)]
+        if random.random() < own_fraction:
+            vout.append(CMutableTxOut(10000, random.choice(addresses).address.to_scriptPubKey()))
+        txs.append(CMutableTransaction(vin, vout))
+    return txs
+
+def timed(label: str, fn, count: int):
+    # Not a collection of garbage left by the setup.
+    gc.collect()
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print("{:<40} {:>10.1f} ms {:>12.0f} /s".format(label, elapsed * 1000, count / elapsed))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--addresses", type=int, default=50000)
+    parser.add_argument("--utxos", type=int, default=100000)
+    parser.add_argument("--txs", type=int, default=20000)
+    args = parser.parse_args()
+
+    bitcoin.SelectParams("testnet")
+    random.seed(0)
+    state_json = json.dumps(make_snapshot(args.addresses, args.utxos))
+
+    # As a cold load does: only what the wallet keeps of the decoded snapshot counts. Tracing slows down
+    # allocations, so restore_state is timed on another wallet.
+    gc.collect()
+    tracemalloc.start()
+    snapshot = json.loads(state_json)
+    traced_wallet = Wallet(b"\x00" * 64)
+    traced_wallet.restore_state(snapshot)
+    del snapshot
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del traced_wallet
+    gc.collect()
+
+    wallet = Wallet(b"\x00" * 64)
+    snapshot = json.loads(state_json)
+    start = time.perf_counter()
+    wallet.restore_state(snapshot)
+    elapsed = time.perf_counter() - start
+    print("{} addresses, {} unspent outputs".format(len(wallet.addresses_map), len(wallet.unspent_outputs_map)))
+    print("{:<40} {:>10.1f} MB".format("wallet state memory", current / 1e6))
+    print("{:<40} {:>10.1f} ms".format("restore_state", elapsed * 1000))
+
+    utxos = list(wallet.unspent_outputs_map.values())
+    lookups = [(utxo.txid, utxo.vout) for utxo in random.sample(utxos, min(len(utxos), 50000))]
+    timed("find unspent output", lambda: [wallet._find_unspent_output(txid, vout) for txid, vout in lookups],
+          len(lookups))
+
+    txs = make_txs(wallet, args.txs, 0.01)
+    timed("addresses_touched_by (ZMQ rawtx)", lambda: [wallet.addresses_touched_by(tx) for tx in txs], len(txs))
+
+    # A sync where a tenth of the addresses spent one output and received a new one.
+    utxo_by_address = {utxo.address: utxo for utxo in utxos}
+    deltas = []
+    for address in random.sample(list(wallet.addresses_map.values()), args.addresses // 10):
+        delta = AddressDelta(address)
+        spent = utxo_by_address.get(address.address)
+        if spent is not None:
+            delta.spent_utxo_keys.add(spent.outpoint)
+        delta.created_utxos.append(UnspentOutput(os.urandom(32).hex(), 0, 5000, address.address))
+        deltas.append(delta)
+    timed("apply deltas of a sync", lambda: wallet._apply_deltas(deltas), len(deltas))
+    timed("state_snapshot", lambda: wallet.read_state(wallet.state_snapshot), 1)
+
+if __name__ == '__main__':
+    main()
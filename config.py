@@ -3,6 +3,10 @@ import os
 NETWORK_MAINNET = "mainnet"
 NETWORK_TESTNET = "testnet"
 
+BACKEND_ESPLORA = "esplora"
+BACKEND_FULLNODE = "fullnode"
+BACKEND_ELECTRUM = "electrum"
+
 class FullNodeConfig:
     def __init__(self, config_file):
         """
@@ -45,12 +49,86 @@ class Config():
     # Same as "EsploraEndpoint", except it is for testnet.
     TestNetExploraEndpoint = "https://blockstream.info/testnet/api/"
 
-    FullNodeConfig: FullNodeConfig(os.path.dirname(os.path.abspath(__file__)) + "/.fullnode_connection.conf")
-
     TestNetFullNodeConfig = FullNodeConfig(
         os.path.dirname(os.path.abspath(__file__)) +
                         "/.fullnode_connection.testnet.conf")
 
+    # Assigned after TestNetFullNodeConfig since it shadows the FullNodeConfig class in this scope.
+    FullNodeConfig = FullNodeConfig(os.path.dirname(os.path.abspath(__file__)) + "/.fullnode_connection.conf")
+
+    # Where discovery and balances come from.
+    # BACKEND_ESPLORA: Esplora at EsploraEndpoint, one request per address.
+    # BACKEND_FULLNODE: a watch-only descriptor wallet on the node in FullNodeConfig, created by the first
+    #   discovery, which imports the descriptors of the accounts with a rescan of the chain. Syncs read the
+    #   history, unspent outputs and mempool transactions of all addresses from it with a few wallet RPCs.
+    #   Needs Bitcoin Core 22 or later, with wallet support.
+    # BACKEND_ELECTRUM: an Electrum server at ElectrumServer, with batched requests for many addresses, and
+    #   only addresses whose status changed since the last sync are looked at.
+    ChainBackend = BACKEND_ESPLORA
+
+    # host:port of an Electrum server (https://electrumx.readthedocs.io/en/latest/protocol.html)
+    ElectrumServer = "electrum.blockstream.info:50002"
+
+    # Same as "ElectrumServer", except it is for testnet.
+    TestNetElectrumServer = "electrum.blockstream.info:60002"
+
+    # Connect to the Electrum server with TLS.
+    ElectrumUseSSL = True
+
+    # Seconds to wait for the Electrum server to connect or to answer a batch.
+    ElectrumTimeout = 30
+
+    # Requests sent to the Electrum server in one batch.
+    ElectrumBatchSize = 1000
+
+    # Initial range of the descriptors imported into the node wallet. Doubled while used indexes come within
+    # the gap limit of the end of the range, which rescans the chain again.
+    FullNodeScanRange = 1000
+
+    # Seconds to wait for an answer from the node. The rescan of importdescriptors can take minutes on mainnet.
+    FullNodeTimeout = 600
+
+    # request_sync syncs a wallet at most once per SyncMinInterval seconds. It is skipped while the chain
+    # tip is unchanged and no ZMQ notification touched the wallet, for up to SyncMaxStaleness seconds,
+    # which bounds how late an unconfirmed payment shows up without ZMQ.
+    SyncMinInterval = 20
+    SyncMaxStaleness = 120
+
+    # Also sync when the mempool changed, with BACKEND_ESPLORA or BACKEND_FULLNODE. The mempool of a busy
+    # network changes all the time, so this mostly helps on testnet.
+    SyncOnMempoolChange = False
+
+    # Seconds the chain tip checked for request_sync is shared by all wallets.
+    ChainStateCheckInterval = 5
+
+    # A sync looks at the unused addresses after the last used one and those of pending transactions
+    # every time, at addresses with unspent outputs every WarmAddressSyncInterval seconds, and at used
+    # addresses with nothing left every ColdAddressSyncInterval seconds, since only reuse changes them.
+    WarmAddressSyncInterval = 600
+    ColdAddressSyncInterval = 3600
+
+    # Loaded wallets are synced in the background: every SyncMinInterval seconds while a page of the wallet
+    # is open, every SyncIdleInterval seconds otherwise, with at most SyncMaxConcurrentWallets at a time.
+    SyncIdleInterval = 300
+    SyncMaxConcurrentWallets = 2
+
+    # A wallet that failed to load, e.g. because the chain backend is down, is loaded again after
+    # SyncLoadRetryDelay seconds, doubling up to SyncLoadRetryMaxDelay seconds while it keeps failing.
+    SyncLoadRetryDelay = 5
+    SyncLoadRetryMaxDelay = 300
+
+    # Seconds a page waits for a wallet to be loaded, or for a sync it asked to wait for. The page shows
+    # what is loaded so far after that.
+    SyncWaitTimeout = 30
+
+    # ZMQ endpoints of the full node (bitcoind -zmqpubrawtx=tcp://127.0.0.1:28332 and -zmqpubhashblock=...)
+    # to show new transactions as soon as the node sees them. Needs pyzmq. Empty to not subscribe.
+    ZmqRawTxEndpoint = ""
+    ZmqHashBlockEndpoint = ""
+
+    # Seconds to wait after a ZMQ block notification before syncing, so that the chain backend has the block.
+    ZmqBlockSyncDelay = 2
+
     # Opt-in Full Replace-by-Fee Signaling
     # Reference: https://github.com/bitcoin/bips/blob/master/bip-0125.mediawiki
     EnableBip125Rfb = True
@@ -60,5 +138,71 @@ class Config():
 
     ThreadPoolMaxWorkers = 10
 
+    # Sync addresses with the asyncio Esplora client (aioesplora) instead of ThreadPoolMaxWorkers threads.
+    EnableAsyncEsplora = False
+
+    # Requests to Esplora in flight at the same time with the asyncio client.
+    AsyncEsploraMaxInFlight = 100
+
+    # Seconds to wait for Esplora to accept a connection, and for a response once connected.
+    EsploraConnectTimeout = 5
+    EsploraReadTimeout = 30
+
+    # Requests to Esplora in flight at the same time adapt to 429/5xx responses and latency,
+    # starting at EsploraInitialConcurrency, within [EsploraMinConcurrency, EsploraMaxConcurrency].
+    EsploraMinConcurrency = 1
+    EsploraInitialConcurrency = ThreadPoolMaxWorkers
+    EsploraMaxConcurrency = AsyncEsploraMaxInFlight
+
+    # Requests per second sent to Esplora. 0 for no limit.
+    EsploraRequestsPerSecond = 0
+
+    # The concurrency limit stops growing while the smoothed latency is above this multiple of the fastest recent response.
+    EsploraLatencyTolerance = 4
+
+    # Retries of an Esplora request that failed with 429, 5xx or a connection error. The delay before
+    # each retry is jittered and doubles from EsploraRetryBaseDelay up to EsploraRetryMaxDelay seconds,
+    # or is what the Retry-After header asks for.
+    EsploraMaxRetries = 5
+    EsploraRetryBaseDelay = 0.5
+    EsploraRetryMaxDelay = 30
+
+    # Seconds between refreshes of fee estimates. Readers never wait for a refresh once the first one is done.
+    FeeEstimateTTL = 60
+
+    # Seconds before fee estimates are fetched again after all sources failed, doubling up to FeeEstimateTTL.
+    FeeEstimateRetryDelay = 2
+
+    # Fall back to estimatesmartfee on the node in FullNodeConfig when Esplora fails to give fee estimates.
+    # With BACKEND_FULLNODE the node is asked first and Esplora is the fallback.
+    FeeEstimateFullNodeFallback = True
+
+    # Addresses whose on-chain usage is remembered in memory. Used addresses are also kept in the database.
+    AddressUsageCacheMaxEntries = 100000
+
+    # Seconds an address is remembered as unused.
+    AddressUsageNegativeTTL = 60
+
+    # Confirmed transactions kept in memory. All of them are also kept in the database.
+    TransactionCacheMaxEntries = 10000
+
+    # Accounts scanned during discovery ahead of the last account known to be used. 0 disables speculation.
+    DiscoveryMaxSpeculativeAccounts = 1
+
+    # Receive/change chains scanned at the same time, across all discoveries.
+    DiscoveryMaxConcurrentChainScans = 8
+
+    # Address existence checks in flight at the same time, across all discoveries.
+    DiscoveryMaxInFlightProbes = 4 * ThreadPoolMaxWorkers
+
+    # Worker processes for CPU bound work such as deriving large ranges of addresses.
+    ProcessPoolMaxWorkers = os.cpu_count() or 1
+
+    # Address ranges of at least this many addresses are derived in the process pool.
+    DeriveRangeProcessPoolThreshold = 2000
+
+    # Transactions with at least this many inputs are signed in the process pool.
+    SignProcessPoolThreshold = 200
+
     # True if the access is protected with a passphrase.
     EnableLogin = True
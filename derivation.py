@@ -0,0 +1,15 @@
+from bip32 import BIP32
+from typing import List
+
+'''
+Key derivation that can run in a worker process. The module only depends on bip32 so
+that it is cheap to import in each worker of the process pool.
+'''
+
+def derive_pubkeys(chaincode: bytes, pubkey: bytes, start: int, count: int) -> List[bytes]:
+    """
+    @chaincode, @pubkey: the extended public key of the parent node.
+    @return: public keys of the non-hardened children [start, start+count).
+    """
+    node = BIP32(chaincode, pubkey=pubkey)
+    return [node.get_pubkey_from_path([index]) for index in range(start, start + count)]
@@ -1,41 +1,100 @@
 from bitcoin.core.serialize import Hash160
 from bitcoin.wallet import CBitcoinAddress, P2PKHBitcoinAddress, P2SHBitcoinAddress, P2WPKHBitcoinAddress
 from bitcoin.core.script import OP_0, OP_CHECKSIG, OP_DUP, OP_EQUAL, OP_EQUALVERIFY, OP_HASH160
-from typing import List, Set, Tuple
+from typing import List, Set, Tuple, Dict
 from bitcoin import bitcoin
 from bip32 import BIP32, HARDENED_INDEX
 import hashlib
 import logging
 import esplora
 import time
-from wallet import Wallet, Bip44Path, Address
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from wallet import Wallet, Bip44Path, Address, DerivedAddress
+from config import Config, NETWORK_TESTNET, BACKEND_ELECTRUM
+import fullnode
+import electrum
+import re
+
+# Runs chain scans. They mostly wait for existence checks running in esplora.gThreadPoolExecutor.
+gDiscoveryThreadPoolExecutor: ThreadPoolExecutor = ThreadPoolExecutor(
+    Config.DiscoveryMaxConcurrentChainScans)
+
+# Bounds the existence checks in flight across all chain scans.
+gProbeSemaphore = threading.BoundedSemaphore(Config.DiscoveryMaxInFlightProbes)
     
 '''
 Given a seed and path, discover all its addresses. BIP 44 specifies addresses are sequentially increasing,
 but it does not specify how. Here we assume for each account, addresses are sequentially increasing
 respecting a gap limit.
+
+Existence checks for the whole window up to the current stop index are in flight at once. A hit moves the
+stop index forward as soon as it comes back, in whatever order the responses arrive. Every checked index is
+below the stop index at the time it is submitted, so it would have been checked by a sequential scan as well,
+and the result is the same as checking one address at a time.
 '''
 def bip84_discover_addresses(seed: bytes, account_i: int, is_change: bool,
-                             bip84_path: Bip44Path, gap_limit: int) -> Tuple[List[Address], int]:
-    addrs: List[(P2WPKHBitcoinAddress, int)] = []
-     
-    stop_at = gap_limit
-    index = 0
-    last_exist_index = -1
-    while index < stop_at:
-        change = 1 if is_change else 0
-        pubkey: bytes = bip84_path.derive_pubkey(account_i, change, index)
-        p2wpkh = bitcoin.core.CScript([OP_0, Hash160(pubkey)])
-        p2wpkh_addr = P2WPKHBitcoinAddress.from_scriptPubKey(p2wpkh)
-        if esplora.existaddress(p2wpkh_addr):
-            stop_at = index + gap_limit + 1
-            last_exist_index = index
-            addrs.append(Address(is_change, index, account_i, p2wpkh_addr, 0))
-        else:
-            addrs.append(Address(is_change, index,
-                             account_i, p2wpkh_addr, 0))
-        index += 1
+                             bip84_path: Bip44Path, gap_limit: int,
+                             cancelled: threading.Event = None,
+                             known_last_exist_index: int = -1) -> Tuple[List[Address], int]:
+    """
+    @cancelled: once set, no more existence checks are submitted and the result is meaningless.
+    @known_last_exist_index: addresses up to this index are known to be used from an earlier
+                             discovery and are not checked again.
+    """
+    change = 1 if is_change else 0
+    last_exist_index = known_last_exist_index
+    stop_at = last_exist_index + gap_limit + 1
+    derived_addresses: List[DerivedAddress] = bip84_path.derive_range(
+        account_i, change, 0, last_exist_index + 1) if last_exist_index >= 0 else []
+    # Future of esplora.existaddress -> address index
+    pending: Dict[Future, int] = {}
+    while True:
+        while len(derived_addresses) < stop_at and not (cancelled is not None and cancelled.is_set()):
+            new_addresses = bip84_path.derive_range(
+                account_i, change, len(derived_addresses), stop_at - len(derived_addresses))
+            derived_addresses.extend(new_addresses)
+            unknown_addresses: List[DerivedAddress] = []
+            # Addresses in the usage cache don't need a request. One database query for the whole window.
+            used_list = esplora.gAddressUsageCache.get_many(
+                [str(derived_address.address) for derived_address in new_addresses])
+            for derived_address, used in zip(new_addresses, used_list):
+                if used is not None:
+                    if used:
+                        last_exist_index = max(last_exist_index, derived_address.address_index)
+                        stop_at = max(stop_at, derived_address.address_index + gap_limit + 1)
+                else:
+                    unknown_addresses.append(derived_address)
+
+            if Config.ChainBackend == BACKEND_ELECTRUM:
+                # The whole window in one round trip.
+                used_list = electrum.existaddresses([derived_address.address for derived_address in unknown_addresses])
+                for derived_address, used in zip(unknown_addresses, used_list):
+                    if used:
+                        last_exist_index = max(last_exist_index, derived_address.address_index)
+                        stop_at = max(stop_at, derived_address.address_index + gap_limit + 1)
+                continue
+
+            for derived_address in unknown_addresses:
+                # Blocks while the budget shared by all discoveries is used up.
+                gProbeSemaphore.acquire()
+                future = esplora.gThreadPoolExecutor.submit(esplora.existaddress, derived_address.address)
+                future.add_done_callback(lambda _: gProbeSemaphore.release())
+                pending[future] = derived_address.address_index
 
+        if len(pending) == 0:
+            break
+
+        done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+        for future in done:
+            index = pending.pop(future)
+            if future.result():
+                last_exist_index = max(last_exist_index, index)
+                stop_at = max(stop_at, index + gap_limit + 1)
+
+    addrs = [Address(is_change, derived_address.address_index, account_i, derived_address.address, 0,
+                     derived_address.address_string)
+             for derived_address in derived_addresses]
     return addrs, last_exist_index
 
 class DiscoverWalletResult():
@@ -48,8 +107,19 @@ class DiscoverWalletResult():
         self.change_addresses = change_addresses
         self.last_change_address_index = last_change_address_index
 
-def discover_bip84_wallet(seed: bytes, gap_limit=20) -> DiscoverWalletResult:
-    bip84_path = Bip44Path(seed, 84, 0)
+def discover_bip84_wallet(seed: bytes, gap_limit=20, bip84_path: Bip44Path = None,
+                          max_speculative_accounts: int = None,
+                          watermarks: List[Tuple[int, int]] = None) -> DiscoverWalletResult:
+    """
+    @max_speculative_accounts: accounts scanned ahead of the last account known to be used.
+                               Config.DiscoveryMaxSpeculativeAccounts if None. 0 disables speculation.
+    @watermarks: (last used receive index, last used change index) per account from an earlier
+                 discovery. Each chain is only checked after its watermark. None to scan from index 0.
+    """
+    if watermarks is None:
+        watermarks = []
+    if bip84_path is None:
+        bip84_path = Bip44Path(seed, 84, 0)
 
     # Discovery addresses.
     start = time.time()
@@ -58,29 +128,204 @@ def discover_bip84_wallet(seed: bytes, gap_limit=20) -> DiscoverWalletResult:
     change_addresses: List[List[Address]] = []
     last_change_address_index: List[int] = []
 
+    if max_speculative_accounts is None:
+        max_speculative_accounts = Config.DiscoveryMaxSpeculativeAccounts
+
+    # Receive and change chains of an account are scanned concurrently. Accounts up to
+    # max_speculative_accounts after the current one are scanned before it is known whether
+    # they will be needed; their scans are cancelled once an unused account is found.
+    # account -> (receive chain scan, change chain scan)
+    scans: Dict[int, Tuple[Future, Future]] = {}
+    cancelled = threading.Event()
+    def start_scan(account):
+        known_last_indexes = watermarks[account] if account < len(watermarks) else (-1, -1)
+        scans[account] = tuple(gDiscoveryThreadPoolExecutor.submit(
+            bip84_discover_addresses, seed, account, is_change, bip84_path, gap_limit, cancelled,
+            known_last_indexes[1 if is_change else 0])
+            for is_change in (False, True))
+
+    for account in range(max_speculative_accounts + 1):
+        start_scan(account)
+
     account_i = 0
     total_address_count = 0
     done = False
     while not done:
-        receiving_addrs, index = bip84_discover_addresses(
-            seed, account_i, False, bip84_path, gap_limit)
+        receive_scan, change_scan = scans.pop(account_i)
+        receiving_addrs, index = receive_scan.result()
         if index == -1:
+            cancelled.set()
+            change_scan.cancel()
+            for speculative_scans in scans.values():
+                for scan in speculative_scans:
+                    scan.cancel()
             done = True
             break
-        
+
+        start_scan(account_i + max_speculative_accounts + 1)
+
         receive_addresses.append(receiving_addrs)
         last_receive_address_index.append(index)
 
-        change_addrs, index = bip84_discover_addresses(
-            seed, account_i, True, bip84_path, gap_limit)
+        change_addrs, index = change_scan.result()
         change_addresses.append(change_addrs)
         last_change_address_index.append(index) # index could be -1
 
         account_i += 1
         total_address_count += len(change_addrs) + len(receiving_addrs)
 
-    logging.debug("Discovered %d accounts and %d addresses, and it took %d ms." % (
-        account_i, total_address_count, int((time.time() - start)*1000)))
+    esplora.gAddressUsageCache.flush()
+    logging.debug("Discovered %d accounts and %d addresses, and it took %d ms. Address usage cache: %s" % (
+        account_i, total_address_count, int((time.time() - start)*1000), esplora.gAddressUsageCache.stats()))
+
+    return DiscoverWalletResult(receive_addresses, last_receive_address_index,
+        change_addresses, last_change_address_index)
+
+def _descriptor_xpub(xpub: str) -> str:
+    # The node only accepts tpub on testnet.
+    node = BIP32.from_xpub(xpub)
+    network = "test" if Config.Network == NETWORK_TESTNET else "main"
+    return BIP32(node.master_chaincode, None, node.master_pubkey, node.parent_fingerprint,
+                 node.depth, node.index, network).get_master_xpub()
+
+# Key origin of the descriptor of an address in wpkh(xpub/<change>/*), e.g. wpkh([d34db33f/1/5]03...)
+DESCRIPTOR_ORIGIN_PATTERN = re.compile(r"\[[0-9a-fA-F]{8}/(\d+)/(\d+)\]")
+
+# xpub and change of a ranged descriptor of the node wallet, with or without key origin and checksum.
+RANGED_DESCRIPTOR_PATTERN = re.compile(r"^wpkh\((?:\[[^\]]*\])?(\w+)/(\d+)/\*\)")
+
+# Categories of the listtransactions entries for outputs paid to the wallet.
+RECEIVE_CATEGORIES = ("receive", "generate", "immature", "orphan")
+
+def fullnode_wallet_name(bip84_path: Bip44Path) -> str:
+    """
+    @return: name of the watch-only wallet on the node that tracks the addresses of a wallet. It is
+             derived from the first account, so that the same wallet is found again after a restart.
+    """
+    return "openwallet-" + hashlib.sha256(bip84_path.account_xpub(0).encode("ascii")).hexdigest()[:16]
+
+def import_fullnode_descriptors(bip84_path: Bip44Path, wallet_name: str,
+                                address_counts: List[Tuple[int, int]]) -> bool:
+    """
+    Make the node wallet track at least the first (receive, change) address counts of each account.
+    Descriptors that are missing, or whose range is too short, are imported with a rescan of the whole
+    chain, so ranges start at Config.FullNodeScanRange and double to keep rescans rare.
+    @return: True if anything was imported.
+    """
+    try:
+        descriptors = fullnode.listdescriptors(wallet_name)
+    except fullnode.RPCError as e:
+        if e.code != fullnode.RPC_WALLET_NOT_FOUND:
+            raise
+        fullnode.load_watch_only_wallet(wallet_name)
+        descriptors = fullnode.listdescriptors(wallet_name)
+    # (xpub, change) -> end of the imported range
+    range_ends: Dict[Tuple[str, int], int] = {}
+    for descriptor in descriptors:
+        match = RANGED_DESCRIPTOR_PATTERN.search(descriptor["desc"])
+        if match is not None and "range" in descriptor:
+            range_ends[(match.group(1), int(match.group(2)))] = descriptor["range"][1]
+
+    requests = []
+    for account_i, counts in enumerate(address_counts):
+        xpub = _descriptor_xpub(bip84_path.account_xpub(account_i))
+        for change, count in enumerate(counts):
+            if count <= range_ends.get((xpub, change), -1) + 1:
+                continue
+            scan_range = Config.FullNodeScanRange
+            while scan_range < count:
+                scan_range *= 2
+            # Nothing tells when the addresses were first used, so the rescan starts at the genesis block.
+            requests.append({"desc": "wpkh({}/{}/*)".format(xpub, change), "range": [0, scan_range - 1],
+                             "timestamp": 0})
+    if len(requests) == 0:
+        return False
+
+    start = time.time()
+    fullnode.importdescriptors(wallet_name, requests)
+    logging.debug("Imported %d descriptors into %s, and the rescan took %d ms." % (
+        len(requests), wallet_name, int((time.time() - start)*1000)))
+    return True
+
+def _fullnode_last_indexes(wallet_name: str, xpubs: List[str]) -> List[List[int]]:
+    """
+    @return: [last used receive address index, last used change address index] per account, -1 if none.
+             An address is used once it was paid, even if it was spent since.
+    """
+    addresses = set(transaction["address"] for transaction in fullnode.listtransactions(wallet_name)
+                    if transaction["category"] in RECEIVE_CATEGORIES)
+    accounts = {xpub: account_i for account_i, xpub in enumerate(xpubs)}
+    last_indexes = [[-1, -1] for _ in xpubs]
+    for info in fullnode.getaddressinfos(wallet_name, sorted(addresses)):
+        parent = RANGED_DESCRIPTOR_PATTERN.search(info.get("parent_desc", ""))
+        if parent is None or parent.group(1) not in accounts:
+            continue
+        match = DESCRIPTOR_ORIGIN_PATTERN.search(info["desc"])
+        assert match is not None, "Unexpected descriptor {}".format(info["desc"])
+        change, index = int(match.group(1)), int(match.group(2))
+        account_last_indexes = last_indexes[accounts[parent.group(1)]]
+        account_last_indexes[change] = max(account_last_indexes[change], index)
+    return last_indexes
+
+def discover_bip84_wallet_fullnode(seed: bytes, gap_limit=20, bip84_path: Bip44Path = None,
+                                   watermarks: List[Tuple[int, int]] = None) -> DiscoverWalletResult:
+    """
+    Discover accounts with a watch-only descriptor wallet on the full node. It tracks the history of
+    every address in the imported ranges, spent or not, and the mempool, so that discovery is a few wallet
+    RPCs once the descriptors are imported. Only the first discovery of a wallet, and accounts or ranges
+    found later, cost a rescan of the chain.
+
+    An account is found if any of its addresses was paid.
+    @watermarks: same as in discover_bip84_wallet. The node wallet has the whole history anyway, they
+                 only keep accounts and indexes from going backwards.
+    """
+    if bip84_path is None:
+        bip84_path = Bip44Path(seed, 84, 0)
+    if watermarks is None:
+        watermarks = []
+
+    start = time.time()
+    wallet_name = fullnode_wallet_name(bip84_path)
+    # Known accounts, and the one after them that is checked for use.
+    account_count = len(watermarks) + 1
+    while True:
+        xpubs = [_descriptor_xpub(bip84_path.account_xpub(account_i)) for account_i in range(account_count)]
+        if import_fullnode_descriptors(bip84_path, wallet_name, [(gap_limit, gap_limit)] * account_count):
+            continue
+        last_indexes = _fullnode_last_indexes(wallet_name, xpubs)
+        for account_i, known_last_indexes in enumerate(watermarks):
+            last_indexes[account_i] = [max(last_index, known_last_index)
+                                       for last_index, known_last_index in zip(last_indexes[account_i], known_last_indexes)]
+        # Used indexes close to the end of the ranges may be followed by more.
+        if import_fullnode_descriptors(bip84_path, wallet_name,
+                                       [(receive + gap_limit + 1, change + gap_limit + 1)
+                                        for receive, change in last_indexes]):
+            continue
+        if last_indexes[-1] == [-1, -1]:
+            break
+        account_count += 1
+
+    receive_addresses: List[List[Address]] = []
+    last_receive_address_index: List[int] = []
+    change_addresses: List[List[Address]] = []
+    last_change_address_index: List[int] = []
+    total_address_count = 0
+    for account_i, account_last_indexes in enumerate(last_indexes[:-1]):
+        for change, last_index in enumerate(account_last_indexes):
+            derived_addresses = bip84_path.derive_range(account_i, change, 0, last_index + gap_limit + 1)
+            addrs = [Address(change == 1, derived_address.address_index, account_i, derived_address.address, 0,
+                             derived_address.address_string)
+                     for derived_address in derived_addresses]
+            if change == 0:
+                receive_addresses.append(addrs)
+                last_receive_address_index.append(last_index)
+            else:
+                change_addresses.append(addrs)
+                last_change_address_index.append(last_index)
+            total_address_count += len(addrs)
+
+    logging.debug("Discovered %d accounts and %d addresses with the node wallet %s, and it took %d ms." % (
+        len(receive_addresses), total_address_count, wallet_name, int((time.time() - start)*1000)))
 
     return DiscoverWalletResult(receive_addresses, last_receive_address_index,
         change_addresses, last_change_address_index)
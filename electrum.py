@@ -0,0 +1,275 @@
+import socket
+import ssl
+import json
+import hashlib
+import binascii
+import logging
+import threading
+from bitcoin.wallet import CBitcoinAddress, CBitcoinAddressError
+from bitcoin.core import CTransaction, CTxOut, b2lx, lx
+from typing import List, Set, Dict, Tuple
+from config import Config, NETWORK_MAINNET
+import esplora
+import wallet
+
+'''
+Chain backend speaking the Electrum server protocol (JSON-RPC over TCP or TLS, one message per line).
+Requests for many addresses are sent as one batch, so a sync costs a few round trips instead of one
+request per address. Reference: https://electrumx.readthedocs.io/en/latest/protocol.html
+'''
+
+CLIENT_NAME = "bitcoin-wallet"
+PROTOCOL_VERSION = "1.4"
+
+def scripthash(address: CBitcoinAddress) -> str:
+    # SHA256 of the scriptPubKey, hex in reversed byte order.
+    return b2lx(hashlib.sha256(address.to_scriptPubKey()).digest())
+
+class ElectrumClient:
+    def __init__(self, host: str, port: int, use_ssl: bool, timeout: float, batch_size: int):
+        self._host = host
+        self._port = port
+        self._use_ssl = use_ssl
+        self._timeout = timeout
+        self._batch_size = batch_size
+
+        self._sock: socket.socket = None
+        self._file = None
+        self._next_id = 0
+        # One batch on the connection at a time.
+        self._lock = threading.Lock()
+
+        # scripthash -> status from the latest subscription notification
+        self.notified_statuses: Dict[str, str] = {}
+
+    def _connect(self):
+        sock = socket.create_connection((self._host, self._port), self._timeout)
+        if self._use_ssl:
+            sock = ssl.create_default_context().wrap_socket(sock, server_hostname=self._host)
+        self._sock = sock
+        self._file = sock.makefile("rb")
+        self._send_and_receive([("server.version", [CLIENT_NAME, PROTOCOL_VERSION])])
+
+    def _close(self):
+        if self._sock is not None:
+            try:
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._file = None
+        # Subscriptions don't survive the connection.
+        self.notified_statuses.clear()
+
+    def _send_and_receive(self, calls: List[Tuple[str, list]]) -> list:
+        requests = []
+        for method, params in calls:
+            self._next_id += 1
+            requests.append({"jsonrpc": "2.0", "id": self._next_id, "method": method, "params": params})
+        payload = requests if len(requests) > 1 else requests[0]
+        self._sock.sendall(json.dumps(payload).encode("ascii") + b"\n")
+
+        responses = {}
+        while len(responses) < len(requests):
+            line = self._file.readline()
+            if not line:
+                raise ConnectionError("Electrum server closed the connection")
+            message = json.loads(line)
+            for response in (message if isinstance(message, list) else [message]):
+                if "id" not in response or response["id"] is None:
+                    # Notification of a subscription, e.g. blockchain.scripthash.subscribe
+                    if response.get("method") == "blockchain.scripthash.subscribe":
+                        notified_scripthash, status = response["params"]
+                        self.notified_statuses[notified_scripthash] = status
+                    continue
+                responses[response["id"]] = response
+
+        results = []
+        for request in requests:
+            response = responses[request["id"]]
+            assert response.get("error") is None, "{} failed: {}".format(request["method"], response["error"])
+            results.append(response["result"])
+        return results
+
+    def batch(self, calls: List[Tuple[str, list]]) -> list:
+        """
+        @calls: list of (method, params)
+        @return: result per call, in the same order. Sent in batches of batch_size calls per round trip.
+        """
+        results = []
+        with self._lock:
+            for i in range(0, len(calls), self._batch_size):
+                chunk = calls[i:i+self._batch_size]
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    results.extend(self._send_and_receive(chunk))
+                except (OSError, ValueError) as e:
+                    # Reconnect once, e.g. after the server dropped an idle connection.
+                    logging.debug("Reconnecting to Electrum server: {}".format(e))
+                    self._close()
+                    self._connect()
+                    results.extend(self._send_and_receive(chunk))
+        return results
+
+    def call(self, method: str, *params):
+        return self.batch([(method, list(params))])[0]
+
+    def has_notified_statuses(self, scripthashes) -> bool:
+        with self._lock:
+            return any(scripthash in scripthashes for scripthash in self.notified_statuses)
+
+    def take_notified_statuses(self, scripthashes) -> Dict[str, str]:
+        with self._lock:
+            taken = [scripthash for scripthash in self.notified_statuses if scripthash in scripthashes]
+            return {scripthash: self.notified_statuses.pop(scripthash) for scripthash in taken}
+
+gClient: ElectrumClient = None
+gClientLock = threading.Lock()
+
+def get_client() -> ElectrumClient:
+    global gClient
+    with gClientLock:
+        if gClient is None:
+            server = Config.ElectrumServer if Config.Network == NETWORK_MAINNET else Config.TestNetElectrumServer
+            host, port = server.rsplit(":", 1)
+            gClient = ElectrumClient(host, int(port), Config.ElectrumUseSSL, Config.ElectrumTimeout,
+                                     Config.ElectrumBatchSize)
+    return gClient
+
+def subscribe(addresses: List[CBitcoinAddress]) -> List[str]:
+    """
+    @return: status hash per address, None if the address has no history. The status changes whenever
+             a transaction of the address is added or confirmed.
+    """
+    return get_client().batch([("blockchain.scripthash.subscribe", [scripthash(address)]) for address in addresses])
+
+def take_notified_statuses(scripthashes) -> Dict[str, str]:
+    """
+    @scripthashes: container of the scripthashes to take, others are left for other wallets.
+    @return: scripthash -> latest status, for the subscribed addresses whose status changed since the
+             last call. Notifications are read along with the responses of other requests.
+    """
+    return get_client().take_notified_statuses(scripthashes)
+
+def has_notified_statuses(scripthashes) -> bool:
+    """
+    @return: True if take_notified_statuses(scripthashes) would return something, without taking it.
+    """
+    return get_client().has_notified_statuses(scripthashes)
+
+def histories(addresses: List[CBitcoinAddress]) -> List[List[dict]]:
+    """
+    @return: per address, [{"tx_hash": txid, "height": height}, ...] with confirmed transactions first in
+             block order, then mempool transactions with a height of 0 or -1.
+    """
+    return get_client().batch([("blockchain.scripthash.get_history", [scripthash(address)]) for address in addresses])
+
+def tip_hash() -> str:
+    """
+    @return: hash of the chain tip, hex in the usual reversed byte order.
+    """
+    header = get_client().call("blockchain.headers.subscribe")
+    return b2lx(hashlib.sha256(hashlib.sha256(binascii.unhexlify(header["hex"])).digest()).digest())
+
+def existaddresses(addresses: List[CBitcoinAddress]) -> List[bool]:
+    """
+    Same as esplora.existaddress for many addresses in one round trip.
+    """
+    used_list = []
+    for address, history in zip(addresses, histories(addresses)):
+        used = any(entry["height"] > 0 for entry in history)
+        esplora.gAddressUsageCache.put(str(address), used)
+        used_list.append(used)
+    return used_list
+
+def existaddress(address: CBitcoinAddress) -> bool:
+    return existaddresses([address])[0]
+
+def utxos(addresses: List[CBitcoinAddress]) -> Dict[str, Set["wallet.UnspentOutput"]]:
+    """
+    Same as esplora.utxos: confirmed unspent outputs per address.
+    """
+    results = get_client().batch(
+        [("blockchain.scripthash.listunspent", [scripthash(address)]) for address in addresses])
+    utxos_response = {}
+    for address, result in zip(addresses, results):
+        utxos_response[str(address)] = set(
+            wallet.UnspentOutput(elm["tx_hash"], elm["tx_pos"], elm["value"], address)
+            for elm in result if elm["height"] > 0)
+    return utxos_response
+
+def _address_of(script_pubkey) -> str:
+    try:
+        return str(CBitcoinAddress.from_scriptPubKey(script_pubkey))
+    except CBitcoinAddressError:
+        return None
+
+def _txout_json(txout: CTxOut) -> dict:
+    return {
+        "scriptpubkey": binascii.hexlify(txout.scriptPubKey).decode("ascii"),
+        "scriptpubkey_address": _address_of(txout.scriptPubKey),
+        "value": txout.nValue,
+    }
+
+def _raw_txs(txids: List[str]) -> Dict[str, CTransaction]:
+    results = get_client().batch([("blockchain.transaction.get", [txid]) for txid in txids])
+    return {txid: CTransaction.deserialize(binascii.unhexlify(raw)) for txid, raw in zip(txids, results)}
+
+def tx_gets(txids: List[str], heights: List[int]) -> List[dict]:
+    """
+    Transactions in the format of esplora.tx_get, with the prevout of each input. Two round trips:
+    one for the transactions and one for the transactions they spend from.
+    @heights: block height per transaction as in get_history, 0 or -1 if unconfirmed.
+    """
+    tx_jsons: Dict[str, dict] = {}
+    for txid in txids:
+        tx_json = esplora.gTransactionCache.get(txid)
+        if tx_json is not None:
+            tx_jsons[txid] = tx_json
+
+    missing = [(txid, height) for txid, height in zip(txids, heights) if txid not in tx_jsons]
+    txs = _raw_txs(list(set(txid for txid, _ in missing)))
+    parent_txids = set(b2lx(txin.prevout.hash) for tx in txs.values() for txin in tx.vin
+                       if not txin.prevout.is_null())
+    parents = _raw_txs(list(parent_txids))
+
+    for txid, height in missing:
+        tx = txs[txid]
+        vin = []
+        for txin in tx.vin:
+            if txin.prevout.is_null():
+                vin.append({"txid": b2lx(txin.prevout.hash), "vout": txin.prevout.n,
+                            "is_coinbase": True, "prevout": None})
+            else:
+                parent_txid = b2lx(txin.prevout.hash)
+                vin.append({"txid": parent_txid, "vout": txin.prevout.n, "is_coinbase": False,
+                            "prevout": _txout_json(parents[parent_txid].vout[txin.prevout.n])})
+        tx_json = {
+            "txid": txid,
+            "vin": vin,
+            "vout": [_txout_json(txout) for txout in tx.vout],
+            "status": {"confirmed": height > 0, "block_height": height} if height > 0 else {"confirmed": False},
+        }
+        esplora.gTransactionCache.put(tx_json)
+        tx_jsons[txid] = tx_json
+
+    return [tx_jsons[txid] for txid in txids]
+
+def send_tx(tx: CTransaction) -> str:
+    try:
+        txid = get_client().call("blockchain.transaction.broadcast",
+                                 binascii.hexlify(tx.serialize()).decode("ascii"))
+    except AssertionError as e:
+        logging.warning("Send transaction failed: {}".format(e))
+        return ""
+
+    assert lx(txid) == tx.GetTxid()
+    return txid
+
+def estimatefees(targets: List[int]) -> List[float]:
+    """
+    @return: fee rate in BTC/kB per confirmation target, None if the server doesn't have enough data.
+    """
+    results = get_client().batch([("blockchain.estimatefee", [target]) for target in targets])
+    return [btc_per_kbyte if btc_per_kbyte > 0 else None for btc_per_kbyte in results]
@@ -1,14 +1,21 @@
 import requests
 from requests import Response
+from requests.adapters import HTTPAdapter
 from bitcoin.wallet import CBitcoinAddress
 from bitcoin.core import CScript, CTxOut, CTransaction, lx
 from config import Config, NETWORK_MAINNET, NETWORK_TESTNET
 import binascii
 from wallet import UnspentOutput
+from addressusage import AddressUsageCache
+from txcache import TransactionCache
+from singleflight import SingleFlight
+from ratelimit import AdaptiveLimiter, backoff_delay, classify, parse_retry_after, \
+    OUTCOME_ERROR, RETRYABLE_STATUS_CODES
 import logging
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from typing import List, Set, Dict
+from typing import List, Set, Dict, Tuple
 import time
+import threading
 
 ENDPOINT_TESTNET = Config.TestNetExploraEndpoint
 ENDPOINT_MAINNET = Config.EsploraEndpoint
@@ -19,30 +26,95 @@ gThreadPoolExecutor: ThreadPoolExecutor = ThreadPoolExecutor(
 def getendpoint():
     return ENDPOINT_MAINNET if Config.Network == NETWORK_MAINNET else ENDPOINT_TESTNET
 
+# Keep-alive connections to Esplora, shared by all threads. urllib3's pool is thread-safe, but a
+# requests.Session is not documented to be, so each thread has its own session mounting this adapter.
+gHTTPAdapter = HTTPAdapter(pool_connections=2, pool_maxsize=Config.ThreadPoolMaxWorkers)
+gThreadLocal = threading.local()
+
+def get_session() -> requests.Session:
+    session = getattr(gThreadLocal, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.mount("http://", gHTTPAdapter)
+        session.mount("https://", gHTTPAdapter)
+        gThreadLocal.session = session
+    return session
+
+def http_timeout():
+    return (Config.EsploraConnectTimeout, Config.EsploraReadTimeout)
+
+# Shared with aioesplora, so that both clients back off together.
+gLimiter = AdaptiveLimiter(Config.EsploraMinConcurrency, Config.EsploraInitialConcurrency,
+                           Config.EsploraMaxConcurrency, Config.EsploraRequestsPerSecond,
+                           Config.EsploraLatencyTolerance)
+
+def retry_delay(attempt: int, retry_after: str = None) -> float:
+    """
+    @return: seconds to wait before retry number attempt (0 based), or None if out of retries.
+    """
+    if attempt >= Config.EsploraMaxRetries:
+        return None
+    return backoff_delay(attempt, Config.EsploraRetryBaseDelay, Config.EsploraRetryMaxDelay,
+                         parse_retry_after(retry_after))
+
+# Identical requests in flight at the same time share one response. Threads share with threads and
+# aioesplora with aioesplora, not with each other: one gets a Response, the other the parsed JSON.
+gSingleFlight = SingleFlight()
+
 def http_get(url, retry_on_5xx=True) -> Response:
-   response = requests.get(url)
-   if response.status_code >= 500:
-      logging.debug("Retrying " + url)
+    """
+    GET with adaptive concurrency and rate limiting. 429, 5xx and failed requests, e.g. a connection
+    error, a timeout or a body cut off by an overloaded server, are retried with backoff unless
+    retry_on_5xx is False. Concurrent calls for the same URL share one request.
+    """
+    return gSingleFlight.do((url, retry_on_5xx), lambda: _http_get(url, retry_on_5xx))
+
+def _http_get(url, retry_on_5xx) -> Response:
+    attempt = 0
+    while True:
+        gLimiter.acquire()
+        start_time = time.time()
+        try:
+            response = get_session().get(url, timeout=http_timeout())
+        except requests.RequestException as e:
+            gLimiter.release(OUTCOME_ERROR, time.time() - start_time)
+            delay = retry_delay(attempt) if retry_on_5xx else None
+            if delay is None:
+                raise
+            logging.debug("Retrying {} in {:.2f}s: {}".format(url, delay, e))
+        except BaseException:
+            gLimiter.release(OUTCOME_ERROR, time.time() - start_time)
+            raise
+        else:
+            gLimiter.release(classify(response.status_code), time.time() - start_time)
+            if not retry_on_5xx or response.status_code not in RETRYABLE_STATUS_CODES:
+                return response
+            delay = retry_delay(attempt, response.headers.get("Retry-After"))
+            if delay is None:
+                return response
+            logging.debug("Retrying {} in {:.2f}s: HTTP {}".format(url, delay, response.status_code))
+
+        time.sleep(delay)
+        attempt += 1
 
-      # Try again.
-      sleep(0.5)
-      response = requests.get(url)
-   return response
+gAddressUsageCache = AddressUsageCache(
+    Config.AddressUsageCacheMaxEntries, Config.AddressUsageNegativeTTL)
+
+gTransactionCache = TransactionCache(Config.TransactionCacheMaxEntries)
 
-gExistedAddresses = set()
 def existaddress(bitcoinaddr: CBitcoinAddress) -> bool:
-    if str(bitcoinaddr) in gExistedAddresses:
-        return True
+    used = gAddressUsageCache.get(str(bitcoinaddr))
+    if used is not None:
+        return used
+
     response = http_get(
         "%saddress/%s" % (getendpoint(), str(bitcoinaddr)))
     assert response.status_code == 200, ("HTTP Error: %s" % (response.text,))
 
     json = response.json()
-    if json["chain_stats"]["tx_count"] != 0:
-        gExistedAddresses.add(str(bitcoinaddr))
-        return True
-
-    return False
+    used = json["chain_stats"]["tx_count"] != 0
+    gAddressUsageCache.put(str(bitcoinaddr), used)
+    return used
 
 class AddressResponse:
     def __init__(self, balance, address):
@@ -106,12 +178,7 @@ def utxos(addresses: List[CBitcoinAddress]) -> Dict[str, Set[UnspentOutput]]:
     return utxos_response
 
 def txout(utxo: UnspentOutput) -> CTxOut:
-    tx_url = "{endpoint}tx/{txid}"
-    tx_response = http_get(tx_url.format(
-        endpoint=getendpoint(), txid=utxo.txid))
-    assert tx_response.status_code == 200, "Failed to get transaction of ID " + utxo.txid
-
-    tx_json = tx_response.json()
+    tx_json = tx_get(utxo.txid)
     assert utxo.vout < len(tx_json["vout"]), "utxo vout is out of the bound (txid={}, vout={})".format(utxo.txid,  utxo.vout)    
     txout_json = tx_json["vout"][utxo.vout]
     b = binascii.unhexlify(txout_json["scriptpubkey"])
@@ -133,15 +200,22 @@ def txouts(utxos: List[UnspentOutput]) -> List[CTxOut]:
     return txouts
 
 def tx_get(txid: str):
+    tx_json = gTransactionCache.get(txid)
+    if tx_json is not None:
+        return tx_json
+
     tx_url = "{}tx/{}".format(getendpoint(), txid)
     response = http_get(tx_url)
-    return response.json()
+    assert response.status_code == 200, "Failed to get transaction of ID " + txid
+    tx_json = response.json()
+    gTransactionCache.put(tx_json)
+    return tx_json
 
 def send_tx(tx: CTransaction) -> str:
     # POST /tx
     tx_url = "{endpoint}tx"
-    response = requests.post(tx_url.format(
-        endpoint=getendpoint()), data=binascii.hexlify(tx.serialize()).decode("ascii"))
+    response = get_session().post(tx_url.format(
+        endpoint=getendpoint()), data=binascii.hexlify(tx.serialize()).decode("ascii"), timeout=http_timeout())
     if response.status_code != 200:
         logging.warn("Send transaction failed: " + response.text)
         return ""
@@ -164,16 +238,53 @@ def fee_estimates():
     fee_estimates_url = "{endpoint}fee-estimates"
     response = http_get(fee_estimates_url.format(
         endpoint=getendpoint()))
+    assert response.status_code == 200, "Failed to get fee estimates"
+    return response.json()
+
+def tip_hash(retry_on_5xx=True) -> str:
+    response = http_get("{}blocks/tip/hash".format(getendpoint()), retry_on_5xx)
+    assert response.status_code == 200, "Failed to get the chain tip"
+    return response.text
+
+def mempool_info(retry_on_5xx=True) -> dict:
+    """
+    @return: for example { "count": 8134, "vsize": 3444604, "total_fee": 29204625, "fee_histogram": [...] }
+    """
+    response = http_get("{}mempool".format(getendpoint()), retry_on_5xx)
+    assert response.status_code == 200, "Failed to get mempool info"
     return response.json()
 
-def address_txs(address: CBitcoinAddress, synced_txid):
+def address_stats(address: str) -> dict:
+    """
+    @return: GET /address/:address, e.g. { "address": ..., "chain_stats": { "funded_txo_count": 1,
+             "funded_txo_sum": 5000, "spent_txo_count": 0, "spent_txo_sum": 0, "tx_count": 1 }, "mempool_stats": {...} }
+    """
+    response = http_get("{}address/{}".format(getendpoint(), address))
+    assert response.status_code == 200, "Failed to get address"
+    stats_json = response.json()
+    gAddressUsageCache.put(address, stats_json["chain_stats"]["tx_count"] != 0)
+    return stats_json
+
+def address_fingerprint(stats_json: dict) -> Tuple:
+    """
+    Changes whenever a transaction of the address is added, confirmed or dropped from the mempool, so
+    the transactions of the address don't need to be fetched while it stays the same.
+    @stats_json: as returned by address_stats
+    """
+    return tuple((stats[key] for stats in (stats_json["chain_stats"], stats_json["mempool_stats"])
+                  for key in ("tx_count", "funded_txo_sum", "spent_txo_sum")))
+
+def address_txs(address: str, synced_txid):
     if synced_txid is None:
-        address_txs_url = "{}address/{}/txs".format(getendpoint(), str(address))
+        address_txs_url = "{}address/{}/txs".format(getendpoint(), address)
     else:
         address_txs_url = "{}address/{}/txs/chain/{}".format(
-            getendpoint(), str(address), synced_txid)
+            getendpoint(), address, synced_txid)
     response = http_get(address_txs_url)
-    return response.json()
+    address_txs_json = response.json()
+    for tx_json in address_txs_json:
+        gTransactionCache.put(tx_json)
+    return address_txs_json
 
 # def tx(txid) -> CTransaction:
 #     '''
@@ -0,0 +1,159 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List
+from config import Config, BACKEND_FULLNODE, BACKEND_ELECTRUM
+import esplora
+import fullnode
+import electrum
+
+'''
+One process-wide source of fee rates. A background thread refreshes them every FeeEstimateTTL seconds,
+and readers get the latest value without waiting on the network, even when it is stale. Until the first
+refresh succeeds, reads raise FeeRatesUnavailable. A failed refresh is tried again after
+FeeEstimateRetryDelay seconds, doubling up to FeeEstimateTTL.
+'''
+
+# Confirmation targets asked of backends that estimate one target at a time, a subset of the ones
+# Esplora returns.
+CONFIRMATION_TARGETS = [1, 2, 3, 6, 12, 24, 144, 504, 1008]
+
+def esplora_fee_estimates() -> Dict[str, float]:
+    return esplora.fee_estimates()
+
+def fullnode_fee_estimates() -> Dict[str, float]:
+    """
+    Same format as esplora.fee_estimates, from the full node's estimatesmartfee.
+    """
+    estimates = {}
+    for target, btc_per_kvbyte in zip(CONFIRMATION_TARGETS, fullnode.estimatesmartfees(CONFIRMATION_TARGETS)):
+        if btc_per_kvbyte is not None:
+            # BTC/kvB -> sat/vB
+            estimates[str(target)] = btc_per_kvbyte * 100000000 / 1000
+    assert len(estimates) > 0, "estimatesmartfee has no estimates"
+    return estimates
+
+def electrum_fee_estimates() -> Dict[str, float]:
+    """
+    Same format as esplora.fee_estimates, from blockchain.estimatefee on the Electrum server.
+    """
+    estimates = {}
+    for target, btc_per_kbyte in zip(CONFIRMATION_TARGETS, electrum.estimatefees(CONFIRMATION_TARGETS)):
+        if btc_per_kbyte is not None:
+            # BTC/kB -> sat/vB
+            estimates[str(target)] = btc_per_kbyte * 100000000 / 1000
+    assert len(estimates) > 0, "blockchain.estimatefee has no estimates"
+    return estimates
+
+def fill_missing_targets(estimates: Dict[str, float]) -> Dict[str, float]:
+    """
+    Backends may have no estimate for some targets, e.g. estimatesmartfee without enough data. Each of
+    CONFIRMATION_TARGETS that is missing gets the estimate of the nearest target that has one, the lower
+    one on a tie since it pays more.
+    @return: None if estimates has none of CONFIRMATION_TARGETS.
+    """
+    available = [target for target in CONFIRMATION_TARGETS if str(target) in estimates]
+    if len(available) == 0:
+        return None
+    filled = dict(estimates)
+    for target in CONFIRMATION_TARGETS:
+        if str(target) not in filled:
+            nearest = min(available, key=lambda available_target: (abs(available_target - target), available_target))
+            filled[str(target)] = estimates[str(nearest)]
+    return filled
+
+class FeeRatesUnavailable(Exception):
+    '''
+    No refresh has succeeded yet.
+    '''
+
+class FeeRateProvider:
+    def __init__(self, sources: List[Callable[[], Dict[str, float]]], ttl: float, retry_delay: float):
+        """
+        @sources: functions returning fee rates in the format of esplora.fee_estimates, tried in order
+                  until one succeeds.
+        @ttl: seconds between refreshes. A read of an older value wakes the refresh thread up.
+        @retry_delay: seconds before the first retry after all sources failed.
+        """
+        self._sources = sources
+        self._ttl = ttl
+        self._retry_delay = retry_delay
+
+        self._estimates: Dict[str, float] = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+        self._wake = threading.Event()
+
+        self.refresh_count = 0
+
+    def _refresh(self) -> bool:
+        """
+        @return: False if all sources failed, the last good estimates are kept then.
+        """
+        for source in self._sources:
+            try:
+                estimates = fill_missing_targets(source())
+            except Exception as e:
+                logging.warning("Failed to get fee estimates from {}: {}".format(source.__name__, e))
+                continue
+            if estimates is None:
+                logging.warning("No fee estimates for {} from {}".format(CONFIRMATION_TARGETS, source.__name__))
+                continue
+
+            with self._lock:
+                self._estimates = estimates
+                self._fetched_at = time.time()
+                self.refresh_count += 1
+            return True
+        return False
+
+    def _run(self):
+        failures = 0
+        while True:
+            start = time.time()
+            if self._refresh():
+                failures = 0
+                delay = self._ttl
+            else:
+                delay = min(self._retry_delay * 2 ** failures, self._ttl)
+                failures += 1
+            logging.debug("Refreshing fee estimates took {} ms.".format(int((time.time() - start)*1000)))
+
+            self._wake.wait(delay)
+            self._wake.clear()
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="feerates", daemon=True)
+                self._thread.start()
+
+    def get(self) -> Dict[str, float]:
+        """
+        Never waits on the network. start() must have been called.
+        @return: the latest fee rates, for example { "1": 87.882, "2": 87.882, ..., "144": 1.027 }
+        @raise FeeRatesUnavailable: before the first successful refresh.
+        """
+        with self._lock:
+            estimates = self._estimates
+            age = time.time() - self._fetched_at
+
+        if age > self._ttl:
+            # The last refresh failed or is late: serve the last good value and try again now.
+            self._wake.set()
+        if estimates is None:
+            raise FeeRatesUnavailable("Fee estimates are not available yet")
+        return estimates
+
+def default_sources() -> List[Callable[[], Dict[str, float]]]:
+    sources = [esplora_fee_estimates]
+    if Config.FeeEstimateFullNodeFallback:
+        sources.append(fullnode_fee_estimates)
+    if Config.ChainBackend == BACKEND_FULLNODE:
+        sources.reverse()
+    elif Config.ChainBackend == BACKEND_ELECTRUM:
+        sources.insert(0, electrum_fee_estimates)
+    return sources
+
+gFeeRateProvider = FeeRateProvider(default_sources(), Config.FeeEstimateTTL, Config.FeeEstimateRetryDelay)
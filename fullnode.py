@@ -1,46 +1,208 @@
 import requests
+from requests.adapters import HTTPAdapter
 import binascii
-import struct
+import itertools
+import threading
+import urllib.parse
+from typing import List, Tuple
 from config import Config, NETWORK_MAINNET, NETWORK_TESTNET
 
-def make_request(payload):
-    full_node_config = None
+'''
+JSON-RPC client of a Bitcoin Core node. Connections are kept alive and shared by all threads, and
+many calls can be sent in one POST with batch().
+'''
+
+# Error codes of wallet RPCs.
+RPC_WALLET_NOT_FOUND = -18
+RPC_WALLET_ALREADY_LOADED = -35
+
+class RPCError(Exception):
+    '''
+    Error returned by the node for a call, e.g. code -5 for a transaction that is not found.
+    Reference: https://github.com/bitcoin/bitcoin/blob/master/src/rpc/protocol.h
+    '''
+    def __init__(self, method: str, code: int, message: str):
+        super().__init__("{} failed: {} (code {})".format(method, message, code))
+        self.method = method
+        self.code = code
+        self.message = message
+
+def get_full_node_config():
     if Config.Network == NETWORK_TESTNET:
         assert Config.TestNetFullNodeConfig is not None, "Missing TestNetFullNodeConfig"
-        full_node_config = Config.TestNetFullNodeConfig
+        return Config.TestNetFullNodeConfig
     elif Config.Network == NETWORK_MAINNET:
         assert Config.FullNodeConfig is not None, "Missing FullNodeConfig"
-        full_node_config = Config.FullNodeConfig
+        return Config.FullNodeConfig
     else:
         raise "Unknown network type: {}".format(Config.Network)
 
+# Same as esplora: urllib3's pool is shared, each thread has its own session mounting it.
+gHTTPAdapter = HTTPAdapter(pool_connections=1, pool_maxsize=Config.ThreadPoolMaxWorkers)
+gThreadLocal = threading.local()
+
+def get_session() -> requests.Session:
+    session = getattr(gThreadLocal, "session", None)
+    if session is None:
+        session = requests.Session()
+        session.mount("http://", gHTTPAdapter)
+        gThreadLocal.session = session
+    return session
+
+# next() on itertools.count is atomic, so ids are unique across threads.
+gRequestIds = itertools.count(1)
+
+def make_request(payload, wallet: str = None):
+    """
+    POST a JSON-RPC request, or a list of them, and return the decoded response.
+    @wallet: name of the node wallet that wallet RPCs are for.
+    """
+    full_node_config = get_full_node_config()
     jsonrpc_server = "http://{}:{}".format(
         full_node_config.host, full_node_config.port)
-    user = full_node_config.user
-    password = full_node_config.password
-    
-    response = requests.post(jsonrpc_server, json=payload, auth=(
-        user, password)).json()
-
-    return response
+    if wallet is not None:
+        jsonrpc_server += "/wallet/" + urllib.parse.quote(wallet)
 
+    response = get_session().post(jsonrpc_server, json=payload, auth=(
+        full_node_config.user, full_node_config.password), timeout=Config.FullNodeTimeout)
+    # Errors of single calls come back with HTTP 404 or 500 and the error in the body.
+    if response.status_code in (401, 403):
+        raise RPCError(payload["method"] if isinstance(payload, dict) else "batch",
+                       response.status_code, "Unauthorized, check user and password in the config")
+    return response.json()
 
-gFullnode_sendrawtransactionId = 0
-def sendrawtransaction(rawtx: bytes) -> str:
+def batch(calls: List[Tuple[str, list]], wallet: str = None) -> list:
     """
-    @return: hex-encoded txid.
+    @calls: list of (method, params), sent in one POST.
+    @wallet: same as in make_request.
+    @return: result per call, in the same order.
+    @raise RPCError: for the first call that failed.
     """
-    # FIXME: Not thread safe though
-    global gFullnode_sendrawtransactionId
-    gFullnode_sendrawtransactionId += 1
+    if len(calls) == 0:
+        return []
+    payload = [{
+        'method': method,
+        'params': params,
+        'jsonrpc': '1.0',
+        'id': next(gRequestIds)
+    } for method, params in calls]
+    responses = {response['id']: response for response in make_request(payload, wallet)}
 
+    results = []
+    for request in payload:
+        response = responses[request['id']]
+        if response['error'] is not None:
+            raise RPCError(request['method'], response['error']['code'], response['error']['message'])
+        results.append(response['result'])
+    return results
+
+def call(method: str, *params, wallet: str = None):
     payload = {
-        'method': "sendrawtransaction",
-        'params': [binascii.hexlify(rawtx).decode("ascii")],
+        'method': method,
+        'params': list(params),
         'jsonrpc': '1.0',
-        'id': gFullnode_sendrawtransactionId
+        'id': next(gRequestIds)
     }
-    response = make_request(payload)
-    assert response['error'] == None, "sendrawtransaction failed: {}".format(response['error'])
+    response = make_request(payload, wallet)
+    if response['error'] is not None:
+        raise RPCError(method, response['error']['code'], response['error']['message'])
     return response['result']
 
+def sendrawtransaction(rawtx: bytes) -> str:
+    """
+    @return: hex-encoded txid.
+    """
+    return call("sendrawtransaction", binascii.hexlify(rawtx).decode("ascii"))
+
+def load_watch_only_wallet(wallet: str):
+    """
+    Load the descriptor wallet named wallet on the node, and create it without private keys if it doesn't
+    exist yet. The node loads it again on startup.
+    """
+    try:
+        call("loadwallet", wallet, True)
+    except RPCError as e:
+        if e.code == RPC_WALLET_ALREADY_LOADED:
+            return
+        if e.code != RPC_WALLET_NOT_FOUND:
+            raise
+        # disable_private_keys, blank, passphrase, avoid_reuse, descriptors, load_on_startup
+        call("createwallet", wallet, True, True, "", False, True, True)
+
+def listdescriptors(wallet: str) -> List[dict]:
+    return call("listdescriptors", wallet=wallet)['descriptors']
+
+def importdescriptors(wallet: str, requests: List[dict]):
+    """
+    Import descriptors into a wallet. Returns once the node has rescanned the chain from the earliest
+    timestamp of the requests, which can take long.
+    @requests: for example [{"desc": "wpkh(xpub.../0/*)", "range": [0, 999], "timestamp": 0}], without
+               checksums, which are added here.
+    @raise RPCError: for the first descriptor that failed to import.
+    """
+    infos = batch([("getdescriptorinfo", [request['desc']]) for request in requests])
+    requests = [dict(request, desc="{}#{}".format(request['desc'], info['checksum']))
+                for request, info in zip(requests, infos)]
+    for result in call("importdescriptors", requests, wallet=wallet):
+        if not result['success']:
+            raise RPCError("importdescriptors", result['error']['code'], result['error']['message'])
+
+def listtransactions(wallet: str, page_size: int = 1000) -> List[dict]:
+    """
+    @return: all transaction entries of a wallet, those in the mempool included, oldest first. Outputs
+             paid to the wallet have category "receive" and the address they pay.
+    """
+    transactions: List[dict] = []
+    while True:
+        # label, count, skip, include_watchonly. Pages are counted from the newest entry.
+        page = call("listtransactions", "*", page_size, len(transactions), True, wallet=wallet)
+        transactions = page + transactions
+        if len(page) < page_size:
+            return transactions
+
+def listunspent(wallet: str, minconf: int = 1) -> List[dict]:
+    return call("listunspent", minconf, wallet=wallet)
+
+def getaddressinfos(wallet: str, addresses: List[str]) -> List[dict]:
+    return batch([("getaddressinfo", [address]) for address in addresses], wallet)
+
+def gettransactions(wallet: str, txids: List[str]) -> List[dict]:
+    """
+    @return: per txid, gettransaction of the wallet, with "hex" the serialized transaction.
+    """
+    # txid, include_watchonly
+    return batch([("gettransaction", [txid, True]) for txid in txids], wallet)
+
+def estimatesmartfees(conf_targets: List[int]) -> List[float]:
+    """
+    @return: estimated fee rate in BTC/kvB per confirmation target, or None where the node doesn't
+             have enough data.
+    """
+    results = batch([("estimatesmartfee", [conf_target]) for conf_target in conf_targets])
+    return [result.get('feerate') for result in results]
+
+def estimatesmartfee(conf_target: int) -> float:
+    return estimatesmartfees([conf_target])[0]
+
+def getrawtransactions(txids: List[str], verbose: bool = False) -> list:
+    """
+    @return: per txid, the hex-encoded transaction, or the decoded transaction if verbose.
+             Transactions that are not in the mempool need -txindex on the node.
+    """
+    return batch([("getrawtransaction", [txid, verbose]) for txid in txids])
+
+def getrawtransaction(txid: str, verbose: bool = False):
+    return getrawtransactions([txid], verbose)[0]
+
+def gettxouts(outpoints: List[Tuple[str, int]], include_mempool: bool = True) -> List[dict]:
+    """
+    @outpoints: list of (txid, vout)
+    @return: per outpoint, the unspent output, or None if it is spent or doesn't exist.
+    """
+    return batch([("gettxout", [txid, vout, include_mempool]) for txid, vout in outpoints])
+
+def getbestblockhash() -> str:
+    return call("getbestblockhash")
+
+def getmempoolinfo() -> dict:
+    return call("getmempoolinfo")
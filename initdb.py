@@ -1,13 +1,21 @@
 import sqlite3
 import os
+import walletcache
+import addressusage
+import txcache
+import walletstate
 
 SQLITE_DB_FILE = os.path.dirname(
     os.path.realpath(__file__)) + "/data/wallets.db"
 
 if __name__ == '__main__':
-    if not os.path.exists(SQLITE_DB_FILE):
-        with sqlite3.connect(SQLITE_DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "CREATE TABLE Wallets (id INTEGER PRIMARY KEY, network TEXT NOT NULL, mnemonic TEXT NOT NULL, label TEXT)")
-            conn.commit()
+    # Safe to run again on an existing database to add tables introduced since it was created.
+    with sqlite3.connect(SQLITE_DB_FILE) as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS Wallets (id INTEGER PRIMARY KEY, network TEXT NOT NULL, mnemonic TEXT NOT NULL, label TEXT)")
+        walletcache.create_tables(cursor)
+        addressusage.create_tables(cursor)
+        txcache.create_tables(cursor)
+        walletstate.create_tables(cursor)
+        conn.commit()
@@ -0,0 +1,182 @@
+import asyncio
+import math
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import List
+
+'''
+Client side flow control for an upstream HTTP service. The number of requests in flight follows AIMD:
+it grows by about one per round trip while responses are fast, stops growing while they are much slower
+than the fastest recent one, and is cut multiplicatively on 429/503, other 5xx and connection errors. A token bucket caps
+the request rate on top of that. Both the threaded and the asyncio clients share the same limiter.
+'''
+
+OUTCOME_OK = "ok"
+# 429 Too Many Requests or 503 Service Unavailable.
+OUTCOME_OVERLOADED = "overloaded"
+# Any other 5xx, or a request that failed, e.g. on a timeout, a connection error or a truncated body.
+OUTCOME_ERROR = "error"
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+def classify(status_code: int) -> str:
+    if status_code in (429, 503):
+        return OUTCOME_OVERLOADED
+    if status_code >= 500:
+        return OUTCOME_ERROR
+    return OUTCOME_OK
+
+def parse_retry_after(value: str) -> float:
+    """
+    @value: Retry-After header, either seconds or an HTTP date.
+    @return: seconds to wait, or None if absent or unparsable.
+    """
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, retry_after: float = None) -> float:
+    """
+    Exponential backoff with full jitter. A Retry-After from the server is honored as a lower bound.
+    @attempt: 0 for the first retry.
+    """
+    delay = random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, max_delay))
+    return delay
+
+class AdaptiveLimiter:
+    def __init__(self, min_limit: int, initial_limit: int, max_limit: int,
+                 requests_per_second: float = 0, latency_tolerance: float = 4):
+        """
+        @requests_per_second: 0 for no rate limit.
+        @latency_tolerance: while the smoothed latency is above this multiple of the fastest recent
+                            response, the limit does not grow.
+        """
+        self._min_limit = min_limit
+        self._max_limit = max_limit
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+
+        self._rate = requests_per_second
+        self._tokens = float(max(1, requests_per_second))
+        self._last_refill = time.monotonic()
+
+        self._latency_tolerance = latency_tolerance
+        self._min_latency: float = None
+        self._smoothed_latency: float = None
+        self._last_decrease = 0.0
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # (event loop, future) of coroutines waiting in acquire_async.
+        self._async_waiters: List[tuple] = []
+
+        self.throttled_count = 0
+        self.error_count = 0
+
+    @property
+    def limit(self) -> int:
+        return int(self._limit)
+
+    def _try_acquire_locked(self) -> float:
+        """
+        @return: 0 if acquired, otherwise seconds to wait before trying again (inf until a release).
+        """
+        if self._in_flight >= int(self._limit):
+            return math.inf
+
+        if self._rate > 0:
+            now = time.monotonic()
+            self._tokens = min(max(1.0, self._rate), self._tokens + (now - self._last_refill) * self._rate)
+            self._last_refill = now
+            if self._tokens < 1:
+                return (1 - self._tokens) / self._rate
+            self._tokens -= 1
+
+        self._in_flight += 1
+        return 0
+
+    def acquire(self):
+        with self._cond:
+            while True:
+                wait = self._try_acquire_locked()
+                if wait == 0:
+                    return
+                self._cond.wait(None if wait == math.inf else wait)
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                wait = self._try_acquire_locked()
+                if wait == 0:
+                    return
+                if wait == math.inf:
+                    future = loop.create_future()
+                    self._async_waiters.append((loop, future))
+            if wait == math.inf:
+                await future
+            else:
+                await asyncio.sleep(wait)
+
+    def release(self, outcome: str, latency: float):
+        with self._cond:
+            self._in_flight -= 1
+            now = time.monotonic()
+
+            if outcome == OUTCOME_OK:
+                if self._min_latency is None:
+                    self._min_latency = self._smoothed_latency = latency
+                else:
+                    self._smoothed_latency += (latency - self._smoothed_latency) * 0.1
+                    if latency < self._min_latency:
+                        self._min_latency = latency
+                    else:
+                        # Let the baseline follow the service if it gets slower for good.
+                        self._min_latency += (latency - self._min_latency) * 0.01
+
+            decrease = None
+            if outcome == OUTCOME_OVERLOADED:
+                self.throttled_count += 1
+                decrease = 0.5
+            elif outcome == OUTCOME_ERROR:
+                self.error_count += 1
+                decrease = 0.75
+
+            if decrease is not None:
+                # Decrease at most once per round trip, since the requests in flight when the service got
+                # overloaded all report the same event.
+                if now - self._last_decrease > (self._smoothed_latency or 0.1):
+                    self._limit = max(float(self._min_limit), self._limit * decrease)
+                    self._last_decrease = now
+            elif self._smoothed_latency <= self._min_latency * self._latency_tolerance:
+                # Latency well above the baseline means requests queue up at the service: stop growing.
+                self._limit = min(float(self._max_limit), self._limit + 1 / self._limit)
+
+            self._cond.notify_all()
+            waiters = self._async_waiters
+            self._async_waiters = []
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(lambda future=future: future.done() or future.set_result(None))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "limit": int(self._limit),
+                "in_flight": self._in_flight,
+                "min_latency_ms": None if self._min_latency is None else int(self._min_latency * 1000),
+                "smoothed_latency_ms": None if self._smoothed_latency is None else int(self._smoothed_latency * 1000),
+                "throttled": self.throttled_count,
+                "errors": self.error_count,
+            }
@@ -11,6 +11,7 @@ import bitcoin
 import os
 import auth
 import binascii
+import feerates
 
 app = Flask(__name__)
 if app.env == 'development':
@@ -25,6 +26,9 @@ else:
     logging.debug("Selecting testnet")
     bitcoin.SelectParams("testnet")
 
+# Fee estimates are refreshed in the background from startup, so that requests never wait for them.
+feerates.gFeeRateProvider.start()
+
 # global variable to all templates
 if Config.Network == NETWORK_MAINNET:
     app.jinja_env.globals['g_network_type'] = "Main Net"
@@ -128,8 +132,18 @@ def api_newaddress(wallet_id):
 @app.route('/api/v1/wallet/<wallet_id>/request_sync', methods=['POST'])
 @auth.login_required
 def api_request_sync_wallet(wallet_id):
-    utils.request_sync(int(wallet_id))
-    return  jsonify({}), 200
+    # ?wait=1 to return once the sync ran, instead of right away. synced is then false if it timed out, or
+    # if the sync was skipped because nothing may have changed since the last one.
+    wait = request.args.get('wait', default=0, type=int) == 1
+    synced = utils.request_sync(int(wallet_id), wait)
+    return  jsonify({"synced": synced}), 200
+
+@app.route('/api/v1/wallet/<wallet_id>/rescan', methods=['POST'])
+@auth.login_required
+def api_rescan_wallet(wallet_id):
+    wait = request.args.get('wait', default=0, type=int) == 1
+    done = utils.rescan_wallet(int(wallet_id), wait)
+    return  jsonify({"done": done}), 200
 
 @app.route('/api/v1/wallet/<wallet_id>/send', methods=['POST'])
 @auth.login_required
@@ -159,6 +173,9 @@ def api_fee_estimates(wallet_id):
     for utxo in req["utxos"]:
         utxos.append((utxo["txid"], int(utxo["vout"])))
 
-    fee_per_target = utils.fee_estimates(
-        int(wallet_id), utxos, req["destination"])
+    try:
+        fee_per_target = utils.fee_estimates(
+            int(wallet_id), utxos, req["destination"])
+    except feerates.FeeRatesUnavailable as e:
+        return jsonify({"error": str(e)}), 503
     return jsonify({"fee_per_target": fee_per_target}), 200
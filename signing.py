@@ -0,0 +1,95 @@
+from bitcoin.core import Hash, CTransaction
+from bitcoin.core.script import CScript, SIGHASH_ALL
+from bitcoin.core.serialize import BytesSerializer
+from bitcoin.wallet import CKey
+from concurrent.futures import Executor
+from typing import List, Dict, Tuple, Callable, Hashable
+import struct
+import math
+import io
+
+'''
+Signing of P2WPKH inputs. The module only depends on python-bitcoinlib so that it is cheap to
+import in each worker of the process pool.
+'''
+
+class Bip143Midstate:
+    '''
+    hashPrevouts, hashSequence and hashOutputs of the BIP 143 transaction digest are the same
+    for every input signed with SIGHASH_ALL, so they are computed once per transaction.
+    Reference: https://github.com/bitcoin/bips/blob/master/bip-0143.mediawiki
+    '''
+    def __init__(self, tx: CTransaction):
+        self._tx = tx
+        self.hash_prevouts = Hash(b"".join(txin.prevout.serialize() for txin in tx.vin))
+        self.hash_sequence = Hash(b"".join(struct.pack("<I", txin.nSequence) for txin in tx.vin))
+        self.hash_outputs = Hash(b"".join(txout.serialize() for txout in tx.vout))
+
+    def sighash(self, txin_index: int, script_code: CScript, amount: int) -> bytes:
+        '''
+        Same as SignatureHash(script_code, tx, txin_index, SIGHASH_ALL, amount, SIGVERSION_WITNESS_V0).
+        '''
+        txin = self._tx.vin[txin_index]
+        f = io.BytesIO()
+        f.write(struct.pack("<i", self._tx.nVersion))
+        f.write(self.hash_prevouts)
+        f.write(self.hash_sequence)
+        txin.prevout.stream_serialize(f)
+        BytesSerializer.stream_serialize(script_code, f)
+        f.write(struct.pack("<q", amount))
+        f.write(struct.pack("<I", txin.nSequence))
+        f.write(self.hash_outputs)
+        f.write(struct.pack("<i", self._tx.nLockTime))
+        f.write(struct.pack("<i", SIGHASH_ALL))
+        return Hash(f.getvalue())
+
+def sign_digests(privkeys: List[bytes], sighashes: List[bytes]) -> List[bytes]:
+    '''
+    Runs in a worker process when signing in parallel.
+    @return: DER signatures with SIGHASH_ALL appended, in the order of sighashes.
+    '''
+    seckeys: Dict[bytes, CKey] = {}
+    signatures = []
+    for privkey, sighash in zip(privkeys, sighashes):
+        seckey = seckeys.get(privkey)
+        if seckey is None:
+            seckey = CKey(privkey)
+            seckeys[privkey] = seckey
+        signatures.append(seckey.sign(sighash) + bytes([SIGHASH_ALL]))
+    return signatures
+
+def sign_p2wpkh_inputs(tx: CTransaction, inputs: List[Tuple[CScript, int, Hashable]],
+                       find_privkey: Callable[[Hashable], bytes],
+                       executor: Executor = None, chunk_count: int = 1) -> List[List[bytes]]:
+    '''
+    @inputs: (scriptCode, amount, key id) per input of tx. Inputs with the same key id share a key.
+    @find_privkey: returns the private key of a key id. It is called once per distinct key id.
+    @executor: if given, signing is split into chunk_count tasks submitted to it.
+    @return: witness stack [signature, pubkey] per input.
+    '''
+    midstate = Bip143Midstate(tx)
+
+    privkeys: Dict[Hashable, bytes] = {}
+    pubkeys: Dict[Hashable, bytes] = {}
+    for _, _, key_id in inputs:
+        if key_id not in privkeys:
+            privkey = find_privkey(key_id)
+            assert privkey is not None, "Can't find privkey associated with {}".format(key_id)
+            privkeys[key_id] = privkey
+            pubkeys[key_id] = CKey(privkey).pub
+
+    input_privkeys = [privkeys[key_id] for _, _, key_id in inputs]
+    sighashes = [midstate.sighash(txin_index, script_code, amount)
+                 for txin_index, (script_code, amount, _) in enumerate(inputs)]
+
+    if executor is None or chunk_count <= 1:
+        signatures = sign_digests(input_privkeys, sighashes)
+    else:
+        chunk_size = math.ceil(len(inputs) / chunk_count)
+        futures = [executor.submit(sign_digests, input_privkeys[i:i+chunk_size], sighashes[i:i+chunk_size])
+                   for i in range(0, len(inputs), chunk_size)]
+        signatures = []
+        for future in futures:
+            signatures.extend(future.result())
+
+    return [[signature, pubkeys[key_id]] for signature, (_, _, key_id) in zip(signatures, inputs)]
@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from typing import Awaitable, Callable, Dict, Hashable
+
+'''
+Coalesces identical calls that are in flight at the same time: the first caller for a key runs the
+call, and callers arriving before it finishes wait for and share its result (or exception). Nothing
+is remembered once the call finishes, so a result is never older than the call it came from.
+'''
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: BaseException = None
+
+class SingleFlight:
+    def __init__(self):
+        self._calls: Dict[Hashable, _Call] = {}
+        # key -> future of the call in flight, for callers on an event loop. Not shared with _calls.
+        self._async_calls: Dict[Hashable, asyncio.Future] = {}
+        self._lock = threading.Lock()
+
+        self.call_count = 0
+        self.shared_count = 0
+
+    def do(self, key: Hashable, fn: Callable[[], object]):
+        with self._lock:
+            self.call_count += 1
+            call = self._calls.get(key)
+            if call is not None:
+                self.shared_count += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable]):
+        """
+        Same as do() for coroutines. All callers must be on the same event loop.
+        """
+        with self._lock:
+            self.call_count += 1
+            future = self._async_calls.get(key)
+            if future is not None:
+                self.shared_count += 1
+            else:
+                future = asyncio.ensure_future(fn())
+                self._async_calls[key] = future
+                future.add_done_callback(lambda _: self._remove_async_call(key))
+        # A waiter being cancelled must not cancel the call the others are waiting for.
+        return await asyncio.shield(future)
+
+    def _remove_async_call(self, key: Hashable):
+        with self._lock:
+            del self._async_calls[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.call_count,
+                "shared": self.shared_count,
+                "in_flight": len(self._calls) + len(self._async_calls),
+            }
@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from typing import Callable, Dict, List
+from config import Config
+
+'''
+Syncs loaded wallets in the background, so that HTTP handlers read the latest state right away instead
+of waiting for the chain backend. Each wallet is synced every active_interval seconds while a page asks
+for it, and every idle_interval seconds otherwise. At most max_concurrent wallets sync at a time.
+A wallet is only synced once it is loaded. A load that fails is tried again after a delay that doubles
+from load_retry_delay up to load_retry_max_delay seconds.
+'''
+
+class _WalletJob:
+    def __init__(self, wallet_id: int, sync: Callable[[], bool], load: Callable[[], None]):
+        self.wallet_id = wallet_id
+        self.sync = sync
+        # Run until it succeeds, before anything else. None once it did.
+        self.load = load
+        # Error of the last failed load, None if it has not failed.
+        self.load_error: str = None
+        self.load_failures = 0
+        # One-off work, e.g. loading or rescanning the wallet, run instead of the next sync.
+        self.tasks: List[Callable[[], None]] = []
+        self.due_at = 0.0
+        self.bumped = False
+        self.last_bumped = 0.0
+        self.running = False
+        # Number of runs started and finished.
+        self.started = 0
+        self.finished = 0
+        # Last run that did its work: a load or tasks that didn't raise, or a sync that returned True.
+        self.succeeded = 0
+
+class SyncScheduler:
+    def __init__(self, max_concurrent: int, active_interval: float, idle_interval: float,
+                 load_retry_delay: float, load_retry_max_delay: float):
+        self._max_concurrent = max_concurrent
+        self._active_interval = active_interval
+        self._idle_interval = idle_interval
+        self._load_retry_delay = load_retry_delay
+        self._load_retry_max_delay = load_retry_max_delay
+
+        self._jobs: Dict[int, _WalletJob] = {}
+        self._cond = threading.Condition()
+        self._threads: List[threading.Thread] = []
+
+    def add_wallet(self, wallet_id: int, sync: Callable[[], bool], load: Callable[[], None] = None) -> int:
+        """
+        @sync: syncs the wallet, called from a scheduler thread. Returns False if it skipped the sync.
+        @load: run before the first sync, e.g. discovery. Tried again later if it raises.
+        @return: the first run, for wait().
+        """
+        with self._cond:
+            job = _WalletJob(wallet_id, sync, load)
+            self._jobs[wallet_id] = job
+            while len(self._threads) < self._max_concurrent:
+                thread = threading.Thread(target=self._run, name="syncscheduler", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            self._cond.notify_all()
+            return 1
+
+    def bump(self, wallet_id: int) -> int:
+        """
+        Sync the wallet before the others, and keep it on active_interval.
+        @return: the run that will sync it, for wait().
+        """
+        with self._cond:
+            job = self._jobs[wallet_id]
+            job.bumped = True
+            job.last_bumped = time.time()
+            self._cond.notify_all()
+            return job.started + 1
+
+    def submit(self, wallet_id: int, task: Callable[[], None]) -> int:
+        """
+        @return: the run that will call task, for wait().
+        """
+        with self._cond:
+            job = self._jobs[wallet_id]
+            job.tasks.append(task)
+            self._cond.notify_all()
+            return job.started + 1
+
+    def wait(self, wallet_id: int, run: int, timeout: float) -> bool:
+        """
+        @run: as returned by bump() or submit().
+        @return: False on timeout, or if neither the run nor a later one did its work, e.g. the sync was
+                 skipped or raised.
+        """
+        with self._cond:
+            job = self._jobs[wallet_id]
+            if not self._cond.wait_for(lambda: job.finished >= run, timeout):
+                return False
+            return job.succeeded >= run
+
+    def loaded(self, wallet_id: int) -> bool:
+        with self._cond:
+            job = self._jobs[wallet_id]
+            return job.load is None and job.finished > 0
+
+    def load_error(self, wallet_id: int) -> str:
+        """
+        @return: why the last load of the wallet failed, None unless it is waiting to be tried again.
+        """
+        with self._cond:
+            return self._jobs[wallet_id].load_error
+
+    def _next_job(self, now: float) -> _WalletJob:
+        next_job = None
+        for job in self._jobs.values():
+            if job.running:
+                continue
+            if job.load is not None:
+                # Nothing else runs before the load, which waits for due_at after a failure.
+                priority = (0, job.due_at)
+                if job.due_at > now:
+                    continue
+            else:
+                priority = (0 if len(job.tasks) > 0 else 1 if job.bumped else 2, job.due_at)
+                if priority[0] == 2 and job.due_at > now:
+                    continue
+            if next_job is None or priority < next_priority:
+                next_job, next_priority = job, priority
+        return next_job
+
+    def _time_to_next_due(self, now: float) -> float:
+        due_ats = [job.due_at for job in self._jobs.values() if not job.running]
+        return max(min(due_ats) - now, 0) if len(due_ats) > 0 else None
+
+    def _run(self):
+        while True:
+            with self._cond:
+                job = self._next_job(time.time())
+                while job is None:
+                    self._cond.wait(self._time_to_next_due(time.time()))
+                    job = self._next_job(time.time())
+                job.running = True
+                job.bumped = False
+                job.started += 1
+                run = job.started
+                load = job.load
+                if load is None:
+                    tasks = job.tasks
+                    job.tasks = []
+
+            start = time.time()
+            load_error = None
+            succeeded = False
+            try:
+                if load is not None:
+                    load()
+                    succeeded = True
+                elif len(tasks) > 0:
+                    for task in tasks:
+                        task()
+                    succeeded = True
+                else:
+                    succeeded = job.sync()
+            except Exception as e:
+                logging.warning("Failed to {} wallet {}: {}".format(
+                    "load" if load is not None else "sync", job.wallet_id, e))
+                if load is not None:
+                    load_error = str(e) or type(e).__name__
+            logging.debug("Sync job of wallet {} took {} ms".format(job.wallet_id, int((time.time() - start)*1000)))
+
+            with self._cond:
+                now = time.time()
+                interval = self._active_interval if now - job.last_bumped < self._idle_interval else self._idle_interval
+                if load is not None and load_error is not None:
+                    interval = min(self._load_retry_delay * 2 ** job.load_failures, self._load_retry_max_delay)
+                    job.load_failures += 1
+                elif load is not None:
+                    job.load = None
+                    job.load_failures = 0
+                job.load_error = load_error
+                if succeeded:
+                    job.succeeded = run
+                job.due_at = now + interval
+                job.running = False
+                job.finished += 1
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "wallets": len(self._jobs),
+                "running": sum(1 for job in self._jobs.values() if job.running),
+                "bumped": sum(1 for job in self._jobs.values() if job.bumped),
+                "load_failed": sum(1 for job in self._jobs.values() if job.load_error is not None),
+            }
+
+gSyncScheduler = SyncScheduler(Config.SyncMaxConcurrentWallets, Config.SyncMinInterval, Config.SyncIdleInterval,
+                               Config.SyncLoadRetryDelay, Config.SyncLoadRetryMaxDelay)
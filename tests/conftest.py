@@ -0,0 +1,22 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bitcoin
+bitcoin.SelectParams("testnet")
+
+# discovery imports wallet, which imports discovery back, so it has to come first.
+import discovery
+import wallet
+
+import addressusage
+import txcache
+import walletcache
+import walletstate
+
+# The caches create their tables once, so all tests share one database, away from data/wallets.db.
+SQLITE_DB_FILE = os.path.join(tempfile.mkdtemp(), "wallets.db")
+for module in (addressusage, txcache, walletcache, walletstate):
+    module.SQLITE_DB_FILE = SQLITE_DB_FILE
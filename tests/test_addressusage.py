@@ -0,0 +1,69 @@
+import sqlite3
+
+import pytest
+
+import addressusage
+
+
+class CountingCache(addressusage.AddressUsageCache):
+    '''
+    Counts database connections, and fails them while fail is set.
+    '''
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.connections = 0
+        self.fail = False
+
+    def _connect(self):
+        self.connections += 1
+        if self.fail:
+            raise sqlite3.OperationalError("database is locked")
+        return super()._connect()
+
+
+def test_get_many_reads_the_database_once():
+    writer = addressusage.AddressUsageCache(100, 60)
+    writer.put("tb1qgetmany1", True)
+    writer.put("tb1qgetmany3", True)
+    writer.flush()
+
+    cache = CountingCache(100, 60)
+    cache.put("tb1qgetmany0", False)
+    cache.put("tb1qgetmany4", True)
+    addresses = ["tb1qgetmany{}".format(i) for i in range(6)] + ["tb1qgetmany1"]
+    assert cache.get_many(addresses) == [False, True, None, True, True, None, True]
+    assert cache.connections == 1
+    assert cache.stats()["misses"] == 2
+
+    # Used addresses read from the database are kept in memory, unknown ones are asked again.
+    assert cache.get_many(["tb1qgetmany1", "tb1qgetmany3"]) == [True, True]
+    assert cache.connections == 1
+    assert cache.get("tb1qgetmany2") is None
+    assert cache.connections == 2
+
+
+def test_get_many_in_batches(monkeypatch):
+    monkeypatch.setattr(addressusage, "SELECT_BATCH_SIZE", 3)
+    writer = addressusage.AddressUsageCache(100, 60)
+    for i in range(0, 10, 2):
+        writer.put("tb1qbatch{}".format(i), True)
+    writer.flush()
+
+    cache = CountingCache(100, 60)
+    assert cache.get_many(["tb1qbatch{}".format(i) for i in range(10)]) == [True, None] * 5
+    assert cache.connections == 1
+
+
+def test_failed_flush_keeps_entries():
+    cache = CountingCache(100, 60)
+    cache.put("tb1qflush0", True)
+    cache.put("tb1qflush1", True)
+    cache.fail = True
+    with pytest.raises(sqlite3.OperationalError):
+        cache.flush()
+    assert cache.stats()["unflushed"] == 2
+
+    cache.fail = False
+    cache.flush()
+    assert cache.stats()["unflushed"] == 0
+    assert addressusage.AddressUsageCache(100, 60).get_many(["tb1qflush0", "tb1qflush1"]) == [True, True]
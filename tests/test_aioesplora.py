@@ -0,0 +1,176 @@
+import asyncio
+import hashlib
+import threading
+
+import pytest
+from aiohttp import web
+
+import aioesplora
+import esplora
+import wallet
+from config import Config
+
+SEED = b"\x21" * 64
+
+
+class StubChain:
+    '''
+    Transactions of an Esplora instance, in the JSON Esplora returns.
+    '''
+    def __init__(self):
+        self.txs = {}
+        # Confirmed txids, oldest first.
+        self.confirmed = []
+        self.mempool = []
+
+    def add_tx(self, spends, payments, confirmed=True):
+        """
+        @spends: list of (txid, vout)
+        @payments: list of (address, value)
+        """
+        txid = hashlib.sha256(str(len(self.txs)).encode()).hexdigest()
+        self.txs[txid] = {
+            "txid": txid,
+            "vin": [{"txid": spent_txid, "vout": n, "prevout": self.txs[spent_txid]["vout"][n]}
+                    for spent_txid, n in spends],
+            "vout": [{"scriptpubkey_address": address, "value": value} for address, value in payments],
+            "status": {"confirmed": False},
+        }
+        self.mempool.append(txid)
+        if confirmed:
+            self.mine()
+        return txid
+
+    def mine(self):
+        for txid in self.mempool:
+            self.confirmed.append(txid)
+            self.txs[txid]["status"] = {"confirmed": True, "block_height": len(self.confirmed)}
+        self.mempool = []
+
+    def _touches(self, txid, address):
+        tx = self.txs[txid]
+        return any(vin["prevout"]["scriptpubkey_address"] == address for vin in tx["vin"]) or \
+            any(vout["scriptpubkey_address"] == address for vout in tx["vout"])
+
+    def address_txids(self, address):
+        """
+        @return: (confirmed txids, mempool txids), newest first.
+        """
+        return ([txid for txid in reversed(self.confirmed) if self._touches(txid, address)],
+                [txid for txid in reversed(self.mempool) if self._touches(txid, address)])
+
+    def address_stats(self, address):
+        def stats(txids):
+            txs = [self.txs[txid] for txid in txids]
+            return {
+                "tx_count": len(txids),
+                "funded_txo_sum": sum(vout["value"] for tx in txs for vout in tx["vout"]
+                                      if vout["scriptpubkey_address"] == address),
+                "spent_txo_sum": sum(vin["prevout"]["value"] for tx in txs for vin in tx["vin"]
+                                     if vin["prevout"]["scriptpubkey_address"] == address),
+            }
+        confirmed, mempool = self.address_txids(address)
+        return {"address": address, "chain_stats": stats(confirmed), "mempool_stats": stats(mempool)}
+
+
+def stub_esplora_app(chain: StubChain) -> web.Application:
+    async def address(request):
+        return web.json_response(chain.address_stats(request.match_info["address"]))
+
+    async def address_txs(request):
+        confirmed, mempool = chain.address_txids(request.match_info["address"])
+        return web.json_response([chain.txs[txid] for txid in mempool[:50] + confirmed[:25]])
+
+    async def address_txs_chain(request):
+        confirmed, _ = chain.address_txids(request.match_info["address"])
+        after = confirmed.index(request.match_info["txid"]) + 1
+        return web.json_response([chain.txs[txid] for txid in confirmed[after:after + 25]])
+
+    async def tx(request):
+        return web.json_response(chain.txs[request.match_info["txid"]])
+
+    app = web.Application()
+    app.router.add_get("/address/{address}", address)
+    app.router.add_get("/address/{address}/txs", address_txs)
+    app.router.add_get("/address/{address}/txs/chain/{txid}", address_txs_chain)
+    app.router.add_get("/tx/{txid}", tx)
+    return app
+
+
+@pytest.fixture
+def chain(monkeypatch):
+    stub_chain = StubChain()
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(stub_esplora_app(stub_chain))
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    monkeypatch.setattr(Config, "Network", "testnet")
+    monkeypatch.setattr(esplora, "ENDPOINT_TESTNET", "http://127.0.0.1:{}/".format(port))
+    yield stub_chain
+    asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+
+
+def populate(chain: StubChain):
+    path = wallet.Bip44Path(SEED, 84, 0)
+    receive = [str(address.address) for address in path.derive_range(0, 0, 0, 8)]
+    change = [str(address.address) for address in path.derive_range(0, 1, 0, 3)]
+    # More transactions than fit in a page of /address/:address/txs.
+    funding = [chain.add_tx([], [(receive[0], 1000 + i)]) for i in range(30)]
+    chain.add_tx([], [(receive[2], 50000)])
+    chain.add_tx([(funding[0], 0), (funding[1], 0)], [("tb1qexternal", 1500), (change[0], 400)])
+    chain.add_tx([], [(receive[5], 7000)])
+    chain.add_tx([(funding[2], 0)], [(change[1], 900)], confirmed=False)
+
+
+def state(w: wallet.Wallet):
+    return (w.balance, w.watermarks(), sorted(w.unspent_outputs_map),
+            sorted((address_string, address.balance, address.last_seen_txid)
+                   for address_string, address in w.addresses_map.items()),
+            sorted(w.mempool_txids), sorted((txid, tx.value) for txid, tx in w.mempool_tx_map.items()))
+
+
+def test_async_sync_matches_threaded(chain, monkeypatch):
+    populate(chain)
+
+    monkeypatch.setattr(Config, "EnableAsyncEsplora", False)
+    threaded = wallet.Wallet(SEED)
+    threaded.discover()
+
+    # Writes to the wallet run off the event loop thread.
+    writer_threads = set()
+    apply_deltas = wallet.Wallet._apply_deltas
+
+    def recording_apply_deltas(self, deltas):
+        writer_threads.add(threading.current_thread().name)
+        apply_deltas(self, deltas)
+    monkeypatch.setattr(wallet.Wallet, "_apply_deltas", recording_apply_deltas)
+    monkeypatch.setattr(Config, "EnableAsyncEsplora", True)
+    asynchronous = wallet.Wallet(SEED)
+    asynchronous.discover()
+
+    assert state(asynchronous) == state(threaded)
+    assert asynchronous.balance == sum(1000 + i for i in range(2, 30)) + 50000 + 400 + 7000
+    assert len(asynchronous.mempool_tx_map) == 1
+    assert "aioesplora" not in writer_threads
+
+    # A block confirms the pending transaction and pays the first unused address.
+    chain.add_tx([], [(str(threaded.receive_addresses[0][6].address), 3000)])
+    monkeypatch.setattr(Config, "EnableAsyncEsplora", False)
+    threaded.sync_addresses(threaded._all_addresses())
+    monkeypatch.setattr(Config, "EnableAsyncEsplora", True)
+    asynchronous.sync_addresses(asynchronous._all_addresses())
+
+    assert state(asynchronous) == state(threaded)
+    assert len(asynchronous.mempool_txids) == 0
+    assert asynchronous.last_receive_address_index == [6]
+
+
+def test_run_blocking_runs_off_the_loop():
+    async def thread_name():
+        return await aioesplora.run_blocking(lambda: threading.current_thread().name)
+    assert aioesplora.run(thread_name()) != "aioesplora"
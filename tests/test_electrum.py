@@ -0,0 +1,257 @@
+import hashlib
+import json
+import socketserver
+import threading
+
+import pytest
+from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut, COutPoint, CScript, b2lx, lx
+
+import electrum
+import wallet
+from config import Config, BACKEND_ELECTRUM
+
+SEED = b"\x31" * 64
+
+
+class StubElectrumServer:
+    '''
+    Electrum server over plain TCP. Batch responses come back in reverse order, after any pending
+    notifications, and the connection can be dropped while a request is in flight.
+    '''
+    def __init__(self):
+        # method -> function of params returning the result, or raising StubError
+        self.methods = {"server.version": lambda params: ["stub", electrum.PROTOCOL_VERSION]}
+        # Messages received, a list of requests for a batch.
+        self.messages = []
+        self.connections = 0
+        # Number of next messages to close the connection on instead of answering.
+        self.drops = 0
+        # Sent ahead of the next response.
+        self.notifications = []
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                server.connections += 1
+                for line in self.rfile:
+                    message = json.loads(line)
+                    server.messages.append(message)
+                    if server.drops > 0:
+                        server.drops -= 1
+                        return
+                    for notification in server.notifications:
+                        self.wfile.write(json.dumps(notification).encode() + b"\n")
+                    server.notifications = []
+                    if isinstance(message, list):
+                        response = [server.respond(request) for request in reversed(message)]
+                    else:
+                        response = server.respond(message)
+                    self.wfile.write(json.dumps(response).encode() + b"\n")
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def respond(self, request):
+        try:
+            result = self.methods[request["method"]](request["params"])
+        except StubError as e:
+            return {"jsonrpc": "2.0", "id": request["id"], "error": {"code": e.code, "message": e.message}}
+        return {"jsonrpc": "2.0", "id": request["id"], "result": result}
+
+    def client(self, batch_size=100) -> electrum.ElectrumClient:
+        return electrum.ElectrumClient("127.0.0.1", self.server.server_address[1], False, 5, batch_size)
+
+    def batches(self, method):
+        return [message for message in self.messages
+                if isinstance(message, list) and message[0]["method"] == method]
+
+
+class StubError(Exception):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+
+@pytest.fixture
+def server():
+    stub = StubElectrumServer()
+    yield stub
+    stub.server.shutdown()
+    stub.server.server_close()
+
+
+def test_batch_in_chunks(server):
+    server.methods["echo"] = lambda params: params[0]
+    client = server.client(batch_size=3)
+    assert client.batch([("echo", [i]) for i in range(7)]) == list(range(7))
+    # server.version, then chunks of 3, 3 and 1.
+    assert [len(message) if isinstance(message, list) else 1 for message in server.messages] == [1, 3, 3, 1]
+    assert server.connections == 1
+
+
+def test_responses_out_of_order_and_notifications(server):
+    server.methods["echo"] = lambda params: params[0]
+    client = server.client()
+    client.call("echo", 0)
+    server.notifications = [{"jsonrpc": "2.0", "method": "blockchain.scripthash.subscribe",
+                             "params": ["ab" * 32, "status"]}]
+    assert client.batch([("echo", [i]) for i in range(5)]) == list(range(5))
+    assert client.has_notified_statuses({"ab" * 32})
+    assert not client.has_notified_statuses({"cd" * 32})
+    assert client.take_notified_statuses({"ab" * 32}) == {"ab" * 32: "status"}
+    assert client.take_notified_statuses({"ab" * 32}) == {}
+
+
+def test_error(server):
+    def broadcast(params):
+        raise StubError(1, "bad-txns-inputs-missingorspent")
+    server.methods["blockchain.transaction.broadcast"] = broadcast
+    client = server.client()
+    with pytest.raises(AssertionError, match="bad-txns-inputs-missingorspent"):
+        client.call("blockchain.transaction.broadcast", "00")
+
+
+def test_reconnect_after_dropped_connection(server):
+    server.methods["echo"] = lambda params: params[0]
+    client = server.client(batch_size=2)
+    assert client.call("echo", "a") == "a"
+    client.notified_statuses["ab" * 32] = "status"
+
+    # Dropped while a chunk is in flight: the chunk is sent again on a new connection.
+    server.drops = 1
+    assert client.batch([("echo", [i]) for i in range(4)]) == list(range(4))
+    assert server.connections == 2
+    # Subscriptions were lost with the connection.
+    assert client.notified_statuses == {}
+    assert [request["params"] for request in server.batches("echo")[-2]] == [[0], [1]]
+
+    # Dropped again on the new connection: only one reconnect per chunk.
+    server.drops = 2
+    with pytest.raises(ConnectionError):
+        client.batch([("echo", [5])])
+
+
+class StubChain:
+    '''
+    Serialized transactions and the histories an Electrum server derives from them.
+    '''
+    def __init__(self):
+        self.raw = {}
+        self.heights = {}
+        # scripthash -> txids
+        self.histories = {}
+        # (txid, vout) -> (scripthash, value)
+        self.outputs = {}
+        self.spent = set()
+
+    def add_tx(self, spends, payments, height):
+        """
+        @spends: list of (txid, vout)
+        @payments: list of (CBitcoinAddress, value)
+        @height: 0 for the mempool
+        """
+        vin = [CMutableTxIn(COutPoint(lx(txid), n)) for txid, n in spends] or \
+            [CMutableTxIn(COutPoint(), CScript([len(self.raw) + 1]))]
+        tx = CMutableTransaction(vin, [CMutableTxOut(value, address.to_scriptPubKey())
+                                       for address, value in payments])
+        txid = b2lx(tx.GetTxid())
+        self.raw[txid] = tx.serialize().hex()
+        self.heights[txid] = height
+        for outpoint in spends:
+            self.spent.add(outpoint)
+            self.histories[self.outputs[outpoint][0]].append(txid)
+        for n, (address, value) in enumerate(payments):
+            scripthash = electrum.scripthash(address)
+            self.outputs[(txid, n)] = (scripthash, value)
+            self.histories.setdefault(scripthash, []).append(txid)
+        return txid
+
+    def history(self, scripthash):
+        txids = list(dict.fromkeys(self.histories.get(scripthash, [])))
+        return [{"tx_hash": txid, "height": self.heights[txid]}
+                for txid in sorted(txids, key=lambda txid: self.heights[txid] or float("inf"))]
+
+    def status(self, scripthash):
+        history = self.history(scripthash)
+        if len(history) == 0:
+            return None
+        return hashlib.sha256("".join("{}:{}:".format(entry["tx_hash"], entry["height"])
+                                      for entry in history).encode()).hexdigest()
+
+    def serve(self, server: StubElectrumServer):
+        server.methods.update({
+            "blockchain.scripthash.subscribe": lambda params: self.status(params[0]),
+            "blockchain.scripthash.get_history": lambda params: self.history(params[0]),
+            "blockchain.scripthash.listunspent": lambda params: [
+                {"tx_hash": txid, "tx_pos": n, "value": value, "height": self.heights[txid]}
+                for (txid, n), (scripthash, value) in self.outputs.items()
+                if scripthash == params[0] and (txid, n) not in self.spent],
+            "blockchain.transaction.get": lambda params: self.raw[params[0]],
+        })
+
+
+@pytest.fixture
+def electrum_backend(server, monkeypatch):
+    monkeypatch.setattr(Config, "ChainBackend", BACKEND_ELECTRUM)
+    monkeypatch.setattr(Config, "WarmAddressSyncInterval", 0)
+    monkeypatch.setattr(Config, "ColdAddressSyncInterval", 0)
+    monkeypatch.setattr(electrum, "gClient", server.client())
+    return server
+
+
+def test_sync_addresses_electrum(electrum_backend):
+    server = electrum_backend
+    path = wallet.Bip44Path(SEED, 84, 0)
+    receive = [address.address for address in path.derive_range(0, 0, 0, 10)]
+    change = [address.address for address in path.derive_range(0, 1, 0, 2)]
+    external = wallet.Bip44Path(b"\x32" * 64, 84, 0).derive_range(0, 0, 0, 1)[0].address
+
+    chain = StubChain()
+    funding = chain.add_tx([], [(receive[0], 5000)], height=10)
+    payment = chain.add_tx([(funding, 0)], [(external, 1500), (change[0], 3300)], height=11)
+    received = chain.add_tx([], [(receive[1], 800), (receive[1], 200)], height=12)
+    pending = chain.add_tx([(received, 1)], [(receive[2], 150)], height=0)
+    chain.serve(server)
+
+    w = wallet.Wallet(SEED)
+    w.discover()
+
+    assert w.balance == 3300 + 800
+    assert sorted(w.unspent_outputs_map) == sorted([(lx(payment), 1), (lx(received), 0)])
+    receive_addresses = w.receive_addresses[0]
+    # Spent down to nothing, still used.
+    assert receive_addresses[0].balance == 0 and receive_addresses[0].last_seen_txid == payment
+    assert receive_addresses[1].last_seen_txid == received
+    assert receive_addresses[2].last_seen_txid is None
+    assert w.change_addresses[0][0].balance == 3300
+    assert w.last_receive_address_index == [1]
+    assert w.mempool_txids == {pending}
+    mempool_tx = w.mempool_tx_map[pending]
+    assert mempool_tx.value == 150 - 200
+    assert mempool_tx.vin_addresses == [receive_addresses[1]]
+    assert mempool_tx.vout_addresses == [receive_addresses[2]]
+
+    # Nothing changed: statuses are checked, histories are not fetched again. Cancelled speculative
+    # scans of the next account may still be checking its addresses, so only those of the wallet count.
+    scripthashes = set(electrum.scripthash(address.address) for address in w.addresses_map.values())
+
+    def history_requests():
+        return [request for batch in server.batches("blockchain.scripthash.get_history") for request in batch
+                if request["params"][0] in scripthashes]
+    history_request_count = len(history_requests())
+    version = w.state_version
+    w.sync_addresses()
+    assert len(history_requests()) == history_request_count
+    assert w.state_version == version
+
+    # The pending transaction confirms, and the server notifies the change.
+    chain.heights[pending] = 13
+    server.notifications = [{"jsonrpc": "2.0", "method": "blockchain.scripthash.subscribe",
+                             "params": [electrum.scripthash(receive[2]), chain.status(electrum.scripthash(receive[2]))]}]
+    w.sync_addresses()
+    assert w.mempool_txids == set() and w.mempool_tx_map == {}
+    assert w.balance == 3300 + 800 + 150
+    assert w.last_receive_address_index == [2]
+    assert receive_addresses[2].last_seen_txid == pending
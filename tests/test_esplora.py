@@ -0,0 +1,74 @@
+import pytest
+import requests
+
+import esplora
+from config import Config
+from ratelimit import OUTCOME_ERROR, OUTCOME_OK
+
+
+class RecordingLimiter:
+    def __init__(self):
+        self.outcomes = []
+
+    def acquire(self):
+        pass
+
+    def release(self, outcome, latency):
+        self.outcomes.append(outcome)
+
+
+class FakeSession:
+    '''
+    Raises or returns the given results in turn.
+    '''
+    def __init__(self, results):
+        self.results = results
+        self.urls = []
+
+    def get(self, url, timeout):
+        self.urls.append(url)
+        result = self.results.pop(0)
+        if isinstance(result, BaseException):
+            raise result
+        return result
+
+
+def ok_response():
+    response = requests.Response()
+    response.status_code = 200
+    return response
+
+
+@pytest.fixture
+def limiter(monkeypatch):
+    recording_limiter = RecordingLimiter()
+    monkeypatch.setattr(esplora, "gLimiter", recording_limiter)
+    monkeypatch.setattr(Config, "EsploraMaxRetries", 2)
+    monkeypatch.setattr(Config, "EsploraRetryBaseDelay", 0)
+    monkeypatch.setattr(Config, "EsploraRetryMaxDelay", 0)
+    return recording_limiter
+
+
+def test_failed_requests_are_errors_and_retried(limiter, monkeypatch):
+    session = FakeSession([requests.exceptions.ChunkedEncodingError("cut off"),
+                           requests.exceptions.ContentDecodingError("bad gzip"), ok_response()])
+    monkeypatch.setattr(esplora, "get_session", lambda: session)
+    assert esplora.http_get("http://esplora/address/a").status_code == 200
+    assert limiter.outcomes == [OUTCOME_ERROR, OUTCOME_ERROR, OUTCOME_OK]
+    assert len(session.urls) == 3
+
+
+def test_failed_request_without_retries(limiter, monkeypatch):
+    session = FakeSession([requests.exceptions.ChunkedEncodingError("cut off")])
+    monkeypatch.setattr(esplora, "get_session", lambda: session)
+    with pytest.raises(requests.exceptions.ChunkedEncodingError):
+        esplora.http_get("http://esplora/address/a", retry_on_5xx=False)
+    assert limiter.outcomes == [OUTCOME_ERROR]
+
+
+def test_other_exceptions_are_errors(limiter, monkeypatch):
+    session = FakeSession([KeyboardInterrupt()])
+    monkeypatch.setattr(esplora, "get_session", lambda: session)
+    with pytest.raises(KeyboardInterrupt):
+        esplora.http_get("http://esplora/address/a")
+    assert limiter.outcomes == [OUTCOME_ERROR]
@@ -0,0 +1,163 @@
+import threading
+import time
+
+import pytest
+
+import feerates
+
+ESTIMATES = {str(target): float(1008 // target) for target in feerates.CONFIRMATION_TARGETS}
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+class FakeSource:
+    '''
+    Returns the estimates it is set to, raises if it is set to an exception, and blocks while
+    release is cleared.
+    '''
+    def __init__(self, estimates):
+        self.estimates = estimates
+        self.calls = 0
+        self.release = threading.Event()
+        self.release.set()
+        self.__name__ = "fake"
+
+    def __call__(self):
+        self.calls += 1
+        self.release.wait(5)
+        if isinstance(self.estimates, Exception):
+            raise self.estimates
+        return self.estimates
+
+
+class StopRun(Exception):
+    pass
+
+
+class RecordingWake:
+    '''
+    Stands in for FeeRateProvider._wake to record the delays between refreshes, and stop _run()
+    after a number of them.
+    '''
+    def __init__(self, waits):
+        self.delays = []
+        self._waits = waits
+
+    def wait(self, delay):
+        self.delays.append(delay)
+        if len(self.delays) == self._waits:
+            raise StopRun()
+
+    def clear(self):
+        pass
+
+    def set(self):
+        pass
+
+
+def test_fill_missing_targets():
+    filled = feerates.fill_missing_targets({"2": 20.0, "12": 5.0, "1008": 1.0})
+    assert filled["1"] == 20.0
+    assert filled["3"] == 20.0
+    # 6 is nearer to 2 than to 12.
+    assert filled["6"] == 20.0
+    assert filled["24"] == 5.0
+    # 504 is nearer to 12 than to 1008.
+    assert filled["504"] == 5.0
+    assert filled["1008"] == 1.0
+    assert set(filled) == {str(target) for target in feerates.CONFIRMATION_TARGETS}
+    # Targets other than CONFIRMATION_TARGETS are kept.
+    assert feerates.fill_missing_targets({"1": 3.0, "5": 2.0})["5"] == 2.0
+    assert feerates.fill_missing_targets({"5": 2.0}) is None
+
+
+def test_fill_missing_targets_tie_takes_lower_target():
+    # 2 is as far from 1 as from 3.
+    assert feerates.fill_missing_targets({"1": 9.0, "3": 4.0})["2"] == 9.0
+
+
+def test_get_never_waits_for_first_refresh():
+    source = FakeSource(ESTIMATES)
+    source.release.clear()
+    provider = feerates.FeeRateProvider([source], 60, 1)
+    provider.start()
+    wait_for(lambda: source.calls == 1)
+
+    start = time.time()
+    with pytest.raises(feerates.FeeRatesUnavailable):
+        provider.get()
+    assert time.time() - start < 1
+
+    source.release.set()
+    wait_for(lambda: provider.refresh_count > 0)
+    assert provider.get() == ESTIMATES
+
+
+def test_stale_while_revalidate():
+    source = FakeSource(ESTIMATES)
+    provider = feerates.FeeRateProvider([source], 60, 1)
+    provider.start()
+    wait_for(lambda: provider.refresh_count == 1)
+
+    # Fresh: no refresh.
+    assert provider.get() == ESTIMATES
+    time.sleep(0.05)
+    assert source.calls == 1
+
+    # Stale: the old value is served right away, and the refresh thread is woken up.
+    new_estimates = dict(ESTIMATES, **{"1": 500.0})
+    source.estimates = new_estimates
+    source.release.clear()
+    provider._fetched_at -= 61
+    start = time.time()
+    assert provider.get() == ESTIMATES
+    assert time.time() - start < 1
+    wait_for(lambda: source.calls == 2)
+    assert provider.get() == ESTIMATES
+
+    source.release.set()
+    wait_for(lambda: provider.refresh_count > 1)
+    assert provider.get() == new_estimates
+
+
+def test_falls_back_to_next_source():
+    failing = FakeSource(ConnectionError("down"))
+    # Nothing for CONFIRMATION_TARGETS counts as a failure too.
+    empty = FakeSource({"5": 1.0})
+    fallback = FakeSource({"1": 10.0, "144": 2.0})
+    provider = feerates.FeeRateProvider([failing, empty, fallback], 60, 1)
+    assert provider._refresh()
+    assert provider.get()["6"] == 10.0
+    assert provider.get()["1008"] == 2.0
+    assert (failing.calls, empty.calls, fallback.calls) == (1, 1, 1)
+
+
+def test_retry_backoff():
+    source = FakeSource(ConnectionError("down"))
+    provider = feerates.FeeRateProvider([source], 20, 2)
+    provider._wake = RecordingWake(6)
+    with pytest.raises(StopRun):
+        provider._run()
+    # Doubling from retry_delay, up to ttl.
+    assert provider._wake.delays == [2, 4, 8, 16, 20, 20]
+
+    # A success goes back to ttl, and the next failure starts from retry_delay again.
+    results = [ESTIMATES, ConnectionError("down"), ConnectionError("down"), ESTIMATES, ConnectionError("down")]
+
+    def source_from_results():
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    provider = feerates.FeeRateProvider([source_from_results], 20, 2)
+    provider._wake = RecordingWake(5)
+    with pytest.raises(StopRun):
+        provider._run()
+    assert provider._wake.delays == [20, 2, 4, 20, 2]
+    # The last good estimates are kept through failures.
+    assert provider.get() == ESTIMATES
@@ -0,0 +1,382 @@
+import json
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut, COutPoint, CScript, b2lx, lx
+from bitcoin.wallet import CBitcoinAddress
+
+import discovery
+import fullnode
+import wallet
+from config import Config, BACKEND_FULLNODE
+
+SEED = b"\x51" * 64
+
+
+class StubNode:
+    '''
+    JSON-RPC server standing in for the node. Batch responses come back in reverse order, as the
+    JSON-RPC spec allows, so that results have to be matched by id.
+    '''
+    def __init__(self):
+        # method -> function of params returning the result, or raising StubError
+        self.methods = {}
+        # (path, method, params) per call
+        self.requests = []
+        self.status = 200
+        node = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if isinstance(payload, list):
+                    body = [node.respond(self.path, request) for request in reversed(payload)]
+                else:
+                    body = node.respond(self.path, payload)
+                data = json.dumps(body).encode()
+                self.send_response(node.status)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = HTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def respond(self, path, request):
+        self.requests.append((path, request["method"], request["params"]))
+        try:
+            result = self.methods[request["method"]](request["params"])
+        except StubError as e:
+            return {"result": None, "error": {"code": e.code, "message": e.message}, "id": request["id"]}
+        return {"result": result, "error": None, "id": request["id"]}
+
+
+class StubError(Exception):
+    def __init__(self, code, message):
+        self.code = code
+        self.message = message
+
+
+@pytest.fixture
+def node(monkeypatch):
+    stub = StubNode()
+    monkeypatch.setattr(Config, "Network", "testnet")
+    monkeypatch.setattr(Config.TestNetFullNodeConfig, "host", "127.0.0.1")
+    monkeypatch.setattr(Config.TestNetFullNodeConfig, "port", str(stub.server.server_port))
+    monkeypatch.setattr(Config.TestNetFullNodeConfig, "user", "user")
+    monkeypatch.setattr(Config.TestNetFullNodeConfig, "password", "password")
+    yield stub
+    stub.server.shutdown()
+
+
+def test_call(node):
+    node.methods["getblockcount"] = lambda params: 123
+    assert fullnode.call("getblockcount") == 123
+    assert node.requests == [("/", "getblockcount", [])]
+
+
+def test_call_error(node):
+    def getrawtransaction(params):
+        raise StubError(-5, "No such mempool or blockchain transaction")
+    node.methods["getrawtransaction"] = getrawtransaction
+    with pytest.raises(fullnode.RPCError) as e:
+        fullnode.getrawtransaction("00" * 32)
+    assert e.value.method == "getrawtransaction"
+    assert e.value.code == -5
+    assert e.value.message == "No such mempool or blockchain transaction"
+
+
+def test_unauthorized(node):
+    node.status = 401
+    node.methods["getbestblockhash"] = lambda params: "00" * 32
+    with pytest.raises(fullnode.RPCError) as e:
+        fullnode.getbestblockhash()
+    assert e.value.code == 401
+
+
+def test_batch_orders_results_by_id(node):
+    node.methods["echo"] = lambda params: params[0]
+    assert fullnode.batch([("echo", [i]) for i in range(10)]) == list(range(10))
+    # One POST for the whole batch.
+    assert [params for _, _, params in node.requests] == [[i] for i in reversed(range(10))]
+
+
+def test_batch_raises_first_error(node):
+    def gettxout(params):
+        if params[1] > 0:
+            raise StubError(-8, "bad vout {}".format(params[1]))
+        return {"value": 1}
+    node.methods["gettxout"] = gettxout
+    with pytest.raises(fullnode.RPCError) as e:
+        fullnode.gettxouts([("00" * 32, 0), ("00" * 32, 1), ("00" * 32, 2)])
+    assert e.value.message == "bad vout 1"
+
+
+def test_batch_empty(node):
+    assert fullnode.batch([]) == []
+    assert node.requests == []
+
+
+def test_wallet_calls_use_wallet_path(node):
+    node.methods["listunspent"] = lambda params: []
+    node.methods["getaddressinfo"] = lambda params: {"address": params[0]}
+    assert fullnode.listunspent("my wallet") == []
+    assert fullnode.getaddressinfos("w", ["a", "b"]) == [{"address": "a"}, {"address": "b"}]
+    assert [path for path, _, _ in node.requests] == ["/wallet/my%20wallet", "/wallet/w", "/wallet/w"]
+
+
+def test_load_watch_only_wallet(node):
+    def loadwallet(params):
+        raise StubError(fullnode.RPC_WALLET_NOT_FOUND, "Wallet file not found")
+    node.methods["loadwallet"] = loadwallet
+    node.methods["createwallet"] = lambda params: {"name": params[0]}
+    fullnode.load_watch_only_wallet("w")
+    assert node.requests[-1] == ("/", "createwallet", ["w", True, True, "", False, True, True])
+
+    def loaded(params):
+        raise StubError(fullnode.RPC_WALLET_ALREADY_LOADED, "Wallet already loaded")
+    node.methods["loadwallet"] = loaded
+    fullnode.load_watch_only_wallet("w")
+    assert node.requests[-1][1] == "loadwallet"
+
+
+def test_importdescriptors(node):
+    node.methods["getdescriptorinfo"] = lambda params: {"checksum": "c" + params[0][-4]}
+    imported = []
+
+    def importdescriptors(params):
+        imported.extend(params[0])
+        return [{"success": True}, {"success": False, "error": {"code": -5, "message": "bad range"}}]
+    node.methods["importdescriptors"] = importdescriptors
+    with pytest.raises(fullnode.RPCError) as e:
+        fullnode.importdescriptors("w", [{"desc": "wpkh(tpub/0/*)", "range": [0, 999], "timestamp": 0},
+                                         {"desc": "wpkh(tpub/1/*)", "range": [0, 999], "timestamp": 0}])
+    assert e.value.message == "bad range"
+    assert [request["desc"] for request in imported] == ["wpkh(tpub/0/*)#c0", "wpkh(tpub/1/*)#c1"]
+
+
+def test_listtransactions_pages(node):
+    entries = [{"txid": "%064x" % i} for i in range(5)]
+
+    def listtransactions(params):
+        _, count, skip, _ = params
+        end = len(entries) - skip
+        return entries[max(0, end - count):max(0, end)]
+    node.methods["listtransactions"] = listtransactions
+    assert fullnode.listtransactions("w", page_size=2) == entries
+    assert len(node.requests) == 3
+
+
+class StubDescriptorWallet:
+    '''
+    The watch-only descriptor wallet of a StubNode. Like the wallet of a node, it only sees outputs paid to
+    addresses in the ranges of its descriptors, and importing a descriptor rescans all transactions.
+    '''
+    def __init__(self, node: StubNode, bip84_path: wallet.Bip44Path):
+        self.bip84_path = bip84_path
+        self.created = False
+        self.loaded = False
+        # (xpub, change) -> end of the imported range
+        self.ranges = {}
+        # (xpub, change, end of the range) per imported descriptor
+        self.imports = []
+        # dicts of txid, hex, outputs as (account, change, index, value), confirmations
+        self.txs = []
+        self.spent = set()
+        # address -> (account, change, index)
+        self.paths = {}
+        node.methods.update({
+            "loadwallet": self.loadwallet,
+            "createwallet": self.createwallet,
+            "listdescriptors": self.listdescriptors,
+            "getdescriptorinfo": lambda params: {"checksum": "abcd1234"},
+            "importdescriptors": self.importdescriptors,
+            "listtransactions": self.listtransactions,
+            "listunspent": self.listunspent,
+            "getaddressinfo": self.getaddressinfo,
+            "gettransaction": self.gettransaction,
+        })
+
+    def xpub(self, account_i):
+        return discovery._descriptor_xpub(self.bip84_path.account_xpub(account_i))
+
+    def address(self, account_i, change, index) -> str:
+        address = str(self.bip84_path.derive_range(account_i, change, index, 1)[0].address)
+        self.paths[address] = (account_i, change, index)
+        return address
+
+    def pay(self, payments, spends=(), confirmations=1) -> str:
+        """
+        @payments: list of (account, change, index, value)
+        @spends: list of (txid, vout)
+        """
+        vin = [CMutableTxIn(COutPoint(lx(txid), n)) for txid, n in spends] or \
+            [CMutableTxIn(COutPoint(), CScript([len(self.txs) + 1]))]
+        tx = CMutableTransaction(vin, [CMutableTxOut(value, CBitcoinAddress(self.address(account_i, change, index)).to_scriptPubKey())
+                                       for account_i, change, index, value in payments])
+        txid = b2lx(tx.GetTxid())
+        self.txs.append({"txid": txid, "hex": tx.serialize().hex(), "outputs": list(payments),
+                         "confirmations": confirmations})
+        self.spent.update(spends)
+        return txid
+
+    def visible(self, account_i, change, index):
+        return index <= self.ranges.get((self.xpub(account_i), change), -1)
+
+    def check_loaded(self):
+        if not self.loaded:
+            raise StubError(fullnode.RPC_WALLET_NOT_FOUND, "Requested wallet does not exist or is not loaded")
+
+    def loadwallet(self, params):
+        if self.loaded:
+            raise StubError(fullnode.RPC_WALLET_ALREADY_LOADED, "Wallet already loaded")
+        if not self.created:
+            raise StubError(fullnode.RPC_WALLET_NOT_FOUND, "Wallet file not found")
+        self.loaded = True
+        return {"name": params[0]}
+
+    def createwallet(self, params):
+        self.created = self.loaded = True
+        return {"name": params[0]}
+
+    def listdescriptors(self, params):
+        self.check_loaded()
+        return {"descriptors": [{"desc": "wpkh({}/{}/*)#zzzzzzzz".format(xpub, change), "range": [0, end]}
+                                for (xpub, change), end in self.ranges.items()]}
+
+    def importdescriptors(self, params):
+        self.check_loaded()
+        results = []
+        for request in params[0]:
+            match = discovery.RANGED_DESCRIPTOR_PATTERN.search(request["desc"])
+            xpub, change, end = match.group(1), int(match.group(2)), request["range"][1]
+            self.ranges[(xpub, change)] = end
+            self.imports.append((xpub, change, end))
+            results.append({"success": True})
+        return results
+
+    def listtransactions(self, params):
+        self.check_loaded()
+        entries = [{"address": self.address(account_i, change, index), "category": "receive",
+                    "txid": tx["txid"], "vout": n, "amount": value / 1e8, "confirmations": tx["confirmations"]}
+                   for tx in self.txs
+                   for n, (account_i, change, index, value) in enumerate(tx["outputs"])
+                   if self.visible(account_i, change, index)]
+        _, count, skip, _ = params
+        end = len(entries) - skip
+        return entries[max(0, end - count):max(0, end)]
+
+    def listunspent(self, params):
+        self.check_loaded()
+        minconf = params[0]
+        return [{"txid": tx["txid"], "vout": n, "address": self.address(account_i, change, index),
+                 "amount": value / 1e8}
+                for tx in self.txs if tx["confirmations"] >= minconf
+                for n, (account_i, change, index, value) in enumerate(tx["outputs"])
+                if (tx["txid"], n) not in self.spent and self.visible(account_i, change, index)]
+
+    def getaddressinfo(self, params):
+        self.check_loaded()
+        account_i, change, index = self.paths[params[0]]
+        return {"address": params[0],
+                "desc": "wpkh([d34db33f/{}/{}]02aa)#qqqqqqqq".format(change, index),
+                "parent_desc": "wpkh({}/{}/*)#zzzzzzzz".format(self.xpub(account_i), change)}
+
+    def gettransaction(self, params):
+        self.check_loaded()
+        tx = next(tx for tx in self.txs if tx["txid"] == params[0])
+        received = sum(value for account_i, change, index, value in tx["outputs"]
+                       if self.visible(account_i, change, index))
+        return {"txid": tx["txid"], "hex": tx["hex"], "amount": received / 1e8,
+                "confirmations": tx["confirmations"]}
+
+
+@pytest.fixture
+def node_wallet(node, monkeypatch):
+    monkeypatch.setattr(Config, "ChainBackend", BACKEND_FULLNODE)
+    monkeypatch.setattr(Config, "GapLimit", 5)
+    monkeypatch.setattr(Config, "FullNodeScanRange", 20)
+    return StubDescriptorWallet(node, wallet.Bip44Path(SEED, 84, 0))
+
+
+def test_first_discovery_imports_descriptors(node_wallet):
+    funding = node_wallet.pay([(0, 0, 3, 50000)])
+    node_wallet.pay([(0, 1, 1, 1200)])
+    # Spent down to nothing, still used.
+    node_wallet.pay([(0, 0, 4, 700)], spends=[(funding, 0)])
+
+    path = node_wallet.bip84_path
+    result = discovery.discover_bip84_wallet_fullnode(SEED, 5, path)
+    assert node_wallet.created
+    assert result.last_receive_address_index == [4]
+    assert result.last_change_address_index == [1]
+    assert [len(addresses) for addresses in result.receive_addresses] == [4 + 5 + 1]
+    assert [len(addresses) for addresses in result.change_addresses] == [1 + 5 + 1]
+    # Both chains of the used account and of the next one, which is unused, with the whole chain rescanned.
+    assert sorted(node_wallet.imports) == sorted(
+        [(node_wallet.xpub(account_i), change, 19) for account_i in (0, 1) for change in (0, 1)])
+
+    # The node wallet keeps them: the next discovery imports nothing.
+    imports = len(node_wallet.imports)
+    assert discovery.discover_bip84_wallet_fullnode(SEED, 5, path).last_receive_address_index == [4]
+    assert len(node_wallet.imports) == imports
+
+
+def test_used_index_near_range_end_reimports_larger_range(node_wallet):
+    node_wallet.pay([(0, 0, 17, 1000)])
+    # Past the first range, within the gap limit of index 17.
+    node_wallet.pay([(0, 0, 21, 2000)])
+
+    result = discovery.discover_bip84_wallet_fullnode(SEED, 5, node_wallet.bip84_path)
+    xpub = node_wallet.xpub(0)
+    assert (xpub, 0, 19) in node_wallet.imports
+    # 17 + 5 + 1 addresses don't fit in the 20 of the first range, which doubles.
+    assert (xpub, 0, 39) in node_wallet.imports
+    assert node_wallet.ranges[(xpub, 0)] == 39
+    assert node_wallet.ranges[(xpub, 1)] == 19
+    assert result.last_receive_address_index == [21]
+    assert len(result.receive_addresses[0]) == 21 + 5 + 1
+
+
+def test_fullnode_last_indexes(node_wallet):
+    node_wallet.pay([(0, 0, 2, 1000), (1, 1, 6, 500)])
+    node_wallet.created = node_wallet.loaded = True
+    node_wallet.importdescriptors([[{"desc": "wpkh({}/{}/*)".format(node_wallet.xpub(account_i), change),
+                                     "range": [0, 19]} for account_i in (0, 1, 2) for change in (0, 1)]])
+    assert discovery._fullnode_last_indexes("w", [node_wallet.xpub(account_i) for account_i in (0, 1, 2)]) == \
+        [[2, -1], [-1, 6], [-1, -1]]
+    # Addresses of accounts not asked for are left out.
+    assert discovery._fullnode_last_indexes("w", [node_wallet.xpub(0)]) == [[2, -1]]
+
+
+def test_sync_merges_payment_past_known_addresses(node_wallet):
+    node_wallet.pay([(0, 0, 0, 10000)])
+    w = wallet.Wallet(SEED)
+    w.discover()
+    assert w.last_receive_address_index == [0]
+    assert len(w.receive_addresses[0]) == 6
+    imports = len(node_wallet.imports)
+
+    # Paid beyond the addresses the wallet knows, but within the imported range.
+    txid = node_wallet.pay([(0, 0, 9, 3000)])
+    pending = node_wallet.pay([(0, 1, 0, 400)], confirmations=0)
+    assert w.sync_addresses()
+    assert w.last_receive_address_index == [9]
+    assert len(w.receive_addresses[0]) == 9 + 5 + 1
+    assert w.receive_addresses[0][9].last_seen_txid == txid
+    assert w.balance == 10000 + 3000
+    assert w.mempool_txids == {pending}
+    assert w.mempool_tx_map[pending].value == 400
+    assert w.mempool_tx_map[pending].vout_addresses == [w.change_addresses[0][0]]
+    assert len(node_wallet.imports) == imports
+
+    # The node restarted without loading the wallet.
+    node_wallet.loaded = False
+    node_wallet.txs[-1]["confirmations"] = 1
+    assert w.sync_addresses()
+    assert w.mempool_txids == set()
+    assert w.balance == 10000 + 3000 + 400
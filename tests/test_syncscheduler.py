@@ -0,0 +1,134 @@
+import threading
+import time
+
+from syncscheduler import SyncScheduler
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def scheduler(max_concurrent=1, load_retry_delay=1000, load_retry_max_delay=1000) -> SyncScheduler:
+    # Nothing is due again within a test unless bumped.
+    return SyncScheduler(max_concurrent, 1000, 1000, load_retry_delay, load_retry_max_delay)
+
+
+class Recorder:
+    '''
+    Functions for the scheduler that record their calls, in order, and block while release is cleared.
+    '''
+    def __init__(self):
+        self.calls = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def function(self, name, result=True):
+        def call():
+            self.calls.append(name)
+            self.release.wait(5)
+            return result
+        return call
+
+
+def test_load_runs_before_sync_and_is_retried_with_backoff():
+    s = scheduler(load_retry_delay=0.1, load_retry_max_delay=0.15)
+    load_times = []
+
+    def load():
+        load_times.append(time.time())
+        if len(load_times) < 4:
+            raise ValueError("node down")
+    recorder = Recorder()
+    first_run = s.add_wallet(1, recorder.function("sync"), load)
+    wait_for(lambda: s.load_error(1) == "node down")
+    assert not s.loaded(1)
+    assert first_run == 1
+    assert not s.wait(1, first_run, 0)
+    # Tasks and bumps wait for the load too.
+    task_run = s.submit(1, recorder.function("task"))
+    s.bump(1)
+
+    wait_for(lambda: s.loaded(1))
+    assert s.load_error(1) is None
+    # Doubling from load_retry_delay, up to load_retry_max_delay.
+    delays = [later - earlier for earlier, later in zip(load_times, load_times[1:])]
+    assert delays[0] >= 0.1 and delays[1] >= 0.15 and delays[2] >= 0.15
+    # 0.4 without the cap.
+    assert delays[2] < 0.3
+
+    assert s.wait(1, task_run, 5)
+    # The bump was taken by a load, which syncs the wallet.
+    assert recorder.calls == ["task"]
+    # A later run did load it.
+    assert s.wait(1, first_run, 0)
+
+
+def test_tasks_then_bumped_then_due():
+    s = scheduler()
+    blocker = threading.Event()
+    s.add_wallet(0, lambda: True, lambda: blocker.wait(5))
+    wait_for(lambda: s.stats()["running"] == 1)
+
+    recorder = Recorder()
+    s.add_wallet(1, recorder.function("due"))
+    s.add_wallet(2, recorder.function("bumped"))
+    s.bump(2)
+    s.add_wallet(3, recorder.function("sync 3"))
+    s.submit(3, recorder.function("task"))
+    blocker.set()
+
+    wait_for(lambda: len(recorder.calls) == 3)
+    assert recorder.calls == ["task", "bumped", "due"]
+
+
+def test_max_concurrent():
+    s = scheduler(max_concurrent=2)
+    recorder = Recorder()
+    recorder.release.clear()
+    for wallet_id in range(4):
+        s.add_wallet(wallet_id, recorder.function(wallet_id))
+
+    wait_for(lambda: len(recorder.calls) == 2)
+    time.sleep(0.1)
+    assert len(recorder.calls) == 2
+    assert s.stats()["running"] == 2
+
+    recorder.release.set()
+    wait_for(lambda: len(recorder.calls) == 4)
+    assert sorted(recorder.calls) == [0, 1, 2, 3]
+
+
+def test_wait_run_numbers():
+    s = scheduler()
+    recorder = Recorder()
+    results = [True, False, True, True]
+
+    def sync():
+        recorder.calls.append("sync")
+        recorder.release.wait(5)
+        return results.pop(0)
+    first_run = s.add_wallet(1, sync)
+    assert first_run == 1
+    assert s.wait(1, first_run, 5)
+
+    # A bumped sync that skips syncing.
+    run = s.bump(1)
+    assert run == 2
+    assert not s.wait(1, run, 5)
+
+    run = s.submit(1, recorder.function("task"))
+    assert run == 3
+    assert s.wait(1, run, 5)
+
+    # Bumped while a run is in progress: the next run syncs.
+    recorder.release.clear()
+    assert s.bump(1) == 4
+    wait_for(lambda: s.stats()["running"] == 1)
+    assert s.bump(1) == 5
+    assert not s.wait(1, 5, 0.1)
+    recorder.release.set()
+    assert s.wait(1, 5, 5)
+    assert recorder.calls == ["sync", "sync", "task", "sync", "sync"]
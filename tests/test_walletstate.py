@@ -0,0 +1,103 @@
+import discovery
+import wallet
+import walletstate
+
+SEED = b"\x61" * 64
+
+
+def discovered_wallet() -> wallet.Wallet:
+    w = wallet.Wallet(SEED)
+    path = wallet.Bip44Path(SEED, 84, 0)
+    receive_addresses, change_addresses = [], []
+    for account_i in range(2):
+        for addresses, change, count in ((receive_addresses, 0, 8), (change_addresses, 1, 4)):
+            addresses.append([wallet.Address(change == 1, derived.address_index, account_i, derived.address, 0,
+                                             str(derived.address))
+                              for derived in path.derive_range(account_i, change, 0, count)])
+    w._merge_discover_result(discovery.DiscoverWalletResult(receive_addresses, [2, -1], change_addresses, [0, -1]))
+    return w
+
+
+def synced_wallet() -> wallet.Wallet:
+    w = discovered_wallet()
+    receive, change = w.receive_addresses[0], w.change_addresses[0]
+
+    paid = wallet.AddressDelta(receive[2])
+    paid.last_seen_txid = "11" * 32
+    paid.esplora_fingerprint = (2, 7000, 0, 1, 0, 500)
+    paid.created_utxos = [wallet.UnspentOutput("11" * 32, 0, 5000, receive[2].address),
+                          wallet.UnspentOutput("12" * 32, 1, 2000, receive[2].address)]
+    paid.mempool_txids = {"22" * 32}
+    spent = wallet.AddressDelta(change[0])
+    spent.last_seen_txid = "13" * 32
+    spent.electrum_status = "ab" * 32
+    w._apply_deltas([paid, spent])
+
+    mempool_tx = wallet.WalletMempoolTransaction("22" * 32)
+    mempool_tx.value = -1500
+    mempool_tx.vin_addresses = [receive[2]]
+    mempool_tx.vout_addresses = [change[1]]
+    w._add_mempool_txs([mempool_tx])
+
+    # As after sending it.
+    w.unspent_outputs_map[w._utxo_key("12" * 32, 1)].sent = True
+    receive[2].last_synced = 1234.5
+    w.last_sync = 1300.0
+    return w
+
+
+def address_state(w: wallet.Wallet):
+    return [(address.account_no, address.is_change, address.address_index, address.address_string,
+             address.script_pubkey, address.balance, address.last_seen_txid, address.esplora_fingerprint,
+             address.electrum_status, address.last_synced)
+            for addresses in w.receive_addresses + w.change_addresses for address in addresses]
+
+
+def test_snapshot_round_trip():
+    w = synced_wallet()
+    walletstate.save_snapshot(24, w.read_state(w.state_snapshot))
+    restored = wallet.Wallet(SEED)
+    restored.restore_state(walletstate.load_snapshot(24))
+
+    assert restored.balance == w.balance == 7000
+    assert restored.last_sync == 1300.0
+    assert restored.watermarks() == w.watermarks() == [(2, 0), (-1, -1)]
+    assert address_state(restored) == address_state(w)
+    # A tuple again after the JSON round trip, so that it compares equal to a fresh one.
+    assert restored.receive_addresses[0][2].esplora_fingerprint == (2, 7000, 0, 1, 0, 500)
+    assert restored.addresses_map.keys() == w.addresses_map.keys()
+    assert restored.script_pubkey_map.keys() == w.script_pubkey_map.keys()
+    assert all(restored.script_pubkey_map[script_pubkey] is restored.addresses_map[address.address_string]
+               for script_pubkey, address in w.script_pubkey_map.items())
+
+    assert sorted((utxo_key, utxo.value, str(utxo.address), utxo.sent)
+                  for utxo_key, utxo in restored.unspent_outputs_map.items()) == \
+        sorted((utxo_key, utxo.value, str(utxo.address), utxo.sent) for utxo_key, utxo in w.unspent_outputs_map.items())
+    assert restored.unspent_outputs_map[restored._utxo_key("12" * 32, 1)].sent
+    assert not restored.unspent_outputs_map[restored._utxo_key("11" * 32, 0)].sent
+    # Outputs find their address.
+    assert all(restored.find_address(utxo.address) is restored.receive_addresses[0][2]
+               for utxo in restored.unspent_outputs_map.values())
+
+    assert restored.mempool_txids == {"22" * 32}
+    mempool_tx = restored.mempool_tx_map["22" * 32]
+    assert mempool_tx.value == -1500
+    assert mempool_tx.vin_addresses == [restored.receive_addresses[0][2]]
+    assert mempool_tx.vout_addresses == [restored.change_addresses[0][1]]
+
+
+def test_snapshot_replaced_with_new_version():
+    w = synced_wallet()
+    version = walletstate.save_snapshot(25, w.read_state(w.state_snapshot))
+    assert walletstate.save_snapshot(25, discovered_wallet().state_snapshot()) == version + 1
+    assert walletstate.load_snapshot(25)["balance"] == 0
+
+
+def test_snapshot_in_another_format_is_ignored(monkeypatch):
+    w = synced_wallet()
+    monkeypatch.setattr(walletstate, "SNAPSHOT_FORMAT", walletstate.SNAPSHOT_FORMAT - 1)
+    walletstate.save_snapshot(26, w.read_state(w.state_snapshot))
+    assert walletstate.load_snapshot(26) is not None
+    monkeypatch.undo()
+    assert walletstate.load_snapshot(26) is None
+    assert walletstate.load_snapshot(27) is None
@@ -0,0 +1,107 @@
+import threading
+import time
+
+import pytest
+from bitcoin.core import CMutableTransaction, CMutableTxIn, CMutableTxOut, COutPoint, CScript, b2lx
+
+import discovery
+import wallet
+import zmqnotify
+from syncscheduler import SyncScheduler
+
+zmq = pytest.importorskip("zmq")
+
+SEED = b"\x41" * 64
+WALLET_ID = 7
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def tx_paying(script_pubkey: bytes, value: int, nonce: int) -> CMutableTransaction:
+    return CMutableTransaction([CMutableTxIn(COutPoint(), CScript([nonce]))],
+                               [CMutableTxOut(value, CScript(script_pubkey))])
+
+
+class RecordingWallet(wallet.Wallet):
+    '''
+    Records the syncs instead of asking a chain backend, and holds them until release is set.
+    '''
+    def __init__(self, seed):
+        super().__init__(seed)
+        self.release = threading.Event()
+        # (thread name, addresses) per sync
+        self.syncs = []
+        self.sync_result = True
+
+    def sync_addresses(self, addresses=None) -> bool:
+        self.syncs.append((threading.current_thread().name, set(addresses)))
+        self.release.wait(5)
+        return self.sync_result
+
+
+@pytest.fixture
+def publisher():
+    socket = zmq.Context.instance().socket(zmq.PUB)
+    port = socket.bind_to_random_port("tcp://127.0.0.1")
+    yield socket, "tcp://127.0.0.1:{}".format(port)
+    socket.close(linger=0)
+
+
+def test_rawtx_and_hashblock(publisher):
+    socket, endpoint = publisher
+    path = wallet.Bip44Path(SEED, 84, 0)
+    receive = [wallet.Address(False, derived.address_index, 0, derived.address, 0)
+               for derived in path.derive_range(0, 0, 0, 3)]
+    w = RecordingWallet(SEED)
+    w._merge_discover_result(discovery.DiscoverWalletResult([receive], [-1], [[]], [-1]))
+
+    scheduler = SyncScheduler(1, 1000, 1000, 1, 1)
+    scheduler.add_wallet(WALLET_ID, lambda: None)
+    subscriber = zmqnotify.ZmqSubscriber(endpoint, endpoint, 0, scheduler)
+    subscriber.add_wallet(WALLET_ID, w)
+
+    sequence = [0]
+
+    def publish(topic: bytes, body: bytes):
+        socket.send_multipart([topic, body, sequence[0].to_bytes(4, "little")])
+        sequence[0] += 1
+
+    # Subscriptions take a moment to reach the publisher, so publish until one gets through.
+    unrelated = tx_paying(b"\x00\x14" + b"\x01" * 20, 1000, 0).serialize()
+    while subscriber.tx_count == 0:
+        publish(b"rawtx", unrelated)
+        time.sleep(0.05)
+    assert len(w.mempool_txids) == 0
+
+    tx = tx_paying(receive[1].script_pubkey, 5000, 1)
+    publish(b"rawtx", tx.serialize())
+    wait_for(lambda: b2lx(tx.GetTxid()) in w.mempool_txids)
+    assert w.mempool_tx_map[b2lx(tx.GetTxid())].value == 5000
+    assert w.last_notified > 0
+
+    publish(b"hashblock", b"\x00" * 32)
+    wait_for(lambda: len(w.syncs) == 1)
+    thread_name, addresses = w.syncs[0]
+    assert thread_name == "syncscheduler"
+    assert addresses == {receive[1]}
+
+    # The ZMQ thread keeps applying transactions while the block sync runs.
+    other_tx = tx_paying(receive[2].script_pubkey, 700, 2)
+    publish(b"rawtx", other_tx.serialize())
+    wait_for(lambda: b2lx(other_tx.GetTxid()) in w.mempool_txids)
+    assert not w.release.is_set()
+    w.release.set()
+    wait_for(lambda: scheduler.stats()["running"] == 0)
+
+    # A sync skipped because another one was in progress leaves its addresses for the next block.
+    w.sync_result = False
+    publish(b"hashblock", b"\x01" * 32)
+    wait_for(lambda: len(w.syncs) == 2)
+    wait_for(lambda: len(subscriber._touched.get(w, set())) > 0)
+    assert subscriber._touched[w] == {receive[2]}
+    assert subscriber.block_count == 2
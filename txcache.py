@@ -0,0 +1,122 @@
+import sqlite3
+import os
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+'''
+Confirmed transactions keyed by txid, as returned by Esplora's GET /tx/:txid. The content of a
+transaction never changes once it is confirmed, so they are kept in the database, with the most
+recently used ones in memory. Unconfirmed transactions are never cached.
+'''
+
+SQLITE_DB_FILE = os.path.dirname(
+    os.path.realpath(__file__)) + "/data/wallets.db"
+
+def create_tables(cursor: sqlite3.Cursor):
+    cursor.execute("CREATE TABLE IF NOT EXISTS Transactions (txid TEXT PRIMARY KEY, tx_json TEXT NOT NULL)")
+
+class TransactionCache:
+    def __init__(self, max_entries: int, flush_batch_size: int = 256):
+        """
+        @max_entries: transactions kept in memory. The least recently used one is evicted first.
+        @flush_batch_size: transactions are written to the database in batches of this size,
+                           or when flush() is called.
+        """
+        self._max_entries = max_entries
+        self._flush_batch_size = flush_batch_size
+
+        # txid -> parsed tx JSON
+        self._entries: OrderedDict = OrderedDict()
+        # Transactions not written to the database yet.
+        self._unflushed: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        self._tables_created = False
+
+        self.hits = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(SQLITE_DB_FILE)
+        if not self._tables_created:
+            create_tables(conn.cursor())
+            conn.commit()
+            self._tables_created = True
+        return conn
+
+    def _put_entry(self, txid: str, tx_json: dict):
+        # Caller must hold self._lock
+        self._entries[txid] = tx_json
+        self._entries.move_to_end(txid)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def get(self, txid: str) -> dict:
+        """
+        @return: the tx JSON, or None if the transaction is unknown or not confirmed.
+        """
+        with self._lock:
+            tx_json = self._entries.get(txid)
+            if tx_json is None:
+                tx_json = self._unflushed.get(txid)
+            if tx_json is not None:
+                self._put_entry(txid, tx_json)
+                self.hits += 1
+                return tx_json
+
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT tx_json FROM Transactions WHERE txid = ?", (txid,))
+            row = cursor.fetchone()
+
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            tx_json = json.loads(row[0])
+            self._put_entry(txid, tx_json)
+            self.hits += 1
+            return tx_json
+
+    def put(self, tx_json: dict):
+        """
+        Cache a transaction if it is confirmed.
+        """
+        if not tx_json["status"]["confirmed"]:
+            return
+
+        txid = tx_json["txid"]
+        flush = False
+        with self._lock:
+            if txid not in self._entries:
+                self._unflushed[txid] = tx_json
+                flush = len(self._unflushed) >= self._flush_batch_size
+            self._put_entry(txid, tx_json)
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Write cached transactions to the database.
+        """
+        with self._lock:
+            if len(self._unflushed) == 0:
+                return
+            tx_jsons = self._unflushed
+            self._unflushed = {}
+
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("INSERT OR IGNORE INTO Transactions (txid, tx_json) VALUES (?,?)",
+                               [(txid, json.dumps(tx_json)) for txid, tx_json in tx_jsons.items()])
+            conn.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "unflushed": len(self._unflushed),
+            }
@@ -5,6 +5,11 @@ import bitcoin
 import logging
 import os
 import discovery
+import walletcache
+import walletstate
+import zmqnotify
+import syncscheduler
+import threading
 from wallet import Wallet, UnspentOutput
 from config import Config
 
@@ -33,8 +38,8 @@ class WalletMempoolTransactionView():
         self.value = value
 
 class UnspentOutputView():
-    def __init__(self, unspent_output: UnspentOutput):
-        self.bitcoin_address = str(unspent_output.address)
+    def __init__(self, unspent_output: UnspentOutput, bitcoin_address: str):
+        self.bitcoin_address = bitcoin_address
         self.omitted_bitcoin_address = self.bitcoin_address[0:4] + \
             "..." + self.bitcoin_address[-4:]
         self.formatted_value = '{:,}'.format(unspent_output.value)
@@ -51,6 +56,14 @@ class WalletView():
         self.label = label
 
     def _loadwallet(self, wallet: Wallet, show_zero_balance: int = 0):
+        # Never a state in the middle of a sync.
+        wallet.read_state(lambda: self._readwallet(wallet, show_zero_balance))
+
+    def _readwallet(self, wallet: Wallet, show_zero_balance: int):
+        # False until the first discovery and sync are done.
+        self.loaded = syncscheduler.gSyncScheduler.loaded(self.wallet_id)
+        # Why loading failed, while it waits to be tried again.
+        self.load_error = syncscheduler.gSyncScheduler.load_error(self.wallet_id)
         self.balance = wallet.balance
         self.formatted_balance = '{:,}'.format(wallet.balance)
 
@@ -61,15 +74,16 @@ class WalletView():
                 "/{}/{}".format(1 if addr.is_change else 0, addr.address_index)
             if addr.balance != 0:
                 self.addresses.append(AddressView(
-                    str(addr.address), addr.balance, addr.is_change, derivation_path))
+                    addr.address_string, addr.balance, addr.is_change, derivation_path))
             elif show_zero_balance == 1:
                 self.addresses.append(AddressView(
-                    str(addr.address), addr.balance, addr.is_change, derivation_path))
+                    addr.address_string, addr.balance, addr.is_change, derivation_path))
         self.addresses.sort(key=lambda addr: addr.derivation_path.split("/"))
 
         self.unspent_outputs = [] 
         for unspent_output in wallet.unspent_outputs_map.values():
-            self.unspent_outputs.append(UnspentOutputView(unspent_output))     
+            self.unspent_outputs.append(UnspentOutputView(
+                unspent_output, wallet.find_address(unspent_output.address).address_string))
         self.unspent_outputs.sort(
             key=lambda unspent_output: (unspent_output.bitcoin_address, unspent_output.txid, unspent_output.vout))
 
@@ -79,6 +93,7 @@ class WalletView():
                 WalletMempoolTransactionView(mempool_tx.txid, mempool_tx.value))
     
 gWalletMap: Dict[int, Tuple[WalletView, Wallet]]={}
+gWalletMapLock = threading.Lock()
 
 def addwallet(nemonic: str, label: str) -> bool:
     assert validate_nemonic(nemonic) == None
@@ -92,20 +107,34 @@ def addwallet(nemonic: str, label: str) -> bool:
 
 def newaddress(wallet_id: int) -> str:
     wallet: Wallet = gWalletMap[wallet_id][1]
+    # Only a discovered wallet knows which addresses are unused.
+    assert syncscheduler.gSyncScheduler.loaded(wallet_id), "Wallet is still loading."
     assert len(wallet.receive_addresses) > 0, "Account 0 must be present."
     
     last_index = wallet.last_receive_address_index[0]
-    return str(wallet.receive_addresses[0][last_index+1].address)
+    return wallet.receive_addresses[0][last_index+1].address_string
 
 def viewwallet(wallet_id: int, show_zero_balance) -> WalletView:
-    # Return the wallet from the cache if found.
-    if wallet_id in gWalletMap.keys():
-        wallet = gWalletMap[wallet_id][1]
+    """
+    Return the wallet as last synced. A wallet that is not loaded yet is loaded in the background, and
+    this waits up to Config.SyncWaitTimeout for it.
+    """
+    with gWalletMapLock:
+        loading = wallet_id not in gWalletMap.keys()
+        if loading:
+            load_run = _addwallet(wallet_id)
+        wallet_view, wallet = gWalletMap[wallet_id]
 
-        wallet_view = gWalletMap[wallet_id][0]
-        wallet_view._loadwallet(wallet, show_zero_balance)
-        return wallet_view
+    if loading:
+        syncscheduler.gSyncScheduler.wait(wallet_id, load_run, Config.SyncWaitTimeout)
+    wallet_view._loadwallet(wallet, show_zero_balance)
+    return wallet_view
 
+def _addwallet(wallet_id: int) -> int:
+    """
+    Add the wallet to gWalletMap and have the sync scheduler load it.
+    @return: the scheduler run loading it.
+    """
     # Load from the database
     with sqlite3.connect(SQLITE_DB_FILE) as conn:
         cursor = conn.cursor()
@@ -114,19 +143,105 @@ def viewwallet(wallet_id: int, show_zero_balance) -> WalletView:
         assert row is not None
 
         wallet_id, network, mnemonic, label = row
-        seed = Mnemonic.to_seed(mnemonic)
-        wallet = Wallet(seed)
-        wallet.discover()
+
+    # The seed (PBKDF2 over the mnemonic) is only computed if a private key or an
+    # account that is not in the cache has to be derived.
+    wallet = Wallet(lambda: Mnemonic.to_seed(mnemonic))
+    cached_addresses = walletcache.load_addresses(wallet_id)
+    wallet.load_derivation_cache(walletcache.load_account_xpubs(wallet_id), cached_addresses)
+    gCachedAddressCount[wallet_id] = len(cached_addresses)
+
+    # Only addresses after the watermarks saved by the last discovery are checked.
+    watermarks = walletcache.load_watermarks(wallet_id)
+    gSavedWatermarks[wallet_id] = watermarks
+
+    def load():
+        snapshot = walletstate.load_snapshot(wallet_id)
+        if snapshot is not None:
+            # Shown right away, and synced incrementally by the next run.
+            wallet.restore_state(snapshot)
+            gSavedStateVersions[wallet_id] = wallet.state_version
+            syncscheduler.gSyncScheduler.submit(wallet_id, incremental_sync)
+        else:
+            wallet.discover(watermarks if len(watermarks) > 0 else None)
+            wallet.sync_addresses()
+            save_wallet_cache(wallet_id, wallet)
+        if zmqnotify.enabled():
+            zmqnotify.add_wallet(wallet_id, wallet)
+
+    def sync() -> bool:
+        synced = wallet.request_sync()
+        if synced:
+            save_wallet_cache(wallet_id, wallet)
+        return synced
+
+    def incremental_sync():
         wallet.sync_addresses()
-        wallet_view = WalletView(wallet_id, network, label)
-        wallet_view._loadwallet(wallet, show_zero_balance)
-        gWalletMap[wallet_id] = (wallet_view, wallet)
-        return wallet_view
+        save_wallet_cache(wallet_id, wallet)
+
+    gWalletMap[wallet_id] = (WalletView(wallet_id, network, label), wallet)
+    return syncscheduler.gSyncScheduler.add_wallet(wallet_id, sync, load)
+
+# wallet id -> number of addresses in the derivation cache
+gCachedAddressCount: Dict[int, int] = {}
+# wallet id -> discovery watermarks in the database
+gSavedWatermarks: Dict[int, List[Tuple[int, int]]] = {}
+# wallet id -> Wallet.state_version of the snapshot in the database
+gSavedStateVersions: Dict[int, int] = {}
 
-def request_sync(wallet_id: int):
+def save_wallet_cache(wallet_id: int, wallet: Wallet):
+    '''
+    Store addresses derived and watermarks moved since the cache was last saved, and a snapshot of the
+    wallet state if it changed.
+    '''
+    state_version = wallet.state_version
+    if state_version != gSavedStateVersions.get(wallet_id):
+        walletstate.save_snapshot(wallet_id, wallet.read_state(wallet.state_snapshot))
+        gSavedStateVersions[wallet_id] = state_version
+
+    watermarks = wallet.watermarks()
+    if watermarks != gSavedWatermarks.get(wallet_id):
+        walletcache.save_watermarks(wallet_id, watermarks)
+        gSavedWatermarks[wallet_id] = watermarks
+
+    if len(wallet.addresses_map) == gCachedAddressCount.get(wallet_id):
+        return
+    walletcache.save_account_xpubs(wallet_id, wallet.account_xpubs())
+    rows = wallet.derivation_cache_rows()
+    walletcache.save_addresses(wallet_id, rows)
+    gCachedAddressCount[wallet_id] = len(rows)
+
+def request_sync(wallet_id: int, wait: bool = False) -> bool:
+    '''
+    Ask the sync scheduler to sync the wallet next. Cheap, the sync happens in the background. The sync is
+    still skipped if Wallet.request_sync finds nothing may have changed.
+    @wait: wait up to Config.SyncWaitTimeout for the sync to be done.
+    @return: with wait, False if waiting timed out or the sync was skipped.
+    '''
+    assert wallet_id in gWalletMap.keys()
+    run = syncscheduler.gSyncScheduler.bump(wallet_id)
+    if wait:
+        return syncscheduler.gSyncScheduler.wait(wallet_id, run, Config.SyncWaitTimeout)
+    return True
+
+def rescan_wallet(wallet_id: int, wait: bool = False) -> bool:
+    '''
+    Discover the wallet from index 0, ignoring the saved watermarks. For recovery, e.g. when the wallet
+    was used elsewhere beyond the gap limit of the saved watermarks. Runs on the sync scheduler.
+    @wait: wait up to Config.SyncWaitTimeout for the rescan to be done.
+    @return: with wait, False if waiting timed out or the rescan failed.
+    '''
     assert wallet_id in gWalletMap.keys()
     wallet = gWalletMap[wallet_id][1]
-    wallet.request_sync()
+
+    def rescan():
+        wallet.discover()
+        save_wallet_cache(wallet_id, wallet)
+
+    run = syncscheduler.gSyncScheduler.submit(wallet_id, rescan)
+    if wait:
+        return syncscheduler.gSyncScheduler.wait(wallet_id, run, Config.SyncWaitTimeout)
+    return True
 
 '''
 return None if nemonic is valid, otherwise error message.
@@ -1,8 +1,9 @@
 from bitcoin.core.serialize import Hash160
-from bitcoin.wallet import CBitcoinAddress, P2PKHBitcoinAddress, P2SHBitcoinAddress, P2WPKHBitcoinAddress, CKey
-from bitcoin.core import COutPoint, CTransaction, lx, CTxIn, CTxOut, CMutableTransaction, CTxInWitness, CScriptWitness, CTxWitness
-from bitcoin.core.script import OP_0, OP_CHECKSIG, OP_DUP, OP_EQUAL, OP_EQUALVERIFY, OP_HASH160, CScript, SignatureHash, SIGHASH_ALL, SIGVERSION_WITNESS_V0
-from typing import List, Set, Dict
+from bitcoin.wallet import CBitcoinAddress, P2PKHBitcoinAddress, P2SHBitcoinAddress, P2WPKHBitcoinAddress
+from bitcoin.core import COutPoint, CTransaction, lx, b2lx, CTxIn, CTxOut, CMutableTransaction, CTxInWitness, CScriptWitness, CTxWitness
+from bitcoin.core.script import OP_0, OP_CHECKSIG, OP_DUP, OP_EQUAL, OP_EQUALVERIFY, OP_HASH160, CScript
+from typing import List, Set, Dict, Tuple, Callable
+from contextlib import contextmanager
 from bitcoin import bitcoin
 from bip32 import BIP32, HARDENED_INDEX
 import hashlib
@@ -11,51 +12,76 @@ import logging
 import requests
 import discovery
 import time
-from concurrent.futures import as_completed
+import threading
+import multiprocessing
+from concurrent.futures import as_completed, ProcessPoolExecutor
 import esplora
 import fullnode
+import derivation
+import signing
+import aioesplora
+import electrum
+import feerates
+import asyncio
 import math
-from config import Config
-
-'''
-
-@seed: The seed as bytes.
-@path: An example of path is m/44'/0'/0'/0/0.
-'''
+from config import Config, BACKEND_FULLNODE, BACKEND_ELECTRUM
 
 COIN = 100000000
 
-def bip32_derive_pubkey(seed: bytes, path: str) -> bytes:
-   bip32 = BIP32.from_seed(seed)
-   return bip32.get_pubkey_from_path(path)
-
-def bip32_derive_privkey(seed: bytes, path: str) -> bytes:
-    bip32 = BIP32.from_seed(seed)
-    return bip32.get_privkey_from_path(path)
-
 class Address:
-    def __init__(self, is_change, address_index, account_no, address, balance):
+    # Wallets keep an Address per derived address, so no __dict__ per instance.
+    __slots__ = ("is_change", "address_index", "address", "address_string", "script_pubkey", "account_no", "balance",
+                 "last_seen_txid", "electrum_status", "esplora_fingerprint", "last_synced")
+
+    def __init__(self, is_change, address_index, account_no, address, balance, address_string: str = None):
+        """
+        @address_string: str(address) if already known, e.g. from a cache. Encoding an address is slow.
+        """
         self.is_change: bool = is_change
         self.address_index = address_index
         self.address: CBitcoinAddress = address
+        self.address_string: str = address_string if address_string is not None else str(address)
+        # Key of Wallet.script_pubkey_map.
+        self.script_pubkey: bytes = bytes(address.to_scriptPubKey())
         self.account_no = account_no
         self.balance = balance
         self.last_seen_txid = None
+        # Status hash from the Electrum server at the last sync.
+        self.electrum_status = None
+        # esplora.address_fingerprint at the last sync.
+        self.esplora_fingerprint: Tuple = None
+        # UNIX time the address was last synced, 0 if never.
+        self.last_synced = 0.0
 
     # def empty(self):
     #     return self.last_seen_txid is None
 
 class UnspentOutput:
+    __slots__ = ("txid_bytes", "vout", "value", "address", "sent")
+
     def __init__(self, txid: str, vout: int, value, address):
-        self.txid = txid
+        # In internal byte order, as in COutPoint.
+        self.txid_bytes: bytes = lx(txid)
         self.vout = vout
         self.value = value
         self.address: CBitcoinAddress = address
         # True if a TX has been broadcasted successfully with this utxo as input.
         self.sent = False
-        self.spent = False
+
+    @property
+    def txid(self) -> str:
+        return b2lx(self.txid_bytes)
+
+    @property
+    def outpoint(self) -> Tuple[bytes, int]:
+        """
+        Key of the output in Wallet.unspent_outputs_map, same as (COutPoint.hash, COutPoint.n) of the spending input.
+        """
+        return (self.txid_bytes, self.vout)
 
 class WalletMempoolTransaction:
+    __slots__ = ("txid", "vin_addresses", "vout_addresses", "value")
+
     def __init__(self, txid):
         self.txid = txid
         # Addresses are owned.
@@ -64,31 +90,251 @@ class WalletMempoolTransaction:
         # With respect to the wallet
         self.value = 0
 
+class AddressDelta:
+    '''
+    What syncing an address found, computed without touching the wallet so that addresses can be synced
+    in parallel. Wallet._apply_deltas applies it.
+    '''
+    __slots__ = ("address", "last_seen_txid", "esplora_fingerprint", "electrum_status", "created_utxos",
+                 "spent_utxo_keys", "utxos", "mempool_txids", "confirmed_txids")
+
+    def __init__(self, address: Address):
+        self.address = address
+        self.last_seen_txid = address.last_seen_txid
+        self.esplora_fingerprint = address.esplora_fingerprint
+        self.electrum_status = address.electrum_status
+        # New unspent outputs of the address.
+        self.created_utxos: List[UnspentOutput] = []
+        # Keys of unspent outputs of the address spent since the last sync.
+        self.spent_utxo_keys: Set[Tuple[bytes, int]] = set()
+        # When not None, all unspent outputs of the address, replacing created_utxos and spent_utxo_keys.
+        self.utxos: Set[UnspentOutput] = None
+        # Transactions of the address in the mempool, and confirmed ones that may have left it.
+        self.mempool_txids: Set[str] = set()
+        self.confirmed_txids: Set[str] = set()
+
+class DerivedAddress:
+    __slots__ = ("address_index", "pubkey", "script_pubkey", "address", "address_string")
+
+    def __init__(self, address_index, pubkey, script_pubkey, address, address_string: str = None):
+        self.address_index = address_index
+        # None if loaded from the cache.
+        self.pubkey: bytes = pubkey
+        self.script_pubkey: CScript = script_pubkey
+        self.address: P2WPKHBitcoinAddress = address
+        # str(address), None unless loaded from the cache.
+        self.address_string: str = address_string
+
+gProcessPoolExecutor: ProcessPoolExecutor = None
+gProcessPoolLock = threading.Lock()
+
+def get_process_pool() -> ProcessPoolExecutor:
+    '''
+    The pool is created on first use. Workers are spawned rather than forked since the
+    web server is multithreaded.
+    '''
+    global gProcessPoolExecutor
+    with gProcessPoolLock:
+        if gProcessPoolExecutor is None:
+            gProcessPoolExecutor = ProcessPoolExecutor(
+                Config.ProcessPoolMaxWorkers, mp_context=multiprocessing.get_context("spawn"))
+    return gProcessPoolExecutor
+
+gChainState: Tuple = None
+gChainStateCheckedAt = 0.0
+# True while a thread is getting the chain state.
+gChainStateChecking = False
+gChainStateLock = threading.Lock()
+
+def get_chain_state() -> Tuple:
+    '''
+    A cheap summary of the chain that changes with every block, and with every mempool change if
+    Config.SyncOnMempoolChange. Shared by all wallets for Config.ChainStateCheckInterval seconds. While one
+    thread gets it, the others get the previous one instead of waiting. Requests are not retried, so that a
+    backend that is down doesn't hold up syncs.
+    @return: (tip hash, mempool summary), or None if the backend could not be reached.
+    '''
+    global gChainState, gChainStateCheckedAt, gChainStateChecking
+    with gChainStateLock:
+        if gChainStateChecking or time.time() - gChainStateCheckedAt < Config.ChainStateCheckInterval:
+            return gChainState
+        gChainStateChecking = True
+
+    chain_state = None
+    try:
+        mempool = None
+        if Config.ChainBackend == BACKEND_FULLNODE:
+            tip = fullnode.getbestblockhash()
+            if Config.SyncOnMempoolChange:
+                mempool_info = fullnode.getmempoolinfo()
+                mempool = (mempool_info["size"], mempool_info["bytes"])
+        elif Config.ChainBackend == BACKEND_ELECTRUM:
+            # Electrum servers don't expose the mempool as a whole. Address statuses cover it.
+            tip = electrum.tip_hash()
+        else:
+            tip = esplora.tip_hash(retry_on_5xx=False)
+            if Config.SyncOnMempoolChange:
+                mempool_info = esplora.mempool_info(retry_on_5xx=False)
+                mempool = (mempool_info["count"], mempool_info["vsize"])
+        chain_state = (tip, mempool)
+    except Exception as e:
+        logging.warning("Failed to get the chain state: {}".format(e))
+    finally:
+        with gChainStateLock:
+            gChainState = chain_state
+            gChainStateCheckedAt = time.time()
+            gChainStateChecking = False
+    return chain_state
+
 class Bip44Path:
     # m / purpose' / coin_type' / account' / change / address_index
     def __init__(self, seed, purpose, coin_type):
+        '''
+        @seed: the seed as bytes, or a callable returning it. A callable is only invoked when
+               something has to be derived from the seed, e.g. a private key or an account
+               whose xpub is not known yet.
+        '''
         self._seed = seed
         self._purpose = purpose
         self._coin_type = coin_type
 
+        self._master: BIP32 = None
+        # account -> xpub at m / purpose' / coin_type' / account'
+        self._account_xpubs: Dict[int, str] = {}
+        # (account, change) -> extended key at m / purpose' / coin_type' / account' / change
+        self._change_nodes: Dict[Tuple[int, int], BIP32] = {}
+        # Same as _change_nodes, without the private key.
+        self._public_change_nodes: Dict[Tuple[int, int], BIP32] = {}
+        # (account, change) -> index -> DerivedAddress that were loaded from a cache.
+        self._cached_addresses: Dict[Tuple[int, int], Dict[int, DerivedAddress]] = {}
+        self._lock = threading.Lock()
+
+    def _get_master(self) -> BIP32:
+        # Caller must hold self._lock
+        if self._master is None:
+            seed = self._seed() if callable(self._seed) else self._seed
+            self._master = BIP32.from_seed(seed)
+        return self._master
+
+    def _account_path(self, account) -> str:
+        return "m/{purpose}'/{coin_type}'/{account}'".format(
+            purpose=self._purpose, coin_type=self._coin_type, account=account)
+
+    def _change_node(self, account, change: int) -> BIP32:
+        '''
+        The hardened part of the path is derived once per (account, change) and cached, so that
+        deriving an address only costs the last non-hardened step.
+        '''
+        key = (account, change)
+        node = self._change_nodes.get(key)
+        if node is not None:
+            return node
+
+        with self._lock:
+            node = self._change_nodes.get(key)
+            if node is None:
+                master = self._get_master()
+                account_path = self._account_path(account)
+                if account not in self._account_xpubs:
+                    self._account_xpubs[account] = master.get_xpub_from_path(account_path)
+                chaincode, privkey = master.get_extended_privkey_from_path(
+                    "{}/{}".format(account_path, change))
+                node = BIP32(chaincode, privkey)
+                self._change_nodes[key] = node
+        return node
+
+    def _public_change_node(self, account, change: int) -> BIP32:
+        '''
+        Derived from the account xpub when it is known, so that no seed is needed.
+        '''
+        key = (account, change)
+        node = self._public_change_nodes.get(key)
+        if node is not None:
+            return node
+
+        xpub = self._account_xpubs.get(account)
+        if xpub is not None:
+            chaincode, pubkey = BIP32.from_xpub(xpub).get_extended_pubkey_from_path([change])
+        else:
+            private_node = self._change_node(account, change)
+            chaincode, pubkey = private_node.master_chaincode, private_node.master_pubkey
+        node = BIP32(chaincode, pubkey=pubkey)
+        self._public_change_nodes[key] = node
+        return node
+
+    def account_xpub(self, account) -> str:
+        if account not in self._account_xpubs:
+            self._change_node(account, 0)
+        return self._account_xpubs[account]
+
+    def account_xpubs(self) -> Dict[int, str]:
+        '''
+        @return: xpubs of all accounts that have been derived or loaded so far.
+        '''
+        return dict(self._account_xpubs)
+
+    def load_cache(self, account_xpubs: Dict[int, str], derived_addresses: List[Tuple[int, int, DerivedAddress]]):
+        '''
+        @account_xpubs: account -> xpub
+        @derived_addresses: list of (account, change, DerivedAddress)
+        '''
+        self._account_xpubs.update(account_xpubs)
+        for account, change, derived_address in derived_addresses:
+            self._cached_addresses.setdefault((account, change), {})[
+                derived_address.address_index] = derived_address
+
     def derive_pubkey(self, account, change: int, address_index) -> bytes:
-        path = "m/{purpose}'/{coin_type}'/{account}'/{change}/{index}".format(
-            purpose=self._purpose, coin_type=self._coin_type, account=account, change=change,
-            index=address_index)
-        pubkey: bytes = bip32_derive_pubkey(self._seed, path)
+        pubkey: bytes = self._public_change_node(
+            account, change).get_pubkey_from_path([address_index])
         return pubkey
-    
+
     def derive_private_key(self, account, change: int, address_index) -> bytes:
-        path = "m/{purpose}'/{coin_type}'/{account}'/{change}/{index}".format(
-            purpose=self._purpose, coin_type=self._coin_type, account=account, change=change,
-            index=address_index)
-        privkey: bytes = bip32_derive_privkey(self._seed, path)
+        privkey: bytes = self._change_node(
+            account, change).get_privkey_from_path([address_index])
         return privkey
 
+    def derive_range(self, account, change: int, start: int, count: int) -> List[DerivedAddress]:
+        '''
+        Derive P2WPKH addresses for indexes [start, start+count). Addresses loaded by load_cache
+        are returned as is. Ranges of at least Config.DeriveRangeProcessPoolThreshold addresses
+        are split across the process pool. Only the extended public key of the change node is
+        sent to the workers.
+        '''
+        derived_addresses: List[DerivedAddress] = []
+        cached_addresses = self._cached_addresses.get((account, change), {})
+        while count > 0 and start in cached_addresses:
+            derived_addresses.append(cached_addresses[start])
+            start += 1
+            count -= 1
+        if count == 0:
+            return derived_addresses
+
+        node = self._public_change_node(account, change)
+        chaincode, pubkey = node.master_chaincode, node.master_pubkey
+
+        if count >= Config.DeriveRangeProcessPoolThreshold and Config.ProcessPoolMaxWorkers > 1:
+            chunk_size = math.ceil(count / Config.ProcessPoolMaxWorkers)
+            futures = [get_process_pool().submit(derivation.derive_pubkeys, chaincode, pubkey,
+                                                 chunk_start, min(chunk_size, start + count - chunk_start))
+                       for chunk_start in range(start, start + count, chunk_size)]
+            pubkeys: List[bytes] = []
+            for future in futures:
+                pubkeys.extend(future.result())
+        else:
+            pubkeys = derivation.derive_pubkeys(chaincode, pubkey, start, count)
+
+        for i, pubkey in enumerate(pubkeys):
+            p2wpkh = bitcoin.core.CScript([OP_0, Hash160(pubkey)])
+            p2wpkh_addr = P2WPKHBitcoinAddress.from_scriptPubKey(p2wpkh)
+            derived_addresses.append(DerivedAddress(start + i, pubkey, p2wpkh, p2wpkh_addr))
+        return derived_addresses
+
 class Wallet:
     def __init__(self, seed):
         '''
         Is Bitcoin Bech 32 P2WPKH wallet 
+
+        @seed: the seed as bytes, or a callable returning it when it is first needed.
         '''
         self.path_prefix = "m/84'/0'"
         self._bip84_path = Bip44Path(seed, 84, 0)
@@ -105,8 +351,10 @@ class Wallet:
 
         # Key is bitcoin address 
         self.addresses_map: Map[str, Address] = {}
-        # Key is txid:n, 
-        self.unspent_outputs_map: Map[str, UnspentOutput] = {}
+        # Same addresses keyed by scriptPubKey, to match transaction outputs without encoding addresses.
+        self.script_pubkey_map: Map[bytes, Address] = {}
+        # Key is UnspentOutput.outpoint, (txid in internal byte order, n).
+        self.unspent_outputs_map: Map[Tuple[bytes, int], UnspentOutput] = {}
 
         # Set of txid.
         self.mempool_txids: Set[str] = set()
@@ -114,7 +362,46 @@ class Wallet:
         self.mempool_tx_map: Map[str, WalletMempoolTransaction] = {}
 
         self.last_sync = time.time()
-        self.syncing = False
+        # get_chain_state() when the last sync started.
+        self.last_sync_chain_state: Tuple = None
+        # UNIX time of the last push notification about the wallet, e.g. from zmqnotify.
+        self.last_notified = 0.0
+        # scripthash -> address subscribed to on the Electrum server.
+        self._electrum_subscriptions: Dict[str, Address] = {}
+
+        # Held by the sync in progress, if any.
+        self._sync_lock = threading.Lock()
+        # Serializes the writers of balance, the maps and sets above and addresses. Maps and sets are
+        # replaced rather than modified, so a reader never sees one change while it iterates it.
+        self._state_lock = threading.Lock()
+        # Even when no write is in progress. See read_state.
+        self.state_version = 0
+
+    @property
+    def syncing(self) -> bool:
+        return self._sync_lock.locked()
+
+    @contextmanager
+    def _write_state(self):
+        with self._state_lock:
+            self.state_version += 1
+            try:
+                yield
+            finally:
+                self.state_version += 1
+
+    def read_state(self, read: Callable[[], object]):
+        """
+        Call read until it ran without a write in between, so that what it returns is consistent, e.g. the
+        balance with the unspent outputs. Writes are short, so it is rarely called twice.
+        """
+        while True:
+            version = self.state_version
+            if version % 2 == 0:
+                result = read()
+                if self.state_version == version:
+                    return result
+            time.sleep(0.001)
     
     def get_new_change_address(self) -> CBitcoinAddress:
         account_0_change_addresses= self.change_addresses[0]
@@ -122,68 +409,66 @@ class Wallet:
         assert account_0_last_index+1 < len(account_0_change_addresses), "No unused change addresses that are reserved?"
         return account_0_change_addresses[account_0_last_index+1].address
 
-    def _find_seckey(self, bitcoin_address: CBitcoinAddress) -> CKey:
-        address = self.addresses_map.get(str(bitcoin_address))
+    def find_address(self, bitcoin_address: CBitcoinAddress) -> Address:
+        """
+        @return: the Address of the wallet, None if it is not one of the wallet.
+        """
+        return self.script_pubkey_map.get(bitcoin_address.to_scriptPubKey())
+
+    def _find_privkey(self, bitcoin_address: CBitcoinAddress) -> bytes:
+        address = self.find_address(bitcoin_address)
         if address is None:
             return None
-        
+
         change = 1 if address.is_change else 0
-        privkey: bytes = self._bip84_path.derive_private_key(
+        return self._bip84_path.derive_private_key(
             address.account_no, change, address.address_index)
-        return CKey(privkey)
 
 
-    def sync_addresses(self):
+    def sync_addresses(self, addresses: List[Address] = None) -> bool:
         """
-        Fast update based on GET /address/:address/txs and GET /address/:address/txs/chain[/:last_seen_txid]
+        Fast update based on GET /address/:address/txs and GET /address/:address/txs/chain[/:last_seen_txid].
+        The transactions of an address are only fetched when GET /address/:address shows they changed.
 
         each address will keep track of what is the last txid that has sync up to, so that only txid after it are
         applied to UTXOs and the address balance.
-        """
-        if self.syncing:
-            return
-        self.syncing = True
 
-        futures = []
-        for account_i in range(len(self.receive_addresses)):
-            cur_receive_addresses = self.receive_addresses[account_i]
-            for index in range(0, len(cur_receive_addresses)):
-                cur_receive_address = cur_receive_addresses[index]
-                future = esplora.gThreadPoolExecutor.submit(
-                    lambda address: self.sync_address(address.address), cur_receive_address)
-                futures.append(future)
-            
-            cur_change_addresses = self.change_addresses[account_i]
-            for index in range(0, len(cur_change_addresses)):
-                cur_change_address = cur_change_addresses[index]
-                future = esplora.gThreadPoolExecutor.submit(
-                    lambda address: self.sync_address(address.address), cur_change_address)
-                futures.append(future)
+        Addresses are fetched in parallel into AddressDelta, and applied by this thread alone.
 
-        # Wait for all addresses sync to be completed
-        start = time.time()
-        for future in as_completed(futures):
-            _ = future.result()
-            pass
-        logging.debug("Sync addresses took {} ms with {} addresses.".format(int((time.time() - start)*1000), len(futures)))
+        @addresses: only sync these addresses, e.g. the ones a new transaction touches. None for the ones
+                    due, see _addresses_due.
+        @return: False if skipped because another sync is in progress.
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return False
+        try:
+            self._sync_addresses(addresses)
+        finally:
+            self._sync_lock.release()
+        return True
 
-        # In each sync_address, mempool_txids are updated as well. Sync txs in mempool for newly added txids
-        futures = []
-        for txid in self.mempool_txids:
-            if txid not in self.mempool_tx_map:
-                future = esplora.gThreadPoolExecutor.submit(
-                    lambda txid: self.sync_mempool_tx(txid), txid)
-                futures.append(future)
-        
-        # Wait for all addresses sync to be completed
+    def _sync_addresses(self, addresses: List[Address]):
+        if addresses is None:
+            addresses = self._addresses_due()
         start = time.time()
-        for future in as_completed(futures):
-            _ = future.result()
-            pass
-        logging.debug("Sync mempool took {} ms with {} txids.".format(
-            int((time.time() - start)*1000), len(futures)))
+        if Config.ChainBackend == BACKEND_FULLNODE:
+            # The node wallet tracks all addresses, so they are all synced at once anyway.
+            self._sync_addresses_fullnode()
+        elif Config.ChainBackend == BACKEND_ELECTRUM:
+            self._sync_addresses_electrum(addresses)
+        elif Config.EnableAsyncEsplora:
+            aioesplora.run(self._sync_addresses_async(addresses))
+        else:
+            self._sync_addresses_threaded(addresses)
+        for address in addresses:
+            address.last_synced = start
+
+        self._extend_addresses()
 
-        # Add more unused addresses if any unused addresses are used after the last index
+    def _extend_addresses(self):
+        # Add more unused addresses if any unused addresses are used after the last index.
+        # (addresses, last_address_index, account, updated last address index, new addresses)
+        extensions: List[Tuple[List[List[Address]], List[int], int, int, List[Address]]] = []
         for addresses, last_address_index, change in [
                 (self.receive_addresses, self.last_receive_address_index, 0),
                 (self.change_addresses, self.last_change_address_index, 1)]:
@@ -202,29 +487,336 @@ class Wallet:
                     # Add more unused addresses to cover the GapLimit
                     new_addresses_needed_count = updated_last_address_index - \
                         cur_last_address_index
-                    index = len(cur_addresses)
-                    for _ in range(new_addresses_needed_count):
-                        pubkey: bytes = self._bip84_path.derive_pubkey(
-                            account_i, change, index)
-                        p2wpkh = bitcoin.core.CScript([OP_0, Hash160(pubkey)])
-                        p2wpkh_addr = P2WPKHBitcoinAddress.from_scriptPubKey(p2wpkh)
-                        new_address = Address(
-                            False if change == 0 else True, index, account_i, p2wpkh_addr, 0)
-                        cur_addresses.append(new_address)
-                        self.addresses_map[str(p2wpkh_addr)] = new_address
-                        index += 1
+                    derived_addresses = self._bip84_path.derive_range(
+                        account_i, change, len(cur_addresses), new_addresses_needed_count)
+                    new_addresses = [Address(
+                        False if change == 0 else True, derived_address.address_index, account_i,
+                        derived_address.address, 0, derived_address.address_string)
+                        for derived_address in derived_addresses]
+                    extensions.append(
+                        (addresses, last_address_index, account_i, updated_last_address_index, new_addresses))
+        # A sync that found nothing new leaves state_version as is, so the snapshot is not saved again.
+        if len(extensions) == 0:
+            return
+
+        with self._write_state():
+            addresses_map = dict(self.addresses_map)
+            script_pubkey_map = dict(self.script_pubkey_map)
+            for addresses, last_address_index, account_i, updated_last_address_index, new_addresses in extensions:
+                for new_address in new_addresses:
+                    addresses[account_i].append(new_address)
+                    addresses_map[new_address.address_string] = new_address
+                    script_pubkey_map[new_address.script_pubkey] = new_address
                 last_address_index[account_i] = updated_last_address_index
+            self.addresses_map = addresses_map
+            self.script_pubkey_map = script_pubkey_map
+
+    def _addresses_due(self) -> List[Address]:
+        """
+        Addresses a sync looks at, by how likely they are to have changed:
+        hot: the unused addresses after the last used one, which are handed out to receive, and those of
+             pending transactions. Every sync.
+        warm: addresses with unspent outputs. Every Config.WarmAddressSyncInterval seconds.
+        cold: used addresses with nothing left on them, which only change if the address is reused.
+              Every Config.ColdAddressSyncInterval seconds.
+        So that a sync costs requests for the addresses in use rather than for the whole history.
+        """
+        now = time.time()
+        hot: Set[Address] = self.mempool_addresses()
+        for addresses, last_address_index in [(self.receive_addresses, self.last_receive_address_index),
+                                              (self.change_addresses, self.last_change_address_index)]:
+            for account_i in range(len(addresses)):
+                hot.update(addresses[account_i][last_address_index[account_i]+1:])
 
-        self.syncing = False
+        addresses_due = []
+        warm_count = 0
+        for address in self._all_addresses():
+            if address in hot or address.last_synced == 0:
+                addresses_due.append(address)
+            elif address.balance != 0:
+                if now - address.last_synced >= Config.WarmAddressSyncInterval:
+                    addresses_due.append(address)
+                    warm_count += 1
+            elif now - address.last_synced >= Config.ColdAddressSyncInterval:
+                addresses_due.append(address)
+        logging.debug("Addresses due: {} of {}, {} hot, {} warm".format(
+            len(addresses_due), len(self.addresses_map), len(hot), warm_count))
+        return addresses_due
 
-    def _utxo_key(self, txid, n):
-        return "{}:{}".format(txid, n)
+    def _all_addresses(self) -> List[Address]:
+        addresses: List[Address] = []
+        for account_i in range(len(self.receive_addresses)):
+            addresses.extend(self.receive_addresses[account_i])
+            addresses.extend(self.change_addresses[account_i])
+        return addresses
+
+    def _sync_addresses_threaded(self, addresses: List[Address]):
+        unspent_outputs_map = self.unspent_outputs_map
+        futures = []
+        for address in addresses:
+            future = esplora.gThreadPoolExecutor.submit(
+                lambda address: self.sync_address(address, unspent_outputs_map), address)
+            futures.append(future)
+
+        # Wait for all addresses sync to be completed
+        start = time.time()
+        deltas = []
+        for future in as_completed(futures):
+            delta = future.result()
+            if delta is not None:
+                deltas.append(delta)
+        self._apply_deltas(deltas)
+        logging.debug("Sync addresses took {} ms with {} addresses. Requests: {}".format(int((time.time() - start)*1000), len(futures), esplora.gSingleFlight.stats()))
+        esplora.gAddressUsageCache.flush()
+        esplora.gTransactionCache.flush()
 
-    def sync_mempool_tx(self, txid):
-        if txid in self.mempool_tx_map:
-            return 
+        # In each sync_address, mempool_txids are updated as well. Sync txs in mempool for newly added txids
+        futures = []
+        for txid in self.mempool_txids:
+            if txid not in self.mempool_tx_map:
+                future = esplora.gThreadPoolExecutor.submit(
+                    lambda txid: self.sync_mempool_tx(txid), txid)
+                futures.append(future)
         
-        tx_json = esplora.tx_get(txid)
+        # Wait for all addresses sync to be completed
+        start = time.time()
+        self._add_mempool_txs([future.result() for future in as_completed(futures)])
+        logging.debug("Sync mempool took {} ms with {} txids.".format(
+            int((time.time() - start)*1000), len(futures)))
+
+    async def _sync_addresses_async(self, addresses: List[Address]):
+        """
+        Same as _sync_addresses_threaded, with every request in flight on the aioesplora event loop.
+        Runs on the event loop thread. Writes to the wallet, which wait for readers of other threads, and
+        to the database run in an executor, so that the loop keeps serving other syncs meanwhile.
+        """
+        start = time.time()
+        unspent_outputs_map = self.unspent_outputs_map
+        deltas = await asyncio.gather(*[self.sync_address_async(address, unspent_outputs_map)
+                                        for address in addresses])
+        await aioesplora.run_blocking(self._apply_deltas, [delta for delta in deltas if delta is not None])
+        logging.debug("Sync addresses took {} ms with {} addresses. Requests: {}".format(int((time.time() - start)*1000), len(addresses), esplora.gSingleFlight.stats()))
+        await aioesplora.run_blocking(esplora.gAddressUsageCache.flush)
+        await aioesplora.run_blocking(esplora.gTransactionCache.flush)
+
+        start = time.time()
+        txids = [txid for txid in self.mempool_txids if txid not in self.mempool_tx_map]
+        tx_jsons = await asyncio.gather(*[aioesplora.tx_get(txid) for txid in txids])
+        await aioesplora.run_blocking(
+            self._add_mempool_txs, [self._mempool_tx(txid, tx_json) for txid, tx_json in zip(txids, tx_jsons)])
+        logging.debug("Sync mempool took {} ms with {} txids.".format(
+            int((time.time() - start)*1000), len(txids)))
+
+    def _sync_addresses_electrum(self, addresses: List[Address]):
+        """
+        Same as _sync_addresses_threaded with an Electrum server. Only addresses whose status hash changed
+        since the last sync are looked at, with a few batched requests for all of them.
+        """
+        start = time.time()
+        statuses = electrum.subscribe([address.address for address in addresses])
+        changed = [(address, status) for address, status in zip(addresses, statuses)
+                   if status != address.electrum_status]
+
+        # The server notifies status changes of addresses subscribed by earlier syncs, e.g. cold ones.
+        syncing = set(addresses)
+        for scripthash, status in electrum.take_notified_statuses(self._electrum_subscriptions).items():
+            address = self._electrum_subscriptions.get(scripthash)
+            if address is not None and address not in syncing and status != address.electrum_status:
+                changed.append((address, status))
+        for address in addresses:
+            self._electrum_subscriptions[electrum.scripthash(address.address)] = address
+        changed_addresses = [address.address for address, _ in changed]
+        histories = electrum.histories(changed_addresses)
+        utxos = electrum.utxos(changed_addresses)
+
+        deltas = []
+        for (address, status), history in zip(changed, histories):
+            delta = self._electrum_history_delta(address, history, utxos[address.address_string])
+            delta.electrum_status = status
+            deltas.append(delta)
+        self._apply_deltas(deltas)
+        logging.debug("Sync addresses took {} ms with {} addresses, {} changed.".format(
+            int((time.time() - start)*1000), len(addresses), len(changed)))
+        esplora.gAddressUsageCache.flush()
+
+        start = time.time()
+        txids = [txid for txid in self.mempool_txids if txid not in self.mempool_tx_map]
+        self._add_mempool_txs([self._mempool_tx(txid, tx_json)
+                               for txid, tx_json in zip(txids, electrum.tx_gets(txids, [0] * len(txids)))])
+        esplora.gTransactionCache.flush()
+        logging.debug("Sync mempool took {} ms with {} txids.".format(
+            int((time.time() - start)*1000), len(txids)))
+
+    def _electrum_history_delta(self, address: Address, history: List[dict],
+                                utxos: Set[UnspentOutput]) -> AddressDelta:
+        """
+        @history: blockchain.scripthash.get_history of the address.
+        @utxos: confirmed unspent outputs of the address.
+        """
+        delta = AddressDelta(address)
+        confirmed_txids = []
+        for entry in history:
+            if entry["height"] > 0:
+                confirmed_txids.append(entry["tx_hash"])
+                delta.confirmed_txids.add(entry["tx_hash"])
+            else:
+                delta.mempool_txids.add(entry["tx_hash"])
+
+        # Confirmed transactions come in block order, so the last one is the newest.
+        delta.last_seen_txid = confirmed_txids[-1] if len(confirmed_txids) > 0 else None
+        if delta.last_seen_txid is not None:
+            esplora.gAddressUsageCache.put(address.address_string, True)
+        delta.utxos = utxos
+        return delta
+
+    def _sync_addresses_fullnode(self):
+        """
+        Same as _sync_addresses_threaded with the watch-only wallet that discovery set up on the node, which
+        tracks every address of the wallet. A few wallet RPCs sync all addresses, spent ones and the
+        mempool included, without scanning the UTXO set.
+        """
+        start = time.time()
+        wallet_name = discovery.fullnode_wallet_name(self._bip84_path)
+        # Addresses added since the last sync may be past the imported ranges.
+        discovery.import_fullnode_descriptors(self._bip84_path, wallet_name, [
+            (len(receive_addresses), len(change_addresses))
+            for receive_addresses, change_addresses in zip(self.receive_addresses, self.change_addresses)])
+        transactions = fullnode.listtransactions(wallet_name)
+        unspents = fullnode.listunspent(wallet_name)
+
+        # Entries come oldest first, so the last confirmed one paying an address is the newest.
+        last_seen_txids: Dict[str, str] = {}
+        mempool_txids: Set[str] = set()
+        for transaction in transactions:
+            if transaction["confirmations"] == 0:
+                mempool_txids.add(transaction["txid"])
+            elif transaction["confirmations"] > 0 and transaction["category"] in discovery.RECEIVE_CATEGORIES:
+                last_seen_txids[transaction["address"]] = transaction["txid"]
+        if any(address_string not in self.addresses_map for address_string in last_seen_txids):
+            # Paid past the gap limit of the known addresses.
+            self._merge_discover_result(discovery.discover_bip84_wallet_fullnode(
+                self._seed, Config.GapLimit, self._bip84_path, watermarks=self.watermarks()))
+
+        utxos: Dict[str, Set[UnspentOutput]] = {}
+        for unspent in unspents:
+            address = self.addresses_map.get(unspent["address"])
+            if address is not None:
+                utxos.setdefault(address.address_string, set()).add(UnspentOutput(
+                    unspent["txid"], unspent["vout"], int(round(unspent["amount"] * COIN)), address.address))
+        synced_utxo_keys: Dict[CBitcoinAddress, Set[Tuple[bytes, int]]] = {}
+        for utxo_key, utxo in self.unspent_outputs_map.items():
+            synced_utxo_keys.setdefault(utxo.address, set()).add(utxo_key)
+
+        deltas = []
+        for address in self._all_addresses():
+            address_utxos = utxos.get(address.address_string, set())
+            last_seen_txid = last_seen_txids.get(address.address_string)
+            if last_seen_txid == address.last_seen_txid and \
+                    set(utxo.outpoint for utxo in address_utxos) == synced_utxo_keys.get(address.address, set()):
+                continue
+            delta = AddressDelta(address)
+            delta.last_seen_txid = last_seen_txid
+            delta.utxos = address_utxos
+            deltas.append(delta)
+            if last_seen_txid is not None:
+                esplora.gAddressUsageCache.put(address.address_string, True)
+
+        # Before the deltas are applied, so that inputs spending outputs of the wallet are still found.
+        txids = [txid for txid in mempool_txids if txid not in self.mempool_tx_map]
+        mempool_txs = [self._fullnode_mempool_tx(transaction)
+                       for transaction in fullnode.gettransactions(wallet_name, txids)]
+        self._apply_deltas(deltas)
+        self._replace_mempool_txids(mempool_txids)
+        self._add_mempool_txs(mempool_txs)
+        logging.debug("Sync addresses took {} ms with the node wallet {}, {} changed, {} txids in the mempool.".format(
+            int((time.time() - start)*1000), wallet_name, len(deltas), len(mempool_txids)))
+        esplora.gAddressUsageCache.flush()
+
+    def _fullnode_mempool_tx(self, transaction: dict) -> WalletMempoolTransaction:
+        """
+        @transaction: gettransaction of the node wallet.
+        """
+        mempool_tx = WalletMempoolTransaction(transaction["txid"])
+        # amount is net of what the wallet paid to others, and fee is negative when the wallet paid it.
+        mempool_tx.value = int(round((transaction["amount"] + transaction.get("fee", 0)) * COIN))
+        tx = CTransaction.deserialize(bytes.fromhex(transaction["hex"]))
+        for txin in tx.vin:
+            utxo = self.unspent_outputs_map.get((txin.prevout.hash, txin.prevout.n))
+            if utxo is not None:
+                mempool_tx.vin_addresses.append(self.find_address(utxo.address))
+        for txout in tx.vout:
+            address = self.script_pubkey_map.get(txout.scriptPubKey)
+            if address is not None:
+                mempool_tx.vout_addresses.append(address)
+        return mempool_tx
+
+    def _apply_deltas(self, deltas: List[AddressDelta]):
+        """
+        The single writer of a sync: apply what the addresses were found to have changed, all at once.
+        """
+        if len(deltas) == 0:
+            return
+        with self._write_state():
+            unspent_outputs_map = dict(self.unspent_outputs_map)
+            mempool_txids = set(self.mempool_txids)
+            mempool_tx_map = dict(self.mempool_tx_map)
+
+            # Outputs of the wallet are all P2WPKH, so addresses compare by witness program.
+            replaced_addresses = set(delta.address.address for delta in deltas if delta.utxos is not None)
+            replaced_utxo_keys: Dict[CBitcoinAddress, List[Tuple[bytes, int]]] = {}
+            if len(replaced_addresses) > 0:
+                for utxo_key, utxo in unspent_outputs_map.items():
+                    if utxo.address in replaced_addresses:
+                        replaced_utxo_keys.setdefault(utxo.address, []).append(utxo_key)
+
+            for delta in deltas:
+                address = delta.address
+                balance = address.balance
+                if delta.utxos is not None:
+                    sent_utxo_keys = set()
+                    for utxo_key in replaced_utxo_keys.get(address.address, []):
+                        utxo = unspent_outputs_map.pop(utxo_key)
+                        if utxo.sent:
+                            sent_utxo_keys.add(utxo_key)
+                    balance = 0
+                    for utxo in delta.utxos:
+                        utxo_key = utxo.outpoint
+                        utxo.sent = utxo_key in sent_utxo_keys
+                        unspent_outputs_map[utxo_key] = utxo
+                        balance += utxo.value
+                else:
+                    for utxo_key in delta.spent_utxo_keys:
+                        utxo = unspent_outputs_map.pop(utxo_key, None)
+                        if utxo is not None:
+                            balance -= utxo.value
+                    for utxo in delta.created_utxos:
+                        utxo_key = utxo.outpoint
+                        if utxo_key not in unspent_outputs_map:
+                            unspent_outputs_map[utxo_key] = utxo
+                            balance += utxo.value
+
+                for txid in delta.confirmed_txids:
+                    mempool_txids.discard(txid)
+                    mempool_tx_map.pop(txid, None)
+                mempool_txids.update(delta.mempool_txids)
+
+                self.balance += balance - address.balance
+                address.balance = balance
+                address.last_seen_txid = delta.last_seen_txid
+                address.esplora_fingerprint = delta.esplora_fingerprint
+                address.electrum_status = delta.electrum_status
+
+            self.unspent_outputs_map = unspent_outputs_map
+            self.mempool_txids = mempool_txids
+            self.mempool_tx_map = mempool_tx_map
+
+    def _utxo_key(self, txid: str, n: int) -> Tuple[bytes, int]:
+        return (lx(txid), n)
+
+    def sync_mempool_tx(self, txid) -> WalletMempoolTransaction:
+        return self._mempool_tx(txid, esplora.tx_get(txid))
+
+    def _mempool_tx(self, txid, tx_json) -> WalletMempoolTransaction:
         vin_addresses: List[Address] = []
         value = 0
         for vin in tx_json["vin"]:
@@ -243,105 +835,399 @@ class Wallet:
         mempool_tx.value = value
         mempool_tx.vin_addresses = vin_addresses
         mempool_tx.vout_addresses = vout_addresses
-        self.mempool_tx_map[txid] = mempool_tx
+        return mempool_tx
+
+    def _add_mempool_txs(self, mempool_txs: List[WalletMempoolTransaction]):
+        if len(mempool_txs) == 0:
+            return
+        with self._write_state():
+            mempool_tx_map = dict(self.mempool_tx_map)
+            for mempool_tx in mempool_txs:
+                # Skip transactions confirmed while they were fetched.
+                if mempool_tx.txid in self.mempool_txids:
+                    mempool_tx_map[mempool_tx.txid] = mempool_tx
+            self.mempool_tx_map = mempool_tx_map
+
+    def addresses_touched_by(self, tx: CTransaction) -> Set[Address]:
+        """
+        @return: addresses of the wallet that tx pays to, or spends an unspent output of.
+        """
+        touched: Set[Address] = set()
+        for txin in tx.vin:
+            utxo = self.unspent_outputs_map.get((txin.prevout.hash, txin.prevout.n))
+            if utxo is not None:
+                touched.add(self.find_address(utxo.address))
+        for txout in tx.vout:
+            address = self.script_pubkey_map.get(txout.scriptPubKey)
+            if address is not None:
+                touched.add(address)
+        return touched
+
+    def apply_unconfirmed_tx(self, tx: CTransaction):
+        """
+        Show a transaction as pending as soon as the full node accepts it, before the chain backend has
+        seen it. Its inputs are resolved against unspent_outputs_map only, which covers every input
+        spending from the wallet except chains of unconfirmed transactions.
+        """
+        txid_bytes = tx.GetTxid()
+        # The node also publishes transactions when they are confirmed. Skip those already synced.
+        for i in range(len(tx.vout)):
+            if (txid_bytes, i) in self.unspent_outputs_map:
+                return
+
+        txid = b2lx(txid_bytes)
+        mempool_tx = WalletMempoolTransaction(txid)
+        for txin in tx.vin:
+            utxo = self.unspent_outputs_map.get((txin.prevout.hash, txin.prevout.n))
+            if utxo is not None:
+                mempool_tx.value -= utxo.value
+                mempool_tx.vin_addresses.append(self.find_address(utxo.address))
+        for txout in tx.vout:
+            address = self.script_pubkey_map.get(txout.scriptPubKey)
+            if address is not None:
+                mempool_tx.value += txout.nValue
+                mempool_tx.vout_addresses.append(address)
+
+        with self._write_state():
+            mempool_tx_map = dict(self.mempool_tx_map)
+            mempool_tx_map[txid] = mempool_tx
+            self.mempool_txids = self.mempool_txids | {txid}
+            self.mempool_tx_map = mempool_tx_map
 
-    def sync_address(self, bitcoin_address: CBitcoinAddress):
-        address: Address = self.addresses_map[str(bitcoin_address)]
-        newest_tx_id = None
+    def mempool_addresses(self) -> Set[Address]:
+        """
+        @return: addresses of the wallet touched by transactions in the mempool.
+        """
+        addresses: Set[Address] = set()
+        for mempool_tx in list(self.mempool_tx_map.values()):
+            addresses.update(mempool_tx.vin_addresses)
+            addresses.update(mempool_tx.vout_addresses)
+        return addresses
 
+    def sync_address(self, address: Address,
+                     unspent_outputs_map: Dict[Tuple[bytes, int], UnspentOutput]) -> AddressDelta:
+        """
+        @unspent_outputs_map: of the wallet when the sync started, not modified.
+        @return: changes since the last sync, None if there are none.
+        """
+        # The small stats of the address tell whether its transactions changed since the last sync.
+        fingerprint = esplora.address_fingerprint(esplora.address_stats(address.address_string))
+        if fingerprint == address.esplora_fingerprint:
+            return None
+
+        delta = AddressDelta(address)
+        # Outputs whose spending transaction was seen, before the older transaction creating them.
+        spent_before_created: Set[Tuple[bytes, int]] = set()
         done = False
         synced_txid = None
         head_txid = None
         while not done:
-            address_txs_json = esplora.address_txs(bitcoin_address, synced_txid)
-            confirmed_tx_count = 0
-            for tx_json in address_txs_json:
-                if not tx_json["status"]["confirmed"]:
-                    self.mempool_txids.add(tx_json["txid"])
-                    continue
-                elif head_txid is None:
-                    head_txid = tx_json["txid"]
-
-                self.mempool_txids.discard(tx_json["txid"])
-                if tx_json["txid"] in self.mempool_tx_map:
-                    del self.mempool_tx_map[tx_json["txid"]]
-
-                synced_txid = tx_json["txid"]
-                confirmed_tx_count += 1
-                if synced_txid == address.last_seen_txid:
-                    done = True
-                    break
-
-                # For each vin, we find whether there is any UTXO being spent. If so,
-                # remove the UTXO and update its address balance.
-                for vin in tx_json["vin"]:
-                    prevout = vin["prevout"]
-                    if prevout["scriptpubkey_address"] == str(bitcoin_address):
-                        utxo_key = self._utxo_key(vin["txid"], vin["vout"])
-                        if utxo_key not in self.unspent_outputs_map:
-                            utxo = UnspentOutput(
-                                vin["txid"], vin["vout"], prevout["value"], bitcoin_address)
-                            utxo.spent = True
-                            self.unspent_outputs_map[utxo_key] = utxo
-                        else:
-                            utxo = self.unspent_outputs_map[utxo_key]
-                            address.balance -= utxo.value
-                            self.balance -= utxo.value
-                            assert not utxo.spent, "Double spending? txid={}, n={}".format(
-                                utxo.txid, utxo.vout)
-                            del self.unspent_outputs_map[utxo_key]
-                
-                for i in range(len(tx_json["vout"])):
-                    vout = tx_json["vout"][i]
-                    if vout["scriptpubkey_address"] == str(bitcoin_address):
-                        utxo_key = self._utxo_key(tx_json["txid"], i)
-                        if utxo_key not in self.unspent_outputs_map:
-                            utxo = UnspentOutput(
-                                tx_json["txid"], i, vout["value"], bitcoin_address)
-                            address.balance += utxo.value
-                            self.balance += utxo.value
-                            self.unspent_outputs_map[utxo_key] = utxo
-                        else:
-                            utxo = self.unspent_outputs_map[utxo_key]
-                            assert utxo.spent
-                            # Remove it since it has already been spent.
-                            del self.unspent_outputs_map[utxo_key]
-
-            if not done and confirmed_tx_count == 0:
+            address_txs_json = esplora.address_txs(address.address_string, synced_txid)
+            synced_txid, head_txid, done = self._address_txs_delta(
+                delta, address_txs_json, unspent_outputs_map, spent_before_created, synced_txid, head_txid)
+
+        delta.last_seen_txid = head_txid
+        if head_txid is not None:
+            esplora.gAddressUsageCache.put(address.address_string, True)
+        delta.esplora_fingerprint = fingerprint
+        return delta
+
+    async def sync_address_async(self, address: Address,
+                     unspent_outputs_map: Dict[Tuple[bytes, int], UnspentOutput]) -> AddressDelta:
+        """
+        @unspent_outputs_map: of the wallet when the sync started, not modified.
+        @return: changes since the last sync, None if there are none.
+        """
+        # The small stats of the address tell whether its transactions changed since the last sync.
+        fingerprint = esplora.address_fingerprint(await aioesplora.address_stats(address.address_string))
+        if fingerprint == address.esplora_fingerprint:
+            return None
+
+        delta = AddressDelta(address)
+        # Outputs whose spending transaction was seen, before the older transaction creating them.
+        spent_before_created: Set[Tuple[bytes, int]] = set()
+        done = False
+        synced_txid = None
+        head_txid = None
+        while not done:
+            address_txs_json = await aioesplora.address_txs(address.address_string, synced_txid)
+            synced_txid, head_txid, done = self._address_txs_delta(
+                delta, address_txs_json, unspent_outputs_map, spent_before_created, synced_txid, head_txid)
+
+        delta.last_seen_txid = head_txid
+        if head_txid is not None:
+            await aioesplora.run_blocking(esplora.gAddressUsageCache.put, address.address_string, True)
+        delta.esplora_fingerprint = fingerprint
+        return delta
+
+    def _address_txs_delta(self, delta: AddressDelta, address_txs_json,
+                           unspent_outputs_map: Dict[Tuple[bytes, int], UnspentOutput],
+                           spent_before_created: Set[Tuple[bytes, int]], synced_txid, head_txid) -> Tuple[str, str, bool]:
+        """
+        Add a page of GET /address/:address/txs or GET /address/:address/txs/chain/:synced_txid to delta.
+        Transactions come newest first.
+        @return: (synced_txid to fetch the next page after, head_txid, True if the address is synced)
+        """
+        bitcoin_address = delta.address.address_string
+        done = False
+        confirmed_tx_count = 0
+        for tx_json in address_txs_json:
+            if not tx_json["status"]["confirmed"]:
+                delta.mempool_txids.add(tx_json["txid"])
+                continue
+            elif head_txid is None:
+                head_txid = tx_json["txid"]
+
+            delta.confirmed_txids.add(tx_json["txid"])
+
+            synced_txid = tx_json["txid"]
+            confirmed_tx_count += 1
+            if synced_txid == delta.address.last_seen_txid:
                 done = True
                 break
-        
-        address.last_seen_txid = head_txid
 
-    def discover(self):
+            # For each vin, we find whether there is any UTXO being spent.
+            for vin in tx_json["vin"]:
+                if vin["prevout"]["scriptpubkey_address"] == bitcoin_address:
+                    utxo_key = self._utxo_key(vin["txid"], vin["vout"])
+                    if utxo_key in unspent_outputs_map:
+                        delta.spent_utxo_keys.add(utxo_key)
+                    else:
+                        spent_before_created.add(utxo_key)
+
+            for i in range(len(tx_json["vout"])):
+                vout = tx_json["vout"][i]
+                if vout["scriptpubkey_address"] == bitcoin_address:
+                    utxo_key = self._utxo_key(tx_json["txid"], i)
+                    # Already spent by a newer transaction.
+                    if utxo_key in spent_before_created:
+                        spent_before_created.discard(utxo_key)
+                    elif utxo_key not in unspent_outputs_map:
+                        delta.created_utxos.append(UnspentOutput(
+                            tx_json["txid"], i, vout["value"], delta.address.address))
+
+        if not done and confirmed_tx_count == 0:
+            done = True
+        return synced_txid, head_txid, done
+
+    def discover(self, watermarks: List[Tuple[int, int]] = None):
         """
         Expensive operation
+
+        @watermarks: (last receive address index, last change address index) per account, as returned by
+                     watermarks() after an earlier discovery. Only addresses after them are checked.
+                     None for a full rescan.
         """
-        discover_wallet_result: discovery.DiscoverWalletResult = discovery.discover_bip84_wallet(
-            self._seed, Config.GapLimit)
-        
-        self.receive_addresses = discover_wallet_result.receive_addresses
-        self.last_receive_address_index: List[int] = discover_wallet_result.last_receive_address_index
-        self.change_addresses: List[List[Address]] = discover_wallet_result.change_addresses
-        self.last_change_address_index: List[int] = discover_wallet_result.last_change_address_index
+        if Config.ChainBackend == BACKEND_FULLNODE:
+            discover_wallet_result: discovery.DiscoverWalletResult = discovery.discover_bip84_wallet_fullnode(
+                self._seed, Config.GapLimit, self._bip84_path, watermarks=watermarks)
+        else:
+            discover_wallet_result: discovery.DiscoverWalletResult = discovery.discover_bip84_wallet(
+                self._seed, Config.GapLimit, self._bip84_path, watermarks=watermarks)
+        self._merge_discover_result(discover_wallet_result)
 
-        for cur_account_addresses in self.receive_addresses:
-            for address in cur_account_addresses:
-                self.addresses_map[str(address.address)] = address
+        self.sync_addresses(self._all_addresses())
 
-        for cur_account_addresses in self.change_addresses:
-            for address in cur_account_addresses:
-                self.addresses_map[str(address.address)] = address
+    def _merge_discover_result(self, discover_wallet_result):
+        """
+        Add accounts and addresses found by discovery. Addresses already known are kept along with their
+        state, and address indexes never move backwards, so that a used address is not handed out again.
+        """
+        if not self._discovered_anything_new(discover_wallet_result):
+            return
+        with self._write_state():
+            addresses_map = dict(self.addresses_map)
+            script_pubkey_map = dict(self.script_pubkey_map)
+            self._merge_discovered_addresses(discover_wallet_result, addresses_map, script_pubkey_map)
+            self.addresses_map = addresses_map
+            self.script_pubkey_map = script_pubkey_map
 
-        self.sync_addresses()
-    
-    def request_sync(self):
-        # sync is honored if last time sync is more than 10 seconds.
-        threshold = 20
-        if time.time() - self.last_sync > threshold:
-            self.sync_addresses()
-            self.last_sync = time.time()
+    def _discovered_anything_new(self, discover_wallet_result) -> bool:
+        for addresses, last_address_index, found_addresses, found_last_address_index in [
+                (self.receive_addresses, self.last_receive_address_index,
+                 discover_wallet_result.receive_addresses, discover_wallet_result.last_receive_address_index),
+                (self.change_addresses, self.last_change_address_index,
+                 discover_wallet_result.change_addresses, discover_wallet_result.last_change_address_index)]:
+            for account_i in range(len(found_addresses)):
+                if account_i == len(addresses) or len(found_addresses[account_i]) > len(addresses[account_i]) or \
+                        found_last_address_index[account_i] > last_address_index[account_i]:
+                    return True
+        return False
+
+    def _merge_discovered_addresses(self, discover_wallet_result, addresses_map: Dict[str, Address],
+                                    script_pubkey_map: Dict[bytes, Address]):
+        for addresses, last_address_index, found_addresses, found_last_address_index in [
+                (self.receive_addresses, self.last_receive_address_index,
+                 discover_wallet_result.receive_addresses, discover_wallet_result.last_receive_address_index),
+                (self.change_addresses, self.last_change_address_index,
+                 discover_wallet_result.change_addresses, discover_wallet_result.last_change_address_index)]:
+            for account_i in range(len(found_addresses)):
+                if account_i == len(addresses):
+                    addresses.append([])
+                    last_address_index.append(-1)
+                cur_addresses = addresses[account_i]
+                for address in found_addresses[account_i][len(cur_addresses):]:
+                    cur_addresses.append(address)
+                    addresses_map[address.address_string] = address
+                    script_pubkey_map[address.script_pubkey] = address
+                last_address_index[account_i] = max(
+                    last_address_index[account_i], found_last_address_index[account_i])
+
+    def _replace_mempool_txids(self, mempool_txids: Set[str]):
+        """
+        Replace the transactions in the mempool with the complete set from the backend.
+        """
+        if mempool_txids == self.mempool_txids:
+            return
+        with self._write_state():
+            self.mempool_txids = mempool_txids
+            self.mempool_tx_map = {txid: mempool_tx for txid, mempool_tx in self.mempool_tx_map.items()
+                                   if txid in mempool_txids}
+
+    def load_derivation_cache(self, account_xpubs: Dict[int, str],
+                              cached_addresses: List[Tuple[int, int, int, bytes, str]]):
+        '''
+        Let discovery reuse addresses derived by a previous process instead of deriving them again.
+        @cached_addresses: list of (account, change, address_index, scriptPubKey, address)
+        '''
+        derived_addresses = []
+        for account, change, address_index, script_pubkey, bitcoin_address in cached_addresses:
+            p2wpkh = CScript(script_pubkey)
+            derived_addresses.append((account, change, DerivedAddress(
+                address_index, None, p2wpkh, P2WPKHBitcoinAddress.from_scriptPubKey(p2wpkh), bitcoin_address)))
+        self._bip84_path.load_cache(account_xpubs, derived_addresses)
+
+    def watermarks(self) -> List[Tuple[int, int]]:
+        """
+        @return: (last receive address index, last change address index) per account.
+        """
+        return list(zip(self.last_receive_address_index, self.last_change_address_index))
+
+    def account_xpubs(self) -> Dict[int, str]:
+        return self._bip84_path.account_xpubs()
+
+    def derivation_cache_rows(self) -> List[Tuple[int, int, int, bytes, str]]:
+        '''
+        @return: list of (account, change, address_index, scriptPubKey, address) for every address of the wallet.
+        '''
+        rows = []
+        for address in list(self.addresses_map.values()):
+            rows.append((address.account_no, 1 if address.is_change else 0, address.address_index,
+                         address.script_pubkey, address.address_string))
+        return rows
+
+    def state_snapshot(self) -> dict:
+        '''
+        What syncing found, for walletstate to save. Call it with read_state for a consistent snapshot.
+        '''
+        addresses = []
+        # Outputs of the wallet are all P2WPKH, so addresses compare by witness program.
+        address_strings: Dict[CBitcoinAddress, str] = {}
+        for account_addresses in self.receive_addresses + self.change_addresses:
+            for address in account_addresses:
+                address_strings[address.address] = address.address_string
+                addresses.append([
+                    address.account_no, 1 if address.is_change else 0, address.address_index, address.address_string,
+                    address.script_pubkey.hex(), address.balance, address.last_seen_txid, address.esplora_fingerprint, address.electrum_status,
+                    address.last_synced])
+        return {
+            "last_sync": self.last_sync,
+            "balance": self.balance,
+            "watermarks": self.watermarks(),
+            "addresses": addresses,
+            "unspent_outputs": [[utxo.txid, utxo.vout, utxo.value, address_strings[utxo.address], utxo.sent]
+                                for utxo in self.unspent_outputs_map.values()],
+            "mempool_txids": list(self.mempool_txids),
+            "mempool_txs": [[mempool_tx.txid, mempool_tx.value,
+                             [address.address_string for address in mempool_tx.vin_addresses],
+                             [address.address_string for address in mempool_tx.vout_addresses]]
+                            for mempool_tx in self.mempool_tx_map.values()],
+        }
+
+    def restore_state(self, snapshot: dict):
+        '''
+        Start from a snapshot of state_snapshot() instead of discovery. The next sync only looks at what
+        changed since the snapshot was taken.
+        '''
+        with self._write_state():
+            watermarks = snapshot["watermarks"]
+            self.receive_addresses = [[] for _ in watermarks]
+            self.change_addresses = [[] for _ in watermarks]
+            self.last_receive_address_index = [last_receive_address_index for last_receive_address_index, _ in watermarks]
+            self.last_change_address_index = [last_change_address_index for _, last_change_address_index in watermarks]
+
+            addresses_map: Dict[str, Address] = {}
+            script_pubkey_map: Dict[bytes, Address] = {}
+            # Addresses are saved in index order per chain.
+            for account, change, address_index, bitcoin_address, script_pubkey, balance, last_seen_txid, \
+                    esplora_fingerprint, electrum_status, last_synced in snapshot["addresses"]:
+                # Much faster than parsing bitcoin_address.
+                p2wpkh_address = P2WPKHBitcoinAddress.from_scriptPubKey(CScript(bytes.fromhex(script_pubkey)))
+                address = Address(change == 1, address_index, account, p2wpkh_address, balance, bitcoin_address)
+                address.last_seen_txid = last_seen_txid
+                address.esplora_fingerprint = tuple(esplora_fingerprint) if esplora_fingerprint is not None else None
+                address.electrum_status = electrum_status
+                address.last_synced = last_synced
+                (self.change_addresses if address.is_change else self.receive_addresses)[account].append(address)
+                addresses_map[bitcoin_address] = address
+                script_pubkey_map[address.script_pubkey] = address
+
+            unspent_outputs_map: Dict[Tuple[bytes, int], UnspentOutput] = {}
+            for txid, vout, value, bitcoin_address, sent in snapshot["unspent_outputs"]:
+                utxo = UnspentOutput(txid, vout, value, addresses_map[bitcoin_address].address)
+                utxo.sent = sent
+                unspent_outputs_map[utxo.outpoint] = utxo
+
+            mempool_tx_map: Dict[str, WalletMempoolTransaction] = {}
+            for txid, value, vin_addresses, vout_addresses in snapshot["mempool_txs"]:
+                mempool_tx = WalletMempoolTransaction(txid)
+                mempool_tx.value = value
+                mempool_tx.vin_addresses = [addresses_map[bitcoin_address] for bitcoin_address in vin_addresses]
+                mempool_tx.vout_addresses = [addresses_map[bitcoin_address] for bitcoin_address in vout_addresses]
+                mempool_tx_map[txid] = mempool_tx
+
+            self.addresses_map = addresses_map
+            self.script_pubkey_map = script_pubkey_map
+            self.unspent_outputs_map = unspent_outputs_map
+            self.mempool_txids = set(snapshot["mempool_txids"])
+            self.mempool_tx_map = mempool_tx_map
+            self.balance = snapshot["balance"]
+            self.last_sync = snapshot["last_sync"]
+
+    def request_sync(self) -> bool:
+        """
+        Sync at most once per Config.SyncMinInterval seconds, and only if something may have changed:
+        the chain state differs from the last sync, a notification came for the wallet from ZMQ or from the
+        Electrum server, or the last sync is Config.SyncMaxStaleness seconds old, since a payment entering
+        the mempool doesn't change the tip.
+        @return: True if synced.
+        """
+        now = time.time()
+        if now - self.last_sync <= Config.SyncMinInterval:
+            return False
+
+        chain_state = get_chain_state()
+        if chain_state is not None and chain_state == self.last_sync_chain_state and \
+                self.last_notified < self.last_sync and not self._electrum_notified() and \
+                now - self.last_sync < Config.SyncMaxStaleness:
+            return False
+
+        if not self.sync_addresses():
+            # Another sync is in progress. It may have started before the change, so try again next time.
+            return False
+        # Anything after the sync started is picked up by the next one.
+        self.last_sync = now
+        self.last_sync_chain_state = chain_state
+        return True
     
+    def _electrum_notified(self) -> bool:
+        """
+        @return: True if the Electrum server notified a status change of an address of the wallet, which the
+                 next sync takes.
+        """
+        return Config.ChainBackend == BACKEND_ELECTRUM and \
+            electrum.has_notified_statuses(self._electrum_subscriptions)
+
     def _find_unspent_output(self, txid: str, vout: int) -> UnspentOutput:
         return self.unspent_outputs_map.get(self._utxo_key(txid, vout))
 
@@ -362,7 +1248,7 @@ class Wallet:
         # Assume there is always a change address.
         output_vbytes += 31
 
-        feerate_per_target = esplora.fee_estimates()
+        feerate_per_target = feerates.gFeeRateProvider.get()
         confirmation_targets = [1, 6, 24*6]
         fee_per_target = {}
         for target in confirmation_targets:
@@ -406,7 +1292,7 @@ class Wallet:
                 # Code: https://github.com/bitcoin/bitcoin/blob/v0.21.2rc1/src/validation.cpp#L610-L635
                 # BIP 125: https://github.com/bitcoin/bips/blob/master/bip-0125.mediawiki
                 nSequence = 0xfffffffd
-            txin = CTxIn(COutPoint(lx(utxo.txid), utxo.vout),
+            txin = CTxIn(COutPoint(utxo.txid_bytes, utxo.vout),
                          nSequence=nSequence)
             txins.append(txin)
         
@@ -422,20 +1308,21 @@ class Wallet:
 
         logging.debug("Unsigned transaction: " + str(binascii.hexlify(tx.serialize())))
 
-        # Signing
-        witnesses = []
-        for txin_index, txin in enumerate(txins):
-            # Get SignatureHash (Transaction digest) for signing according to https://github.com/bitcoin/bips/blob/master/bip-0143.mediawiki#Native_P2WPKH
-            utxo = utxos[txin_index]
+        # Signing. Transaction digests are computed according to
+        # https://github.com/bitcoin/bips/blob/master/bip-0143.mediawiki#Native_P2WPKH
+        start = time.time()
+        signing_inputs = []
+        for utxo in utxos:
             p2wpkh_bitcoin_address: P2WPKHBitcoinAddress = utxo.address
-            sighash = SignatureHash(p2wpkh_bitcoin_address.to_redeemScript(), tx, txin_index, SIGHASH_ALL,
-                                    amount=utxo.value, sigversion=SIGVERSION_WITNESS_V0)
+            signing_inputs.append((p2wpkh_bitcoin_address.to_redeemScript(), utxo.value, p2wpkh_bitcoin_address))
 
-            seckey: CKey = self._find_seckey(p2wpkh_bitcoin_address)
-            assert seckey is not None, "Can't find privkey associated with the address"
-            signature = seckey.sign(sighash) + bytes([SIGHASH_ALL])
-            witness = [signature, seckey.pub]
-            witnesses.append(witness)
+        executor = None
+        if len(signing_inputs) >= Config.SignProcessPoolThreshold and Config.ProcessPoolMaxWorkers > 1:
+            executor = get_process_pool()
+        witnesses = signing.sign_p2wpkh_inputs(tx, signing_inputs, self._find_privkey,
+                                               executor, Config.ProcessPoolMaxWorkers)
+        logging.debug("Signing took {} ms with {} inputs.".format(
+            int((time.time() - start)*1000), len(signing_inputs)))
 
         # Aggregate all of the witnesses together, and then assign them to the
         # transaction object.
@@ -445,13 +1332,22 @@ class Wallet:
         logging.debug("Signed transaction: " +
                       str(binascii.hexlify(tx.serialize())))
 
-        txid = esplora.send_tx(tx)
+        if Config.ChainBackend == BACKEND_ELECTRUM:
+            txid = electrum.send_tx(tx)
+        elif Config.ChainBackend == BACKEND_FULLNODE:
+            try:
+                txid = fullnode.sendrawtransaction(tx.serialize())
+            except fullnode.RPCError as e:
+                logging.warning("Send transaction failed: {}".format(e))
+                txid = ""
+        else:
+            txid = esplora.send_tx(tx)
         logging.debug("TXID: {}".format(txid))
         assert txid != "", "Failed to send tx"
 
         # Mark utxos as sent
-        for txin_index, txin in enumerate(txins):
-            utxo = utxos[txin_index]
-            utxo = self._find_unspent_output(utxo.txid, utxo.vout)
-            utxo.sent = True
+        with self._write_state():
+            for txin_index, txin in enumerate(txins):
+                utxo = self.unspent_outputs_map[utxos[txin_index].outpoint]
+                utxo.sent = True
         return (txid, fee)
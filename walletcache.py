@@ -0,0 +1,99 @@
+import sqlite3
+import os
+import threading
+from typing import List, Dict, Tuple
+
+'''
+Data derived from a wallet's mnemonic, cached in the database so that a cold load neither
+runs PBKDF2 on the mnemonic nor derives every address again, and discovery watermarks so that
+it does not check every address again. Private keys are never stored.
+'''
+
+SQLITE_DB_FILE = os.path.dirname(
+    os.path.realpath(__file__)) + "/data/wallets.db"
+
+def create_tables(cursor: sqlite3.Cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS WalletAccountKeys (wallet_id INTEGER NOT NULL, account INTEGER NOT NULL, "
+        "xpub TEXT NOT NULL, PRIMARY KEY (wallet_id, account))")
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS WalletAddresses (wallet_id INTEGER NOT NULL, account INTEGER NOT NULL, "
+        "change INTEGER NOT NULL, address_index INTEGER NOT NULL, script_pubkey BLOB NOT NULL, address TEXT NOT NULL, "
+        "PRIMARY KEY (wallet_id, account, change, address_index))")
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS WalletWatermarks (wallet_id INTEGER NOT NULL, account INTEGER NOT NULL, "
+        "last_receive_address_index INTEGER NOT NULL, last_change_address_index INTEGER NOT NULL, "
+        "PRIMARY KEY (wallet_id, account))")
+
+gTablesCreated = False
+gTablesLock = threading.Lock()
+
+def _connect() -> sqlite3.Connection:
+    # Databases created before the cache existed don't have the tables yet.
+    global gTablesCreated
+    conn = sqlite3.connect(SQLITE_DB_FILE)
+    with gTablesLock:
+        if not gTablesCreated:
+            create_tables(conn.cursor())
+            conn.commit()
+            gTablesCreated = True
+    return conn
+
+def load_account_xpubs(wallet_id: int) -> Dict[int, str]:
+    with _connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT account, xpub FROM WalletAccountKeys WHERE wallet_id = ?", (wallet_id,))
+        return {account: xpub for account, xpub in cursor}
+
+def save_account_xpubs(wallet_id: int, account_xpubs: Dict[int, str]):
+    with _connect() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT OR IGNORE INTO WalletAccountKeys (wallet_id, account, xpub) VALUES (?,?,?)",
+            [(wallet_id, account, xpub) for account, xpub in account_xpubs.items()])
+        conn.commit()
+
+def load_addresses(wallet_id: int) -> List[Tuple[int, int, int, bytes, str]]:
+    """
+    @return: list of (account, change, address_index, scriptPubKey, address)
+    """
+    with _connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT account, change, address_index, script_pubkey, address FROM WalletAddresses WHERE wallet_id = ?",
+            (wallet_id,))
+        return cursor.fetchall()
+
+def save_addresses(wallet_id: int, addresses: List[Tuple[int, int, int, bytes, str]]):
+    """
+    @addresses: list of (account, change, address_index, scriptPubKey, address). Existing rows are kept.
+    """
+    with _connect() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT OR IGNORE INTO WalletAddresses (wallet_id, account, change, address_index, script_pubkey, address) "
+            "VALUES (?,?,?,?,?,?)",
+            [(wallet_id,) + tuple(address) for address in addresses])
+        conn.commit()
+
+def load_watermarks(wallet_id: int) -> List[Tuple[int, int]]:
+    """
+    @return: (last receive address index, last change address index) per account found by discovery.
+    """
+    with _connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT last_receive_address_index, last_change_address_index FROM WalletWatermarks "
+            "WHERE wallet_id = ? ORDER BY account", (wallet_id,))
+        return cursor.fetchall()
+
+def save_watermarks(wallet_id: int, watermarks: List[Tuple[int, int]]):
+    with _connect() as conn:
+        cursor = conn.cursor()
+        cursor.executemany(
+            "INSERT OR REPLACE INTO WalletWatermarks (wallet_id, account, last_receive_address_index, last_change_address_index) "
+            "VALUES (?,?,?,?)",
+            [(wallet_id, account, last_receive_address_index, last_change_address_index)
+             for account, (last_receive_address_index, last_change_address_index) in enumerate(watermarks)])
+        conn.commit()
@@ -0,0 +1,65 @@
+import sqlite3
+import os
+import json
+import time
+import threading
+
+'''
+Snapshots of what syncing found for a wallet: addresses with their sync cursors, unspent outputs and
+mempool transactions, as returned by Wallet.state_snapshot(). A cold load restores the latest snapshot
+and only syncs what changed since, instead of discovering and syncing the wallet from scratch.
+'''
+
+SQLITE_DB_FILE = os.path.dirname(
+    os.path.realpath(__file__)) + "/data/wallets.db"
+
+# Snapshots in another format are ignored, and the wallet is discovered again.
+# 2: scriptPubKey of each address.
+SNAPSHOT_FORMAT = 2
+
+def create_tables(cursor: sqlite3.Cursor):
+    cursor.execute(
+        "CREATE TABLE IF NOT EXISTS WalletStates (wallet_id INTEGER PRIMARY KEY, version INTEGER NOT NULL, "
+        "format INTEGER NOT NULL, saved_at REAL NOT NULL, state_json TEXT NOT NULL)")
+
+gTablesCreated = False
+gTablesLock = threading.Lock()
+
+def _connect() -> sqlite3.Connection:
+    # Databases created before snapshots existed don't have the table yet.
+    global gTablesCreated
+    conn = sqlite3.connect(SQLITE_DB_FILE)
+    with gTablesLock:
+        if not gTablesCreated:
+            create_tables(conn.cursor())
+            conn.commit()
+            gTablesCreated = True
+    return conn
+
+def load_snapshot(wallet_id: int) -> dict:
+    """
+    @return: the latest snapshot of the wallet, None if there is none.
+    """
+    with _connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT state_json FROM WalletStates WHERE wallet_id = ? AND format = ?", (wallet_id, SNAPSHOT_FORMAT))
+        row = cursor.fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+def save_snapshot(wallet_id: int, snapshot: dict) -> int:
+    """
+    Replace the snapshot of the wallet.
+    @return: version of the snapshot, one more than the one it replaces.
+    """
+    state_json = json.dumps(snapshot, separators=(",", ":"))
+    with _connect() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version FROM WalletStates WHERE wallet_id = ?", (wallet_id,))
+        row = cursor.fetchone()
+        version = row[0] + 1 if row is not None else 1
+        cursor.execute(
+            "INSERT OR REPLACE INTO WalletStates (wallet_id, version, format, saved_at, state_json) VALUES (?,?,?,?,?)",
+            (wallet_id, version, SNAPSHOT_FORMAT, time.time(), state_json))
+        conn.commit()
+    return version
@@ -0,0 +1,159 @@
+import functools
+import logging
+import threading
+import time
+from bitcoin.core import CTransaction, b2lx
+from typing import List, Dict, Set, Tuple
+from config import Config
+from wallet import Wallet, Address
+import syncscheduler
+
+# pyzmq is only needed when ZmqRawTxEndpoint or ZmqHashBlockEndpoint is set.
+try:
+    import zmq
+except ImportError:
+    zmq = None
+
+'''
+Push updates from the ZMQ publisher of a full node (bitcoind -zmqpubrawtx and -zmqpubhashblock).
+A transaction the node accepts is shown right away in every loaded wallet it touches. After each
+block, the addresses touched since the previous block and those of pending transactions are synced
+with the chain backend, so that confirmations show up without polling. Those syncs run on the sync
+scheduler, so that the ZMQ thread keeps reading notifications meanwhile.
+Reference: https://github.com/bitcoin/bitcoin/blob/master/doc/zmq.md
+'''
+
+def enabled() -> bool:
+    return Config.ZmqRawTxEndpoint != "" or Config.ZmqHashBlockEndpoint != ""
+
+class ZmqSubscriber:
+    def __init__(self, rawtx_endpoint: str, hashblock_endpoint: str, block_sync_delay: float,
+                 scheduler: syncscheduler.SyncScheduler):
+        """
+        @rawtx_endpoint, hashblock_endpoint: e.g. tcp://127.0.0.1:28332, or "" to not subscribe.
+        @block_sync_delay: seconds to wait after a block before syncing, so that the chain backend
+                           has indexed it.
+        @scheduler: runs the syncs after blocks, with the other syncs of the wallet.
+        """
+        self._rawtx_endpoint = rawtx_endpoint
+        self._hashblock_endpoint = hashblock_endpoint
+        self._block_sync_delay = block_sync_delay
+        self._scheduler = scheduler
+
+        # wallet -> id of the wallet in the scheduler
+        self._wallets: Dict[Wallet, int] = {}
+        # Transactions to show.
+        self._unapplied: List[Tuple[Wallet, CTransaction]] = []
+        # wallet -> addresses touched by transactions since the last block sync
+        self._touched: Dict[Wallet, Set[Address]] = {}
+        # When to sync the wallets in self._block_sync_wallets, None if no block is pending.
+        self._block_sync_at: float = None
+        self._block_sync_wallets: Set[Wallet] = set()
+        self._lock = threading.Lock()
+        self._thread: threading.Thread = None
+
+        # UNIX time of the last notification, 0 if none.
+        self.last_notified = 0.0
+        self.tx_count = 0
+        self.block_count = 0
+
+    def add_wallet(self, wallet_id: int, wallet: Wallet):
+        with self._lock:
+            self._wallets[wallet] = wallet_id
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="zmqnotify", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        socket = zmq.Context.instance().socket(zmq.SUB)
+        for endpoint, topic in [(self._rawtx_endpoint, b"rawtx"), (self._hashblock_endpoint, b"hashblock")]:
+            if endpoint != "":
+                socket.connect(endpoint)
+                socket.setsockopt(zmq.SUBSCRIBE, topic)
+
+        while True:
+            # Wake up for pending work even when nothing is published.
+            if socket.poll(100 if self._has_pending() else None):
+                # [topic, body, 4 byte sequence number]
+                topic, body = socket.recv_multipart()[:2]
+                self.last_notified = time.time()
+                try:
+                    if topic == b"rawtx":
+                        self._on_rawtx(body)
+                    elif topic == b"hashblock":
+                        self._on_hashblock(body)
+                except Exception as e:
+                    logging.warning("Failed to handle ZMQ {}: {}".format(topic, e))
+            self._process_pending()
+
+    def _has_pending(self) -> bool:
+        with self._lock:
+            return len(self._unapplied) > 0 or self._block_sync_at is not None
+
+    def _on_rawtx(self, body: bytes):
+        tx = CTransaction.deserialize(body)
+        self.tx_count += 1
+        with self._lock:
+            for wallet in self._wallets:
+                touched = wallet.addresses_touched_by(tx)
+                if len(touched) == 0:
+                    continue
+                logging.debug("ZMQ rawtx {} touches {} addresses".format(b2lx(tx.GetTxid()), len(touched)))
+                wallet.last_notified = time.time()
+                self._unapplied.append((wallet, tx))
+                self._touched.setdefault(wallet, set()).update(touched)
+
+    def _on_hashblock(self, body: bytes):
+        self.block_count += 1
+        logging.debug("ZMQ hashblock {}".format(body.hex()))
+        with self._lock:
+            self._block_sync_at = time.time() + self._block_sync_delay
+            # Pending transactions may have been confirmed by the block.
+            self._block_sync_wallets.update(self._wallets)
+
+    def _process_pending(self):
+        with self._lock:
+            unapplied = self._unapplied
+            self._unapplied = []
+            block_sync = self._block_sync_at is not None and time.time() >= self._block_sync_at
+            block_syncs = []
+            if block_sync:
+                for wallet in self._block_sync_wallets:
+                    block_syncs.append((wallet, self._touched.pop(wallet, set())))
+                self._block_sync_wallets = set()
+                self._block_sync_at = None
+
+        for wallet, tx in unapplied:
+            wallet.apply_unconfirmed_tx(tx)
+
+        for wallet, touched in block_syncs:
+            self._scheduler.submit(self._wallets[wallet], functools.partial(self._block_sync, wallet, touched))
+
+    def _block_sync(self, wallet: Wallet, touched: Set[Address]):
+        """
+        Run by the scheduler after a block.
+        @touched: addresses touched by transactions since the block before.
+        """
+        addresses = touched | wallet.mempool_addresses()
+        if len(addresses) == 0:
+            return
+        if not wallet.sync_addresses(list(addresses)):
+            # Another sync was in progress, which may have started before the block. Try after the next one.
+            with self._lock:
+                self._touched.setdefault(wallet, set()).update(touched)
+
+gZmqSubscriber: ZmqSubscriber = None
+gZmqSubscriberLock = threading.Lock()
+
+def add_wallet(wallet_id: int, wallet: Wallet):
+    """
+    Keep wallet updated from ZMQ notifications. The subscriber starts with the first wallet.
+    @wallet_id: of the wallet in syncscheduler.gSyncScheduler.
+    """
+    global gZmqSubscriber
+    assert zmq is not None, "pyzmq is required for ZMQ notifications: pip install pyzmq"
+    with gZmqSubscriberLock:
+        if gZmqSubscriber is None:
+            gZmqSubscriber = ZmqSubscriber(Config.ZmqRawTxEndpoint, Config.ZmqHashBlockEndpoint,
+                                           Config.ZmqBlockSyncDelay, syncscheduler.gSyncScheduler)
+    gZmqSubscriber.add_wallet(wallet_id, wallet)